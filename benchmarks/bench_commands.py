@@ -0,0 +1,336 @@
+"""Time dotsync commands end to end on synthetic homes.
+
+Generates a home and a dotsync repo per scale, then runs update, diff, list,
+save, restore and clean through dotsync.__main__.main, recording wall time,
+subprocess spawns and filesystem calls for each. Run from the project root::
+
+    python benchmarks/bench_commands.py --files 1000,10000 --output bench.json
+
+Every synthetic home mixes:
+
+* loose files listed one by one, split over several categories, two hosts
+  (``laptop`` and ``desktop`` groups) and a per-host override
+* a deep ``@tree:`` hierarchy holding the bulk of the files
+* a symlink farm (a tree of symlinks pointing at a shared directory)
+* a few ``|encrypt`` entries, skipped with ``--no-encrypt`` or when gpg is
+  missing
+
+Filesystem calls are counted by wrapping the os functions dotsync uses, which
+misses calls made from C (shutil's sendfile, DirEntry.stat). On Linux the
+read/write syscall counts of the process are taken from /proc/self/io as
+well. Results are written as JSON so runs can be compared across releases.
+"""
+
+import argparse
+import builtins
+import contextlib
+import getpass
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotsync import info  # noqa: E402
+from dotsync.__main__ import main  # noqa: E402
+
+RESULTS_VERSION = 1
+
+# os functions counted as filesystem calls
+FS_CALLS = ('stat', 'lstat', 'scandir', 'listdir', 'readlink', 'symlink',
+            'link', 'mkdir', 'makedirs', 'remove', 'unlink', 'rmdir',
+            'rename', 'replace', 'chmod', 'utime')
+
+PASSWORD = 'benchmark'
+HOST_GROUPS = {'laptop': ('common', 'tools', 'laptop-only'),
+               'desktop': ('common', 'tools', 'desktop-only')}
+HOST = 'laptop'
+CATEGORIES = [HOST]
+
+# fraction of the files in each part of the synthetic home
+LOOSE_SHARE = 0.05
+FARM_SHARE = 0.10
+MAX_LOOSE = 2000
+MAX_ENCRYPTED = 20
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_home(home, n_files, encrypt=True):
+    """Fill home with about n_files files and return the filelist for it."""
+    lines = [f'{host}={",".join(cats)}' for host, cats in HOST_GROUPS.items()]
+
+    n_loose = min(MAX_LOOSE, max(1, int(n_files * LOOSE_SHARE)))
+    n_farm = max(1, int(n_files * FARM_SHARE))
+    n_encrypted = min(MAX_ENCRYPTED, max(1, n_files // 100)) if encrypt else 0
+    n_tree = max(1, n_files - n_loose - n_farm - n_encrypted)
+
+    # loose files, cycling through shared and per-host categories
+    categories = ['common', 'tools', 'laptop-only', 'desktop-only']
+    for i in range(n_loose):
+        rel = f'.loose/dir{i % 20}/file{i}.conf'
+        write(os.path.join(home, rel), f'loose {i}\n' * 4)
+        lines.append(f'{rel}:{categories[i % len(categories)]}')
+    # the same file stored per host
+    write(os.path.join(home, '.profile'), 'export BENCH=1\n')
+    lines.append('.profile:laptop-only')
+    lines.append('.profile:desktop-only')
+
+    # deep tree, 8 levels with 5 directories per level until full
+    per_dir = 25
+    created = 0
+    index = 0
+    while created < n_tree:
+        parts = []
+        i = index
+        for _ in range(8):
+            parts.append(f'l{i % 5}')
+            i //= 5
+        dirname = os.path.join(home, '.config', 'deep', *parts)
+        for j in range(min(per_dir, n_tree - created)):
+            write(os.path.join(dirname, f'f{j}.txt'), f'{index}/{j}\n')
+            created += 1
+        index += 1
+    lines.append('@tree:.config/deep:common')
+
+    # symlink farm pointing into a shared directory outside the farm
+    share = os.path.join(home, '.local', 'share', 'bench')
+    farm = os.path.join(home, '.local', 'farm')
+    for i in range(n_farm):
+        target = os.path.join(share, f'd{i % 10}', f't{i}')
+        write(target, f'target {i}\n')
+        link = os.path.join(farm, f'd{i % 10}', f'l{i}')
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(target, link)
+    lines.append('@tree:.local/farm:tools')
+
+    for i in range(n_encrypted):
+        rel = f'.secret/key{i}'
+        write(os.path.join(home, rel), f'secret {i}\n')
+        lines.append(f'{rel}:common|encrypt')
+
+    return '\n'.join(lines) + '\n'
+
+
+def touch_some(home, every=10):
+    """Modify every n-th loose file so save/update have work to do."""
+    root = os.path.join(home, '.loose')
+    count = 0
+    for dirpath, _, files in os.walk(root):
+        for fname in sorted(files)[::every]:
+            with open(os.path.join(dirpath, fname), 'a') as f:
+                f.write('changed\n')
+            count += 1
+    return count
+
+
+class Counters:
+    """Counts subprocess spawns and filesystem calls while active."""
+
+    def __init__(self):
+        self.subprocesses = 0
+        self.fs_calls = {}
+        self._saved = []
+
+    def _patch(self, owner, name, wrapper):
+        self._saved.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, wrapper)
+
+    def _counting(self, name, func):
+        def wrapper(*args, **kwargs):
+            self.fs_calls[name] = self.fs_calls.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        popen_init = subprocess.Popen.__init__
+
+        def init(popen, *args, **kwargs):
+            self.subprocesses += 1
+            popen_init(popen, *args, **kwargs)
+
+        self._patch(subprocess.Popen, '__init__', init)
+        for name in FS_CALLS:
+            if hasattr(os, name):
+                self._patch(os, name, self._counting(name, getattr(os, name)))
+        self._patch(builtins, 'open', self._counting('open', builtins.open))
+        self.io_before = read_proc_io()
+        return self
+
+    def __exit__(self, *exc):
+        self.io_after = read_proc_io()
+        for owner, name, value in reversed(self._saved):
+            setattr(owner, name, value)
+        self._saved = []
+
+    def io(self):
+        if self.io_before is None or self.io_after is None:
+            return {}
+        return {key: self.io_after[key] - self.io_before[key]
+                for key in self.io_before}
+
+
+# read/write syscall and byte counts of this process (Linux only)
+def read_proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+    except OSError:
+        return None
+    return {key: int(value) for key, value in fields.items()
+            if key in ('syscr', 'syscw', 'rchar', 'wchar')}
+
+
+def run_command(name, argv, repo, home):
+    # command output would drown the results table
+    with contextlib.redirect_stdout(io.StringIO()), Counters() as counters:
+        start = time.perf_counter()
+        code = main(args=argv, cwd=repo, home=home)
+        elapsed = time.perf_counter() - start
+
+    if code not in (0, None):
+        raise RuntimeError(f'{" ".join(argv)} exited with {code}')
+
+    proc_io = counters.io()
+    return {
+        'command': name,
+        'argv': argv,
+        'seconds': round(elapsed, 6),
+        'subprocesses': counters.subprocesses,
+        'fs_calls': sum(counters.fs_calls.values()),
+        'fs_calls_by_name': dict(sorted(counters.fs_calls.items())),
+        'read_syscalls': proc_io.get('syscr'),
+        'write_syscalls': proc_io.get('syscw'),
+    }
+
+
+def bench_scale(n_files, encrypt, workdir):
+    home = os.path.join(workdir, f'home-{n_files}')
+    repo = os.path.join(workdir, f'repo-{n_files}')
+    os.makedirs(home)
+    os.makedirs(repo)
+
+    start = time.perf_counter()
+    flist = make_home(home, n_files, encrypt=encrypt)
+    generate = time.perf_counter() - start
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        main(args=['init'], cwd=repo)
+    with open(os.path.join(repo, 'filelist'), 'w') as f:
+        f.write(flist)
+
+    common = ['--non-interactive']
+    steps = [
+        ('update (initial)', ['update', *CATEGORIES, *common]),
+        ('update (no-op)', ['update', *CATEGORIES, *common]),
+        ('diff', ['diff', *CATEGORIES]),
+        ('list', ['list']),
+        ('save --no-push', ['save', *CATEGORIES, '--no-push', *common]),
+        ('touch', None),
+        ('update (changed)', ['update', *CATEGORIES, *common]),
+        ('save --no-push (changed)',
+         ['save', *CATEGORIES, '--no-push', *common]),
+        ('restore --skip-pull', ['restore', *CATEGORIES, '--skip-pull',
+                                 '--conflict', 'overwrite', *common]),
+        ('clean', ['clean', *CATEGORIES, *common]),
+    ]
+
+    results = []
+    for name, argv in steps:
+        if argv is None:
+            touch_some(home)
+            continue
+        logging.info(f'{n_files} files: {name}')
+        result = run_command(name, argv, repo, home)
+        result['files'] = n_files
+        results.append(result)
+
+    return {'files': n_files, 'encrypt': encrypt,
+            'generate_seconds': round(generate, 6), 'commands': results}
+
+
+def missing(value):
+    return '-' if value is None else value
+
+
+def print_table(scales):
+    print(f'{"files":>8}  {"command":<26}{"seconds":>10}{"procs":>7}'
+          f'{"fs calls":>10}{"reads":>9}{"writes":>9}')
+    for scale in scales:
+        for r in scale['commands']:
+            print(f'{r["files"]:>8}  {r["command"]:<26}{r["seconds"]:>10.3f}'
+                  f'{r["subprocesses"]:>7}{r["fs_calls"]:>10}'
+                  f'{missing(r["read_syscalls"]):>9}'
+                  f'{missing(r["write_syscalls"]):>9}')
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', default='1000,10000',
+                        help='comma separated home sizes (e.g. 1000,10000,'
+                             '100000)')
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    parser.add_argument('--no-encrypt', action='store_true',
+                        help='leave out the encrypt plugin entries')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated homes and repos')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    scales = [int(n) for n in opts.files.split(',') if n]
+    encrypt = not opts.no_encrypt and shutil.which('gpg') is not None
+    if not opts.no_encrypt and not encrypt:
+        print('gpg not found, benchmarking without encrypted files')
+
+    workdir = tempfile.mkdtemp(prefix='dotsync-bench-')
+    # keep git and gpg away from the user's configuration
+    os.environ.update({
+        'GNUPGHOME': os.path.join(workdir, 'gnupg'),
+        'GIT_CONFIG_NOSYSTEM': '1',
+        'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@localhost',
+        'GIT_COMMITTER_NAME': 'bench',
+        'GIT_COMMITTER_EMAIL': 'bench@localhost',
+    })
+    os.makedirs(os.environ['GNUPGHOME'], mode=0o700)
+    getpass.getpass = lambda prompt='': PASSWORD
+    # categories are picked explicitly, the real hostname must not add any
+    info.hostname = 'dotsync-bench'
+
+    try:
+        results = [bench_scale(n, encrypt, workdir) for n in scales]
+    finally:
+        if opts.keep:
+            print(f'generated files kept in {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+
+    if opts.output:
+        data = {
+            'version': RESULTS_VERSION,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scales': results,
+        }
+        with open(opts.output, 'w') as f:
+            json.dump(data, f, indent=2)
+        print(f'results written to {opts.output}')
+
+
+if __name__ == '__main__':
+    main_bench()
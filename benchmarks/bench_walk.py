@@ -0,0 +1,108 @@
+"""Compare the scandir tree walker against the old os.walk implementation.
+
+Builds a synthetic home with N files spread over nested directories and
+times walk_tree for both engines. Run from the project root::
+
+    python benchmarks/bench_walk.py --files 100000 --workers 8
+"""
+
+import argparse
+import fnmatch
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotsync.tree import (  # noqa: E402
+    DIR_SKIP,
+    SYSTEM_FILES,
+    normalize_home_rel,
+    pattern_has_glob,
+    pattern_walk_root,
+    walk_tree,
+)
+
+
+def legacy_walk_tree(home, pattern):
+    abs_root = os.path.join(home, pattern_walk_root(pattern))
+    has_glob = pattern_has_glob(pattern)
+    results = {}
+    for root, dirs, files in os.walk(abs_root):
+        dirs[:] = [d for d in dirs if d not in DIR_SKIP]
+        for fname in files:
+            if fname in SYSTEM_FILES:
+                continue
+            abs_f = os.path.join(root, fname)
+            rel = normalize_home_rel(home, abs_f)
+            if has_glob:
+                if not fnmatch.fnmatch(rel, pattern):
+                    continue
+            elif rel != pattern and not rel.startswith(pattern + '/'):
+                continue
+            results[rel] = {'kind': 'symlink' if os.path.islink(abs_f) else 'file'}
+    return results
+
+
+def make_home(home, n_files, fanout=10, per_dir=50):
+    """Create n_files files, per_dir per directory, in a fanout-ary tree."""
+    root = os.path.join(home, '.config', 'bench')
+    created = 0
+    index = 0
+    while created < n_files:
+        parts = []
+        i = index
+        for _ in range(3):
+            parts.append(f'd{i % fanout}')
+            i //= fanout
+        dirname = os.path.join(root, *parts, f'leaf{index}')
+        os.makedirs(dirname)
+        for j in range(min(per_dir, n_files - created)):
+            with open(os.path.join(dirname, f'f{j}'), 'w') as f:
+                f.write('x')
+            created += 1
+        index += 1
+    return '.config/bench'
+
+
+def best_of(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        print(f'generating {opts.files} files in {home} ...')
+        pattern = make_home(home, opts.files)
+
+        legacy_t, expected = best_of(lambda: legacy_walk_tree(home, pattern), opts.repeat)
+        serial_t, serial = best_of(lambda: walk_tree(home, pattern, workers=1), opts.repeat)
+        par_t, parallel = best_of(
+            lambda: walk_tree(home, pattern, workers=opts.workers), opts.repeat
+        )
+
+        assert serial == expected and list(serial) == list(expected)
+        assert parallel == expected and list(parallel) == list(expected)
+
+        print(f'{"engine":<24}{"seconds":>10}{"speedup":>10}')
+        for name, t in (('os.walk (legacy)', legacy_t),
+                        ('scandir, 1 worker', serial_t),
+                        (f'scandir, {opts.workers} workers', par_t)):
+            print(f'{name:<24}{t:>10.3f}{legacy_t / t:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,26 +13,14 @@ if __name__ == '__main__':
     mod = os.path.dirname(os.path.realpath(__file__))
     site.addsitedir(os.path.dirname(mod))
 
+# only light modules are imported here, the rest is imported by the functions
+# needing them so that quick commands (list, categories, --version) do not pay
+# for loading git, the plugins or the file operation machinery
 from dotsync.args import Arguments
 from dotsync.enums import Actions
-from dotsync.file_ops import BatchApplyError
 from dotsync.policy import from_args
 from dotsync.checks import safety_checks
-from dotsync.flists import Filelist
-from dotsync.git import Git, GitPullError
-from dotsync.calc_ops import CalcOps, RestoreAborted
-from dotsync.tree import (
-    materialize_symlinks,
-    pattern_walk_root,
-    restore_symlinks,
-    walk_tree,
-)
-from dotsync.plugins.plain import PlainPlugin
-from dotsync.plugins.encrypt import EncryptPlugin
-from dotsync.interaction import (
-    collect_filelist_categories,
-    prompt_category_selection,
-)
+from dotsync import instrument
 import dotsync.info as info
 
 
@@ -57,9 +45,11 @@ def ensure_filelist_exists(flist_fname, create_if_missing=False):
 
 def load_filelist(flist_fname):
     """Load and parse filelist, return Filelist object or None if error"""
+    from dotsync.flists import Filelist
+
     if not ensure_filelist_exists(flist_fname):
         return None
-    return Filelist(flist_fname)
+    return Filelist(flist_fname, use_cache=True)
 
 
 def normalize_filepath(filepath, home):
@@ -338,6 +328,8 @@ def find_dotsync_repo(start_dir=None, home=None):
 # ------------------------------------------------------------------------------
 
 def init_repo(repo_dir, flist):
+    from dotsync.git import Git
+
     # Ensure repository directory exists
     if not os.path.exists(repo_dir):
         try:
@@ -467,6 +459,9 @@ def infer_category_from_path(filepath):
 
 def add_to_filelist(flist_fname, filepath, category, home, dry_run, verbose_level, encrypt=False, auto_update=False, repo=None, plugins=None, plugin_dirs=None):
     """Add a new configuration file to the filelist"""
+    from dotsync.calc_ops import CalcOps
+    from dotsync.flists import Filelist, invalidate_filelist_cache
+
     # System files to ignore (e.g., macOS .DS_Store, Windows Thumbs.db)
     SYSTEM_FILES = {'.DS_Store', 'Thumbs.db', '.DS_Store?'}
     
@@ -537,11 +532,13 @@ def add_to_filelist(flist_fname, filepath, category, home, dry_run, verbose_leve
             if existing_lines and not existing_lines[-1].endswith('\n'):
                 f.write('\n')
             f.write(tree_line)
+        invalidate_filelist_cache(flist_fname)
         logging.info(f'Added to filelist: @tree:{normalized_path}:{category}{plugin_suffix}')
         if auto_update and not dry_run and repo and plugins is not None and plugin_dirs is not None:
             logging.info('Auto-updating tree...')
             try:
-                filelist_obj = Filelist(flist_fname)
+                filelist_obj = Filelist(flist_fname, use_cache=True)
+                filelist_obj.cache_trees()
                 categories = [category]
                 update_args = Arguments(['update', category, '--non-interactive'])
                 active_filelist = prepare_active_filelist(
@@ -587,6 +584,7 @@ def add_to_filelist(flist_fname, filepath, category, home, dry_run, verbose_leve
         if existing_lines and not existing_lines[-1].endswith('\n'):
             f.write('\n')
         f.write(new_entry)
+    invalidate_filelist_cache(flist_fname)
     
     logging.info(f'Added to filelist: {normalized_path}:{category}{plugin_suffix}')
     
@@ -595,7 +593,7 @@ def add_to_filelist(flist_fname, filepath, category, home, dry_run, verbose_leve
         logging.info('Auto-updating file...')
         try:
             # Load filelist
-            filelist = Filelist(flist_fname)
+            filelist = Filelist(flist_fname, use_cache=True)
             manifest = filelist.manifest()
             
             # Activate categories
@@ -629,6 +627,8 @@ def add_to_filelist(flist_fname, filepath, category, home, dry_run, verbose_leve
 
 def encrypt_to_filelist(flist_fname, filepath, home, dry_run):
     """Convert an existing plain config file to encrypted management"""
+    from dotsync.flists import invalidate_filelist_cache
+
     # Normalize filepath
     normalized_path = normalize_filepath(filepath, home)
     if normalized_path is None:
@@ -714,6 +714,7 @@ def encrypt_to_filelist(flist_fname, filepath, home, dry_run):
     # Write updated filelist
     with open(flist_fname, 'w') as f:
         f.writelines(new_lines)
+    invalidate_filelist_cache(flist_fname)
     
     logging.info(f'Converted {normalized_path} to encrypted management')
     logging.info('Run "dotsync update" to re-sync the file with encryption')
@@ -744,6 +745,8 @@ def purge_repo_paths(repo, plugin_dirs, paths_by_plugin, dotsync_repo=None):
 
 def unmanage_from_filelist(flist_fname, filepath, home, repo, plugins, plugin_dirs, dry_run, policy=None, purge_repo=False):
     """Restore a configuration file to home directory and stop managing it"""
+    from dotsync.tree import pattern_walk_root
+
     normalized_path = normalize_filepath(filepath, home)
     if normalized_path is None:
         return 1
@@ -804,6 +807,9 @@ def unmanage_from_filelist(flist_fname, filepath, home, repo, plugins, plugin_di
 
 def _unmanage_tree(flist_fname, tree, home, repo, plugins, plugin_dirs, dry_run, policy, purge_repo):
     """Remove a @tree entry from the filelist and optionally purge mirrored paths."""
+    from dotsync.flists import invalidate_filelist_cache
+    from dotsync.tree import pattern_walk_root
+
     pattern = tree['pattern']
     if dry_run:
         logging.info(f'[DRY RUN] Would untrack tree {pattern}')
@@ -828,6 +834,7 @@ def _unmanage_tree(flist_fname, tree, home, repo, plugins, plugin_dirs, dry_run,
 
     with open(flist_fname, 'w') as f:
         f.writelines(new_lines)
+    invalidate_filelist_cache(flist_fname)
     logging.info(f'Removed tree {pattern} from filelist')
 
     if purge_repo:
@@ -859,6 +866,8 @@ def _unmanage_tree(flist_fname, tree, home, repo, plugins, plugin_dirs, dry_run,
 
 def _unmanage_one(flist_fname, normalized_path, home, repo, filelist, plugins, plugin_dirs, policy=None, purge_repo=False):
     """Unmanage a single file. filelist is the loaded object (may be stale after first call)."""
+    from dotsync.flists import invalidate_filelist_cache
+
     if normalized_path not in filelist.files:
         logging.error(f'File {normalized_path} is not managed by dotsync')
         return 1
@@ -934,6 +943,7 @@ def _unmanage_one(flist_fname, normalized_path, home, repo, filelist, plugins, p
 
     with open(flist_fname, 'w') as f:
         f.writelines(new_lines)
+    invalidate_filelist_cache(flist_fname)
     logging.info(f'Removed {normalized_path} from filelist')
 
     if purge_repo and os.path.exists(repo_file):
@@ -995,13 +1005,15 @@ def _collect_managed_entries(filelist, categories):
 
 def _collect_tree_summaries(filelist, home, categories):
     """Summarize active @tree entries without expanding into atomic paths."""
+    from dotsync.tree import pattern_walk_root
+
     flat = _flatten_list_categories(filelist, categories)
     summaries = []
     for tree in filelist.trees:
         if flat is not None and not set(tree['categories']) & set(flat):
             continue
         pattern = tree['pattern']
-        walked = walk_tree(home, pattern)
+        walked = filelist.walk_tree(home, pattern)
         paths = list(walked.keys())
         root = pattern_walk_root(pattern) or pattern
         if not paths:
@@ -1153,14 +1165,7 @@ def show_categories(flist_fname):
     if filelist is None:
         return 1
 
-    group_lines = []
-    with open(flist_fname, 'r') as f:
-        for line in f:
-            stripped = line.strip()
-            if not stripped or stripped.startswith('#'):
-                continue
-            if '=' in stripped:
-                group_lines.append(stripped)
+    group_lines = filelist.group_lines
 
     categories = set()
     for instances in filelist.files.values():
@@ -1207,10 +1212,14 @@ def confirm_prune(stale_paths, policy):
     return ans.lower() in ('y', 'yes')
 
 
+@instrument.timed('materialize_tree_symlinks')
 def materialize_tree_symlinks(filelist_obj, home, repo, plugin_dirs, categories):
     """Materialize symlinks for active @tree entries; return canonical repo paths."""
+    from dotsync.tree import materialize_symlinks
+
     symlink_canonicals = {}
     active_cats = filelist_obj._flatten_categories(categories)
+    expanded = filelist_obj.expand_trees(home, categories)
 
     for tree in filelist_obj.trees:
         if not set(active_cats) & set(tree['categories']):
@@ -1218,9 +1227,8 @@ def materialize_tree_symlinks(filelist_obj, home, repo, plugin_dirs, categories)
 
         plugin_name = tree['plugin']
         plugin_dir = plugin_dirs[plugin_name]
-        watched = filelist_obj.expand_trees(home, categories)
         watched = {
-            path: info for path, info in watched.items()
+            path: info for path, info in expanded.items()
             if set(info['categories']) & set(tree['categories'])
         }
         if not watched:
@@ -1242,6 +1250,7 @@ def materialize_tree_symlinks(filelist_obj, home, repo, plugin_dirs, categories)
     return symlink_canonicals
 
 
+@instrument.timed('prepare_active_filelist')
 def prepare_active_filelist(filelist_obj, home, categories, plugin_dirs=None, from_repo=False):
     """Merge atomic and tree entries for save/update/restore."""
     return filelist_obj.merge_active(
@@ -1254,6 +1263,8 @@ def prepare_active_filelist(filelist_obj, home, categories, plugin_dirs=None, fr
 
 def plugin_filelist(active_filelist, plugin):
     """Build calc_ops file dict for a single plugin."""
+    if hasattr(active_filelist, 'by_plugin'):
+        return active_filelist.by_plugin(plugin)
     return {
         path: active_filelist[path]
         for path in active_filelist
@@ -1261,10 +1272,22 @@ def plugin_filelist(active_filelist, plugin):
     }
 
 
+def prune_objects(plugins):
+    """Drop objects no repo file links to anymore, if the store is enabled."""
+    store = getattr(plugins.get('plain'), 'store', None)
+    if store is not None:
+        store.prune()
+
+
 def update_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args):
     """Update files from home to repository"""
+    from dotsync.calc_ops import CalcOps
+    from dotsync.file_ops import BatchApplyError
+    from dotsync.index import StatIndex
+
     clean_ops = []
     policy = from_args(args)
+    index = StatIndex(repo, rehash=getattr(args, 'rehash', False))
 
     symlink_canonicals = materialize_tree_symlinks(
         filelist_obj, home, repo, plugin_dirs, args.categories
@@ -1280,10 +1303,12 @@ def update_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_
         logging.debug(f'active filelist for plugin {plugin}: {flist}')
 
         plugin_dir = plugin_dirs[plugin]
-        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy)
+        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy, index=index)
 
         try:
             calc_ops.update(flist).apply(args.dry_run, keep_going=policy.keep_going)
+            if not args.dry_run:
+                calc_ops.record_synced()
         except BatchApplyError as e:
             for op_str, err in e.errors:
                 logging.error(f'{op_str}: {err}')
@@ -1292,13 +1317,12 @@ def update_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_
             logging.error(str(e))
             return 1
 
-        allowed = set(manifest.get(plugin, []))
-        stale = calc_ops.find_stale_repo_files(allowed)
-        if stale and not confirm_prune(stale, policy):
+        prune = calc_ops.plan_prune(manifest.get(plugin, []))
+        if prune.stale and not confirm_prune(prune.stale, policy):
             logging.info('Prune cancelled')
             return 1
 
-        clean_ops.append(calc_ops.clean_repo(manifest.get(plugin, [])))
+        clean_ops.append(prune.file_ops())
         plugins[plugin].clean_data(manifest.get(plugin, []))
 
     for clean_op in clean_ops:
@@ -1309,11 +1333,18 @@ def update_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_
                 logging.error(f'{op_str}: {err}')
             return 1
 
+    if not args.dry_run:
+        index.save()
+        for plugin in plugins.values():
+            plugin.flush()
+        prune_objects(plugins)
     return 0
 
 
 def ensure_repo_current(git, policy):
     """Fetch and fast-forward pull before restore; return HEAD sha or None on failure."""
+    from dotsync.git import GitPullError
+
     if policy.skip_pull:
         sha = git.head_sha()
     else:
@@ -1331,21 +1362,69 @@ def ensure_repo_current(git, policy):
     return sha
 
 
-def restore_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args):
+def prescan_restore(active_filelist, plugins, plugin_dirs, home):
+    """Compare the home files restore would overwrite, return RestorePrescans.
+
+    Run while git fetches so restore only compares the files the pull
+    changed.
+    """
+    from dotsync.calc_ops import CalcOps, RestorePrescan
+
+    prescans = {}
+    for plugin in plugins:
+        flist = plugin_filelist(active_filelist, plugin)
+        if not flist:
+            continue
+        calc_ops = CalcOps(plugin_dirs[plugin], home, plugins[plugin])
+        prescans[plugin] = calc_ops.prescan_restore(flist, RestorePrescan())
+    return prescans
+
+
+def restore_files(repo, filelist_obj, active_filelist, manifest, plugins,
+                  plugin_dirs, home, args, git=None, prescans=None):
     """Restore files from repository to home"""
+    from dotsync.calc_ops import CalcOps, RestoreAborted
+    from dotsync.file_ops import BatchApplyError
+    from dotsync.git import Git
+    from dotsync.tree import restore_symlinks
+
     clean_ops = []
     policy = from_args(args)
-
-    git = Git(repo)
-    if ensure_repo_current(git, policy) is None:
+    prescans = prescans or {}
+
+    if git is None:
+        git = Git(repo)
+    # None if nothing is committed yet
+    before = git.head_sha(check=False)
+    after = ensure_repo_current(git, policy)
+    if after is None:
         return 1
 
+    if after != before:
+        # the filelist was expanded before the pull, expand what was pulled
+        logging.debug(f'pulled {before}..{after}, reloading the filelist')
+        filelist_obj = load_filelist(os.path.join(repo, 'filelist'))
+        if filelist_obj is None:
+            return 1
+        filelist_obj.cache_trees()
+        try:
+            active_filelist = prepare_active_filelist(
+                filelist_obj, home, args.categories, plugin_dirs, from_repo=True,
+            )
+            manifest = filelist_obj.build_restore_manifest(
+                plugin_dirs, args.categories, repo,
+            )
+        except RuntimeError:
+            logging.error(f'Error activating categories: {args.categories}')
+            return 1
+
     active_cats = filelist_obj._flatten_categories(args.categories)
 
     for plugin in plugins:
         flist = plugin_filelist(active_filelist, plugin)
         plugin_dir = plugin_dirs[plugin]
-        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy)
+        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy,
+                           prescan=prescans.get(plugin))
 
         if flist:
             logging.debug(f'active filelist for plugin {plugin}: {flist}')
@@ -1391,8 +1470,13 @@ def restore_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin
 
 def clean_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args):
     """Clean files from repository that are no longer managed"""
+    from dotsync.calc_ops import CalcOps
+    from dotsync.file_ops import BatchApplyError
+    from dotsync.index import StatIndex
+
     clean_ops = []
     policy = from_args(args)
+    index = StatIndex(repo, rehash=getattr(args, 'rehash', False))
 
     for plugin in plugins:
         flist = plugin_filelist(active_filelist, plugin)
@@ -1401,7 +1485,7 @@ def clean_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_d
         logging.debug(f'active filelist for plugin {plugin}: {flist}')
 
         plugin_dir = plugin_dirs[plugin]
-        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy)
+        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy, index=index)
 
         try:
             calc_ops.clean(flist).apply(args.dry_run, keep_going=policy.keep_going)
@@ -1424,22 +1508,33 @@ def clean_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_d
                 logging.error(f'{op_str}: {err}')
             return 1
 
+    if not args.dry_run:
+        index.save()
+        for plugin in plugins.values():
+            plugin.flush()
+        prune_objects(plugins)
     return 0
 
 
 def show_diff(repo, filelist, plugins, plugin_dirs, home, git, args):
     """Show differences between home and repository"""
+    from dotsync.calc_ops import CalcOps
+    from dotsync.index import StatIndex
+
     print('\n'.join(git.diff(ignore=['.plugins/'])))
     policy = from_args(args)
+    index = StatIndex(repo, rehash=getattr(args, 'rehash', False))
 
     for plugin in plugins:
-        calc_ops = CalcOps(plugin_dirs[plugin], home, plugins[plugin], policy=policy)
+        calc_ops = CalcOps(plugin_dirs[plugin], home, plugins[plugin], policy=policy,
+                           index=index)
         diff = calc_ops.diff(args.categories)
         
         if diff:
             print(f'\n{plugin}-plugin updates not yet in repo:')
             print('\n'.join(diff))
-    
+
+    index.save()
     return 0
 
 
@@ -1468,14 +1563,196 @@ def push_with_remote(git, no_push=False):
     return 0
 
 
-def save_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args, git):
-    """Mirror home to repo, commit, and push by default."""
+def sync_paths(repo, filelist_obj, active_filelist, plugins, plugin_dirs, home,
+               paths, categories, policy, index, dry_run=False):
+    """Update the entries for the given absolute paths from home to the repo.
+
+    Only the matching active entries are compared and copied. Tree files that
+    were deleted from home are removed from the repository.
+    """
+    from dotsync.calc_ops import CalcOps
+    from dotsync.file_ops import BatchApplyError, FileOps
+
+    scoped, gone, unknown = filelist_obj.scope_active(
+        active_filelist, home, paths, categories,
+    )
+    for path in unknown:
+        logging.warning(f'{path} is not managed in the active categories')
+    if not scoped and not gone:
+        logging.error('none of the given paths are managed')
+        return 1
+
+    if any(entry.get('kind') == 'symlink' for entry in scoped.values()):
+        filelist_obj.invalidate_trees()
+        materialize_tree_symlinks(filelist_obj, home, repo, plugin_dirs, categories)
+
+    for plugin in plugins:
+        flist = scoped.by_plugin(plugin)
+        plugin_dir = plugin_dirs[plugin]
+
+        prune = FileOps(plugin_dir)
+        for path, entry in gone.items():
+            if entry['plugin'] != plugin:
+                continue
+            for category in filelist_obj._flatten_categories(entry['categories']):
+                target = os.path.join(category, path)
+                if os.path.lexists(os.path.join(plugin_dir, target)):
+                    logging.info(f'{target} no longer exists in home, removing')
+                    prune.remove(target)
+
+        if not flist and not prune.ops:
+            continue
+        logging.debug(f'syncing for plugin {plugin}: {list(flist)}')
+
+        calc_ops = CalcOps(plugin_dir, home, plugins[plugin], policy=policy, index=index)
+        try:
+            calc_ops.update(flist).apply(dry_run, keep_going=policy.keep_going)
+            if not dry_run:
+                calc_ops.record_synced()
+            prune.apply(dry_run, keep_going=policy.keep_going)
+        except BatchApplyError as e:
+            for op_str, err in e.errors:
+                logging.error(f'{op_str}: {err}')
+            return 1
+        except Exception as e:
+            logging.error(str(e))
+            return 1
+
+    if not dry_run:
+        index.save()
+    return 0
+
+
+def update_paths(repo, filelist_obj, active_filelist, plugins, plugin_dirs, home, args, cwd):
+    """Update only the files given on the command line."""
+    from dotsync.index import StatIndex
+
+    paths = [os.path.join(cwd, os.path.expanduser(p)) for p in args.paths]
+    index = StatIndex(repo, rehash=getattr(args, 'rehash', False))
+    return sync_paths(
+        repo, filelist_obj, active_filelist, plugins, plugin_dirs, home, paths,
+        args.categories, from_args(args), index, dry_run=args.dry_run,
+    )
+
+
+def watch_files(repo, flist_fname, filelist_obj, active_filelist, manifest, plugins,
+                plugin_dirs, home, args, git):
+    """Mirror home to repo once, then keep mirroring files as they change."""
+    from dotsync import watch
+    from dotsync.flists import Filelist
+    from dotsync.index import StatIndex
+
+    # nobody is around to answer prompts
+    args.non_interactive = True
+    args.keep_going = True
+    policy = from_args(args)
+
     result = update_files(
-        repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args
+        repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
     )
     if result != 0:
         return result
 
+    # paths that failed to sync are tried again with the next change
+    state = {'filelist': filelist_obj, 'active': active_filelist, 'retry': set()}
+    index = StatIndex(repo, rehash=getattr(args, 'rehash', False))
+
+    def make_watcher():
+        roots, dirs, files = watch.watch_targets(
+            state['filelist'], state['active'], home, args.categories,
+        )
+        # the filelist itself, to pick up new entries
+        files.append(os.path.abspath(flist_fname))
+        return watch.make_watcher(roots, files, poll=args.poll, dirs=dirs)
+
+    # reloads the filelist and does a full update, like a fresh start
+    def rescan(watcher):
+        state['filelist'] = Filelist(flist_fname, use_cache=True)
+        state['filelist'].cache_trees()
+        state['active'] = prepare_active_filelist(
+            state['filelist'], home, args.categories, plugin_dirs, from_repo=False,
+        )
+        update_files(
+            repo, state['filelist'], state['active'], state['filelist'].manifest(),
+            plugins, plugin_dirs, home, args,
+        )
+        try:
+            new = make_watcher()
+        except ValueError as e:
+            # the old watcher still sees the filelist being fixed
+            logging.error(f'{e}, still watching the previous entries')
+            return watcher
+        watcher.close()
+        return new
+
+    def sync(watcher, paths):
+        if os.path.abspath(flist_fname) in paths:
+            logging.info('filelist changed, reloading')
+            state['retry'] = set()
+            return rescan(watcher)
+
+        # other files under a watched directory change as well
+        is_managed = watch.managed(
+            state['filelist'], state['active'], home, args.categories,
+        )
+        paths = {path for path in paths | state['retry'] if is_managed(path)}
+        state['retry'] = set()
+        if not paths:
+            logging.debug('none of the changed paths are managed')
+            return watcher
+
+        if sync_paths(
+            repo, state['filelist'], state['active'], plugins, plugin_dirs, home,
+            paths, args.categories, policy, index,
+        ) != 0:
+            logging.warning(f'unable to sync {len(paths)} changed path(s), '
+                            'trying again with the next change')
+            state['retry'] = paths
+        return watcher
+
+    def commit():
+        with git.snapshot():
+            if not git.has_changes():
+                return
+            msg = git.gen_commit_message(ignore=['.plugins/'], pending=True)
+        if not msg or not msg.strip():
+            return
+        git.add()
+        try:
+            git.commit(msg)
+        except Exception as e:
+            logging.error(f'Failed to commit: {e}')
+            git.reset()
+
+    try:
+        watcher = make_watcher()
+    except ValueError as e:
+        logging.error(str(e))
+        return 1
+
+    print('Watching for changes, press Ctrl-C to stop')
+    return watch.run(
+        watcher, sync, rescan,
+        commit=commit,
+        debounce=args.debounce if args.debounce is not None else watch.DEBOUNCE,
+        commit_interval=args.commit_interval,
+    )
+
+
+def save_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args, git,
+               cwd=None):
+    """Mirror home to repo, commit, and push by default."""
+    if args.paths:
+        result = update_paths(
+            repo, filelist_obj, active_filelist, plugins, plugin_dirs, home, args, cwd,
+        )
+    else:
+        result = update_files(
+            repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args
+        )
+    if result != 0:
+        return result
+
     if args.dry_run:
         if args.no_push:
             logging.info('[DRY RUN] Would git add, commit (no push)')
@@ -1483,19 +1760,20 @@ def save_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_di
             logging.info('[DRY RUN] Would git add, commit, and push')
         return 0
 
-    has_new_changes = git.has_changes()
-    if not has_new_changes:
-        logging.warning('no changes detected in repo, not creating commit')
-        return push_with_remote(git, no_push=args.no_push)
+    with git.snapshot():
+        has_new_changes = git.has_changes()
+        if not has_new_changes:
+            logging.warning('no changes detected in repo, not creating commit')
+            return push_with_remote(git, no_push=args.no_push)
 
-    git.add()
-    msg = args.commit_message or git.gen_commit_message(ignore=['.plugins/'])
+        msg = args.commit_message or git.gen_commit_message(ignore=['.plugins/'],
+                                                            pending=True)
 
     if not msg or msg.strip() == '':
         logging.warning('no valid changes to commit after filtering')
-        git.reset()
         return push_with_remote(git, no_push=args.no_push)
 
+    git.add()
     try:
         git.commit(msg)
     except Exception as e:
@@ -1508,8 +1786,11 @@ def save_files(repo, filelist_obj, active_filelist, manifest, plugins, plugin_di
 
 def commit_changes(repo, git):
     """Commit changes to git repository"""
-    has_new_changes = git.has_changes()
-    
+    with git.snapshot():
+        has_new_changes = git.has_changes()
+        msg = has_new_changes and git.gen_commit_message(ignore=['.plugins/'],
+                                                         pending=True)
+
     if not has_new_changes:
         logging.warning('no changes detected in repo, not creating commit')
         # Even if no new changes, check if there are unpushed commits to push
@@ -1525,15 +1806,12 @@ def commit_changes(repo, git):
                     return 1
         return 0
     
-    git.add()
-    msg = git.gen_commit_message(ignore=['.plugins/'])
-    
     # Handle empty commit message (no valid changes after filtering)
     if not msg or msg.strip() == '':
         logging.warning('no valid changes to commit after filtering')
-        git.reset()
         return 0
     
+    git.add()
     try:
         git.commit(msg)
     except Exception as e:
@@ -1577,6 +1855,25 @@ def show_password(plugins):
     return 0
 
 
+def reencrypt_files(plugins, args):
+    """Re-encrypt encrypted files stored in the other format (armor setting)"""
+    plugin = plugins['encrypt']
+    target = 'ASCII armored' if plugin.armor else 'binary'
+    pending = [path for path in sorted(plugin.hashes)
+               if plugin.armored(path) != plugin.armor]
+    if not pending:
+        logging.info(f'all encrypted files are {target} already')
+        return 0
+    if args.dry_run:
+        for path in pending:
+            print(f'CONVERT {path} to {target}')
+        return 0
+
+    converted = plugin.convert(plugin.armor)
+    logging.info(f'converted {converted} encrypted file(s) to {target}')
+    return 0
+
+
 def change_password(dotfiles, plugins):
     """Change encryption password for encrypted files"""
     logging.debug('attempting to change encryption password')
@@ -1609,6 +1906,10 @@ def default_wizard_repo_path(home):
 
 def run_restore_wizard(cwd, home, args):
     """Bootstrap a new machine: clone remote, pick categories, restore."""
+    from dotsync.flists import Filelist
+    from dotsync.git import Git, GitPullError
+    from dotsync.interaction import collect_filelist_categories, prompt_category_selection
+
     policy = from_args(args)
     repo = default_wizard_repo_path(home)
 
@@ -1658,7 +1959,8 @@ def run_restore_wizard(cwd, home, args):
         logging.error(f'safety checks failed for {repo}, exiting')
         return 1
 
-    filelist_obj = Filelist(flist_fname)
+    filelist_obj = Filelist(flist_fname, use_cache=True)
+    filelist_obj.cache_trees()
     git = Git(repo)
     sha = ensure_repo_current(git, policy)
     if sha is None:
@@ -1682,6 +1984,7 @@ def run_restore_wizard(cwd, home, args):
     plugins, plugin_dirs, dotfiles = setup_plugins_and_dirs(repo)
     plugins['plain'].hard = args.hard_mode
     plugins['encrypt'].hard = args.hard_mode
+    plugins['encrypt'].rehash = getattr(args, 'rehash', False)
 
     try:
         active_filelist = prepare_active_filelist(
@@ -1710,19 +2013,29 @@ def run_restore_wizard(cwd, home, args):
 
 def setup_plugins_and_dirs(repo):
     """Setup plugins and plugin directories, return (plugins, plugin_dirs, dotfiles)"""
+    from dotsync.manifest import CACHE_DIR, read_config
+    from dotsync.objects import object_store
+    from dotsync.plugins.encrypt import EncryptPlugin
+    from dotsync.plugins.plain import PlainPlugin
+
     dotfiles = os.path.join(repo, 'dotfiles')
     logging.debug(f'dotfiles path is {dotfiles}')
+    config = read_config(repo)
     
     plugins_data_dir = os.path.join(repo, '.plugins')
     plugins = {
         'plain': PlainPlugin(
             data_dir=os.path.join(plugins_data_dir, 'plain'),
             repo_dir=os.path.join(dotfiles, 'plain'),
-            hard=False),  # Will be set from args if needed
+            hard=False,  # Will be set from args if needed
+            store=object_store(repo)),
         'encrypt': EncryptPlugin(
             data_dir=os.path.join(plugins_data_dir, 'encrypt'),
             repo_dir=os.path.join(dotfiles, 'encrypt'),
-            hard=False)
+            hard=False,
+            cache_dir=(os.path.join(repo, CACHE_DIR)
+                       if config.get('reuse_ciphertext', True) else None),
+            armor=config.get('armor', True))
     }
     
     plugin_dirs = {plugin: os.path.join(dotfiles, plugin) for plugin in plugins}
@@ -1739,6 +2052,18 @@ def main(args=None, cwd=os.getcwd(), home=info.home):
     logging.basicConfig(format=logging.BASIC_FORMAT, level=args.verbose_level)
     logging.debug(f'ran with arguments {args}')
 
+    if args.profile is None:
+        return run_action(args, cwd, home)
+
+    instrument.enable()
+    try:
+        return run_action(args, cwd, home)
+    finally:
+        instrument.print_report(args.profile)
+        instrument.disable()
+
+
+def run_action(args, cwd, home):
     # For init command, use specified directory or default to ~/.dotfiles or cwd
     # For track/add, bootstrap repo if missing; other commands require existing repo
     bootstrap_if_missing = args.action in (Actions.TRACK, Actions.ADD)
@@ -1803,8 +2128,11 @@ def main(args=None, cwd=os.getcwd(), home=info.home):
     
     flist_fname = os.path.join(repo, 'filelist')
 
-    # run safety checks
-    if not safety_checks(repo, home, args.action == Actions.INIT):
+    # run safety checks, listing commands only read the filelist and do not
+    # need git
+    read_only = args.action in (Actions.LIST, Actions.CATEGORIES)
+    if not safety_checks(repo, home, args.action == Actions.INIT,
+                         need_git=not read_only):
         logging.error(f'safety checks failed for {repo}, exiting')
         return 1
 
@@ -1813,10 +2141,21 @@ def main(args=None, cwd=os.getcwd(), home=info.home):
         init_repo(repo, flist_fname)
         return 0
 
+    # check for list (before setting up plugins, which list does not use)
+    if args.action == Actions.LIST:
+        return list_managed_files(
+            flist_fname, args.categories, home, top_level=args.top_level,
+        )
+
+    # check for categories
+    if args.action == Actions.CATEGORIES:
+        return show_categories(flist_fname)
+
     # Setup plugins early for add command (needed for auto-update)
     plugins, plugin_dirs, dotfiles = setup_plugins_and_dirs(repo)
     plugins['plain'].hard = args.hard_mode
     plugins['encrypt'].hard = args.hard_mode
+    plugins['encrypt'].rehash = getattr(args, 'rehash', False)
 
     # check for track / add (deprecated alias)
     if args.action in (Actions.TRACK, Actions.ADD):
@@ -1853,69 +2192,94 @@ def main(args=None, cwd=os.getcwd(), home=info.home):
             args.dry_run, policy=from_args(args), purge_repo=args.purge_repo,
         )
 
-    # check for list
-    if args.action == Actions.LIST:
-        return list_managed_files(
-            flist_fname, args.categories, home, top_level=args.top_level,
-        )
-
-    # check for categories
-    if args.action == Actions.CATEGORIES:
-        return show_categories(flist_fname)
-
     if args.action == Actions.SHOWPW:
         return show_password(plugins)
+    if args.action == Actions.REENCRYPT:
+        return reencrypt_files(plugins, args)
 
-    # Load filelist for other operations
-    filelist_obj = load_filelist(flist_fname)
-    if filelist_obj is None:
-        return 1
+    # set up git interface
+    from dotsync.git import Git
+    git = Git(repo)
 
+    # restore fetches while the filelist is expanded and the files it would
+    # overwrite are compared
+    fetching = (args.action == Actions.RESTORE
+                and not from_args(args).skip_pull and git.has_remote())
+    if fetching:
+        git.start_fetch()
+
+    # no early return below leaves the fetch running
     try:
-        if args.action == Actions.RESTORE:
-            active_filelist = prepare_active_filelist(
-                filelist_obj, home, args.categories, plugin_dirs, from_repo=True,
+        # Load filelist for other operations
+        filelist_obj = load_filelist(flist_fname)
+        if filelist_obj is None:
+            return 1
+        # every stage below shares one walk per @tree root
+        filelist_obj.cache_trees()
+
+        try:
+            if args.action == Actions.RESTORE:
+                active_filelist = prepare_active_filelist(
+                    filelist_obj, home, args.categories, plugin_dirs, from_repo=True,
+                )
+                manifest = filelist_obj.build_restore_manifest(
+                    plugin_dirs, args.categories, repo,
+                )
+            elif getattr(args, 'paths', None):
+                # tree files are looked up one path at a time by sync_paths, so
+                # no tree is walked
+                active_filelist = filelist_obj.activate(args.categories)
+                manifest = None
+            else:
+                active_filelist = prepare_active_filelist(
+                    filelist_obj, home, args.categories, plugin_dirs, from_repo=False,
+                )
+                manifest = filelist_obj.manifest()
+        except RuntimeError:
+            logging.error(f'Error activating categories: {args.categories}')
+            return 1
+
+        # Route to appropriate command function
+        if args.action == Actions.UPDATE and args.paths:
+            return update_paths(
+                repo, filelist_obj, active_filelist, plugins, plugin_dirs, home, args, cwd,
             )
-            manifest = filelist_obj.build_restore_manifest(
-                plugin_dirs, args.categories, repo,
+        elif args.action == Actions.UPDATE:
+            return update_files(
+                repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
             )
-        else:
-            active_filelist = prepare_active_filelist(
-                filelist_obj, home, args.categories, plugin_dirs, from_repo=False,
+        elif args.action == Actions.WATCH:
+            return watch_files(
+                repo, flist_fname, filelist_obj, active_filelist, manifest, plugins,
+                plugin_dirs, home, args, git,
             )
-            manifest = filelist_obj.manifest()
-    except RuntimeError:
-        logging.error(f'Error activating categories: {args.categories}')
-        return 1
-
-    # set up git interface
-    git = Git(repo)
-
-    # Route to appropriate command function
-    if args.action == Actions.UPDATE:
-        return update_files(
-            repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
-        )
-    elif args.action == Actions.SAVE:
-        return save_files(
-            repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args, git,
-        )
-    elif args.action == Actions.RESTORE:
-        return restore_files(
-            repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
-        )
-    elif args.action == Actions.CLEAN:
-        return clean_files(
-            repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
-        )
-    elif args.action == Actions.DIFF:
-        return show_diff(repo, active_filelist, plugins, plugin_dirs, home, git, args)
-    elif args.action == Actions.COMMIT:
-        return commit_changes(repo, git)
-    elif args.action == Actions.PASSWD:
-        return change_password(dotfiles, plugins)
+        elif args.action == Actions.SAVE:
+            return save_files(
+                repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args, git,
+                cwd=cwd,
+            )
+        elif args.action == Actions.RESTORE:
+            prescans = None
+            if fetching:
+                prescans = prescan_restore(active_filelist, plugins, plugin_dirs, home)
+            return restore_files(
+                repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
+                git=git, prescans=prescans,
+            )
+        elif args.action == Actions.CLEAN:
+            return clean_files(
+                repo, filelist_obj, active_filelist, manifest, plugins, plugin_dirs, home, args,
+            )
+        elif args.action == Actions.DIFF:
+            return show_diff(repo, active_filelist, plugins, plugin_dirs, home, git, args)
+        elif args.action == Actions.COMMIT:
+            return commit_changes(repo, git)
+        elif args.action == Actions.PASSWD:
+            return change_password(dotfiles, plugins)
 
-    return 0
+        return 0
+    finally:
+        git.wait_fetch()
 
 
 if __name__ == '__main__':
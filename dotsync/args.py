@@ -54,6 +54,12 @@ class CustomHelpFormatter(argparse.RawDescriptionHelpFormatter):
         return result
 
 
+# paths given to update/save are told apart from category names by looking
+# like a path: containing a slash or starting with a dot or tilde
+def is_path_arg(arg):
+    return '/' in arg or os.sep in arg or arg.startswith(('.', '~'))
+
+
 class Arguments:
     def __init__(self, args=None):
         # construct parser
@@ -123,6 +129,24 @@ class Arguments:
                             help='commit message for save command')
         parser.add_argument('--top-level', action='store_true',
                             help='for list: show one row per first-level path root')
+        parser.add_argument('--rehash', action='store_true',
+                            help='ignore the stat index and compare file contents')
+        parser.add_argument('--debounce', type=float, default=None,
+                            help='for watch: seconds without changes before '
+                                 'syncing (default: 0.5)')
+        parser.add_argument('--commit-interval', type=float, default=None,
+                            help='for watch: commit synced changes at most '
+                                 'every this many seconds')
+        parser.add_argument('--poll', action='store_true',
+                            help='for watch: poll for changes instead of '
+                                 'using inotify')
+        parser.add_argument('--profile', action='store_true',
+                            help='print time spent per phase and counters to '
+                                 'stderr when done')
+        parser.add_argument('--profile-format', default=None,
+                            choices=['table', 'json'],
+                            help='format of the --profile report (implies '
+                                 '--profile, default: table)')
 
         args = parser.parse_args(args)
         
@@ -192,8 +216,26 @@ class Arguments:
         self.commit_message = getattr(args, 'commit_message', None)
         self.purge_repo = getattr(args, 'purge_repo', False)
         self.top_level = getattr(args, 'top_level', False)
+        self.rehash = getattr(args, 'rehash', False)
+        # report format if profiling, None otherwise
+        profile_format = getattr(args, 'profile_format', None)
+        self.profile = None
+        if getattr(args, 'profile', False) or profile_format:
+            self.profile = profile_format or 'table'
+        self.debounce = getattr(args, 'debounce', None)
+        self.commit_interval = getattr(args, 'commit_interval', None)
+        self.poll = getattr(args, 'poll', False)
         self.action = Actions(args.action)
         self.categories = args.category
+        # update and save also take paths, only syncing the entries for them
+        self.paths = []
+        if self.action in (Actions.UPDATE, Actions.SAVE):
+            self.paths = [c for c in args.category if is_path_arg(c)]
+            if self.paths:
+                self.categories = [c for c in args.category
+                                   if not is_path_arg(c)]
+                if not self.categories:
+                    self.categories = ['common', info.hostname]
         if self.categories_filter:
             self.categories = [
                 c.strip() for c in self.categories_filter.split(',') if c.strip()
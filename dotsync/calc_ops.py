@@ -1,6 +1,7 @@
 import os
 import logging
 
+from dotsync import instrument
 from dotsync.file_ops import FileOps
 from dotsync.interaction import (
     decide_candidate,
@@ -10,16 +11,94 @@ from dotsync.interaction import (
 )
 
 
+# System files to ignore (e.g., macOS .DS_Store, Windows Thumbs.db)
+SYSTEM_FILES = {'.DS_Store', 'Thumbs.db', '.DS_Store?'}
+
+
 class RestoreAborted(Exception):
     pass
 
 
+class PrunePlan:
+    """Repo paths that are no longer backed by the manifest.
+
+    stale lists the files not in the manifest and is what the user is asked
+    to confirm. removals is what actually gets removed: the stale files and
+    the directories that are already empty. All paths are relative to the
+    repo.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.stale = []
+        self.removals = []
+        # directories that are already empty
+        self.empty = set()
+
+    def __bool__(self):
+        return bool(self.removals)
+
+    def file_ops(self):
+        fops = FileOps(self.repo)
+        for path in self.removals:
+            if path in self.empty:
+                logging.info(f'{path} is empty, removing')
+            else:
+                logging.info(f'{path} is not in the manifest, removing')
+            fops.remove(path)
+        return fops
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class RestorePrescan:
+    """samefile results for restore worked out ahead of time.
+
+    Filled while git fetches, so the conflict check of restore does not wait
+    for the network. A result is only used while neither file's stat changed,
+    files the pull (or anything else) touched since are compared again.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, source, dest, plugin):
+        try:
+            key = (_stat_key(source), _stat_key(dest))
+            same = plugin.samefile(source, dest)
+        except Exception:
+            return
+        self.results[(source, dest)] = (key, same)
+
+    # the result for source and dest, None if there is none or it is stale
+    def lookup(self, source, dest):
+        result = self.results.get((source, dest))
+        if result is None:
+            return None
+        try:
+            if (_stat_key(source), _stat_key(dest)) != result[0]:
+                return None
+        except OSError:
+            return None
+        return result[1]
+
+
 class CalcOps:
-    def __init__(self, repo, restore_path, plugin, policy=None):
+    def __init__(self, repo, restore_path, plugin, policy=None, index=None,
+                 prescan=None):
         self.repo = str(repo)
         self.restore_path = str(restore_path)
         self.plugin = plugin
         self.policy = policy
+        self.index = index
+        # a RestorePrescan with samefile results restore can reuse
+        self.prescan = prescan
+        # (repo_file, ext_file) pairs that update() queued a plugin apply for;
+        # recorded in the index once the ops were applied successfully
+        self.synced = []
 
     @staticmethod
     def _categories_for(path_entry):
@@ -27,8 +106,31 @@ class CalcOps:
             return path_entry['categories']
         return path_entry
 
+    # plugin.samefile, short-circuited by the stat index if one is available
+    @instrument.timed('CalcOps.samefile')
+    def samefile(self, repo_file, ext_file):
+        if self.index is None or os.path.islink(ext_file):
+            return self.plugin.samefile(repo_file, ext_file)
+        if self.index.lookup(repo_file, ext_file):
+            logging.debug(f'{ext_file} unchanged according to stat index')
+            return True
+        same = self.plugin.samefile(repo_file, ext_file)
+        if same:
+            self.index.record(repo_file, ext_file)
+        return same
+
+    # stores the pairs synced by the last update() in the stat index. should
+    # only be called after the returned ops have been applied
+    def record_synced(self):
+        if self.index is not None:
+            for repo_file, ext_file in self.synced:
+                self.index.record(repo_file, ext_file)
+        self.synced = []
+
+    @instrument.timed('CalcOps.update')
     def update(self, files):
         fops = FileOps(self.repo)
+        self.synced = []
 
         for path in files:
             entry = files[path]
@@ -116,7 +218,7 @@ class CalcOps:
             master = os.path.join(self.repo, master, path)
             slaves = [os.path.join(self.repo, s, path) for s in slaves]
 
-            if source != master and not self.plugin.samefile(master, source):
+            if source != master and not self.samefile(master, source):
                 if os.path.exists(master):
                     fops.remove(master)
                 # check if source is in repo, if it is not apply the plugin
@@ -135,6 +237,8 @@ class CalcOps:
                             fops.remove(original_path[source])
                         else:
                             fops.remove(source)
+                    else:
+                        self.synced.append((master, source))
 
             for slave in slaves:
                 if slave == source:
@@ -144,9 +248,8 @@ class CalcOps:
 
         return fops
 
-    def restore(self, files):
-        fops = FileOps(self.repo)
-
+    # yields the (repo file, home file) pairs restore works on
+    def _restore_pairs(self, files, quiet=False):
         for path in files:
             entry = files[path]
             if isinstance(entry, dict) and entry.get('kind') == 'symlink':
@@ -157,12 +260,28 @@ class CalcOps:
             source = os.path.join(self.repo, master, path)
 
             if not os.path.exists(source):
-                logging.debug(f'{source} not found in repo')
-                logging.warning(f'unable to find "{path}" in repo, skipping')
+                if not quiet:
+                    logging.debug(f'{source} not found in repo')
+                    logging.warning(f'unable to find "{path}" in repo, '
+                                    f'skipping')
                 continue
 
-            dest = os.path.join(self.restore_path, path)
+            yield source, os.path.join(self.restore_path, path)
+
+    # compares the files restore would overwrite with their repo copies and
+    # adds the results to prescan, without asking or changing anything
+    @instrument.timed('CalcOps.prescan_restore')
+    def prescan_restore(self, files, prescan):
+        for source, dest in self._restore_pairs(files, quiet=True):
+            if os.path.isfile(dest) and not os.path.islink(dest):
+                prescan.add(source, dest, self.plugin)
+        return prescan
 
+    @instrument.timed('CalcOps.restore')
+    def restore(self, files):
+        fops = FileOps(self.repo)
+
+        for source, dest in self._restore_pairs(files):
             should_proceed, should_copy = self._handle_restore_conflict(source, dest)
             
             if not should_proceed:
@@ -182,8 +301,13 @@ class CalcOps:
                 os.remove(dest)
             return (True, True)
 
+        same = None
+        if self.prescan is not None:
+            same = self.prescan.lookup(source, dest)
         try:
-            if self.plugin.samefile(source, dest):
+            if same is None:
+                same = self.plugin.samefile(source, dest)
+            if same:
                 logging.debug(f'{dest} is the same file as in the repo, skipping')
                 return (True, False)
         except Exception:
@@ -205,6 +329,7 @@ class CalcOps:
         raise RestoreAborted(f'Restore cancelled by user at {dest}')
 
     # removes links from restore path that point to the repo
+    @instrument.timed('CalcOps.clean')
     def clean(self, files):
         fops = FileOps(self.repo)
 
@@ -216,7 +341,7 @@ class CalcOps:
             restore_path = os.path.join(self.restore_path, path)
 
             if os.path.exists(repo_path) and os.path.exists(restore_path):
-                if self.plugin.samefile(repo_path, restore_path):
+                if self.samefile(repo_path, restore_path):
                     fops.remove(restore_path)
 
         return fops
@@ -224,94 +349,58 @@ class CalcOps:
     # will go through the repo and search for files that should no longer be
     # there. accepts a list of filenames that are allowed
     def clean_repo(self, filenames):
-        fops = FileOps(self.repo)
+        return self.plan_prune(filenames).file_ops()
 
-        if not os.path.isdir(self.repo):
-            return fops
-
-        # System files to ignore (e.g., macOS .DS_Store, Windows Thumbs.db)
-        SYSTEM_FILES = {'.DS_Store', 'Thumbs.db', '.DS_Store?'}
-
-        for category in os.listdir(self.repo):
-            # Skip system files
-            if category in SYSTEM_FILES:
-                continue
-
-            category_path = os.path.join(self.repo, category)
+    # returns the files in the repo that are not in filenames
+    def find_stale_repo_files(self, filenames):
+        return self.plan_prune(filenames).stale
 
-            # Skip if not a directory (shouldn't happen, but be safe)
-            if not os.path.isdir(category_path):
-                continue
+    # walks the repo once and returns a PrunePlan with the files that are not
+    # in filenames and the empty directories
+    @instrument.timed('CalcOps.plan_prune')
+    def plan_prune(self, filenames):
+        plan = PrunePlan(self.repo)
+        if not os.path.isdir(self.repo):
+            return plan
 
-            # remove empty category folders
-            try:
-                if not os.listdir(category_path):
-                    logging.info(f'{category} is empty, removing')
-                    fops.remove(category)
-                    continue
-            except (OSError, NotADirectoryError):
-                # If listdir fails, skip this entry
+        filenames = set(filenames)
+        try:
+            categories = list(os.scandir(self.repo))
+        except OSError:
+            return plan
+
+        for entry in categories:
+            # files directly in the repo are not managed by any category
+            if entry.name in SYSTEM_FILES or not entry.is_dir() \
+                    or entry.is_symlink():
                 continue
+            self._scan_prune(entry.path, entry.name, filenames, plan)
 
-            for root, dirs, files in os.walk(category_path):
-                # Filter out system files from directories list
-                dirs[:] = [d for d in dirs if d not in SYSTEM_FILES]
-
-                # remove empty directories
-                for dname in dirs:
-                    dname = os.path.join(root, dname)
-                    if os.path.isdir(dname):
-                        try:
-                            if not os.listdir(dname):
-                                dname = os.path.relpath(dname, self.repo)
-                                logging.info(f'{dname} is empty, removing')
-                                fops.remove(dname)
-                        except (OSError, NotADirectoryError):
-                            continue
-
-                # remove files that are not in the manifest
-                for fname in files:
-                    # Skip system files
-                    if fname in SYSTEM_FILES:
-                        continue
-                    fname = os.path.relpath(os.path.join(root, fname),
-                                            self.repo)
-                    if fname not in filenames:
-                        logging.info(f'{fname} is not in the manifest, '
-                                     'removing')
-                        fops.remove(fname)
-
-        return fops
+        plan.stale.sort()
+        plan.removals = sorted(plan.stale + list(plan.empty))
+        return plan
 
-    def find_stale_repo_files(self, filenames):
-        stale = []
-        if not os.path.isdir(self.repo):
-            return stale
+    # adds the stale files and empty directories under path to plan
+    def _scan_prune(self, path, rel, filenames, plan):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
 
-        SYSTEM_FILES = {'.DS_Store', 'Thumbs.db', '.DS_Store?'}
+        if not entries:
+            plan.empty.add(rel)
 
-        for category in os.listdir(self.repo):
-            if category in SYSTEM_FILES:
+        for entry in entries:
+            entry_rel = os.path.join(rel, entry.name)
+            if entry.name in SYSTEM_FILES:
                 continue
-            category_path = os.path.join(self.repo, category)
-            if not os.path.isdir(category_path):
+            elif entry.is_symlink() and entry.is_dir():
+                # symlinked directories are content, never descended into
                 continue
-            try:
-                if not os.listdir(category_path):
-                    continue
-            except (OSError, NotADirectoryError):
-                continue
-
-            for root, dirs, files in os.walk(category_path):
-                dirs[:] = [d for d in dirs if d not in SYSTEM_FILES]
-                for fname in files:
-                    if fname in SYSTEM_FILES:
-                        continue
-                    rel = os.path.relpath(os.path.join(root, fname), self.repo)
-                    if rel not in filenames:
-                        stale.append(rel)
-
-        return stale
+            elif entry.is_dir():
+                self._scan_prune(entry.path, entry_rel, filenames, plan)
+            elif entry_rel not in filenames:
+                plan.stale.append(entry_rel)
 
     # goes through the filelist and finds files that have modifications that
     # are not yet in the repo e.g. changes to encrypted files. This should not
@@ -333,7 +422,7 @@ class CalcOps:
                         continue
 
                     logging.debug(f'checking diff samefile for {restore_file}')
-                    if not self.plugin.samefile(category_file, restore_file):
+                    if not self.samefile(category_file, restore_file):
                         diffs.append(f'modified {restore_file}')
 
         return diffs
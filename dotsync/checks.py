@@ -1,18 +1,18 @@
 import os
 import logging
-import subprocess
+import shutil
 
 
-def safety_checks(dir_name, home, init):
+# need_git: whether the command about to run uses git. looking git up is cheap
+# (no process is started) but commands that do not need it should not fail
+# without it
+def safety_checks(dir_name, home, init, need_git=True):
     # check that we're not in the user's home folder
     if dir_name == home:
         logging.error('dotsync should not be run inside home folder')
         return False
 
-    try:
-        subprocess.run(['git', '--version'], check=True,
-                       stdout=subprocess.PIPE)
-    except FileNotFoundError:
+    if need_git and shutil.which('git') is None:
         logging.error('"git" command not found in path, needed for proper '
                       'dotsync operation')
         return False
@@ -13,9 +13,11 @@ class Actions(enum.Enum):
     CATEGORIES = 'categories'  # Show category groups and definitions
     UPDATE = 'update'      # Sync config files from home to repository
     SAVE = 'save'          # Mirror home to repo, commit, and push
+    WATCH = 'watch'        # Keep mirroring home to repo as files change
     RESTORE = 'restore'    # Restore config files from repository to home
     DIFF = 'diff'          # Show differences between home and repository
     COMMIT = 'commit'      # Commit changes to git and optionally push
     CLEAN = 'clean'        # Remove files from repository that are no longer managed
     PASSWD = 'passwd'      # Change encryption password for encrypted files
     SHOWPW = 'showpw'      # Print stored encryption password (local machine only)
+    REENCRYPT = 'reencrypt'  # Re-encrypt encrypted files in the configured format
@@ -0,0 +1,131 @@
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+
+from dotsync import instrument
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# _IOW(0x94, 9, int), clones the whole file as copy-on-write extents
+FICLONE = 0x40049409
+
+# copy modes from fastest to slowest. 'copy' is a plain shutil.copyfile
+# (which itself uses sendfile where it can) and always works
+MODES = ('reflink', 'copy_file_range', 'copy')
+
+# errors meaning the filesystem (pair) does not support a mode, as opposed to
+# the copy itself failing
+UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+               errno.ENOSYS}
+
+# (source st_dev, dest st_dev) -> index in MODES of the fastest mode not known
+# to be unsupported between the two filesystems
+_modes = {}
+_reported = set()
+_lock = threading.Lock()
+
+
+def _available(mode):
+    if mode == 'reflink':
+        return fcntl is not None and sys.platform.startswith('linux')
+    if mode == 'copy_file_range':
+        return hasattr(os, 'copy_file_range')
+    return True
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                        size - offset, offset, offset)
+            if copied == 0:
+                # some filesystems copy nothing instead of failing. the next
+                # mode starts dst over
+                fdst.truncate(0)
+                raise OSError(errno.EOPNOTSUPP,
+                              f'copy_file_range stopped at {offset} of {size} '
+                              f'bytes')
+            offset += copied
+
+
+def _copy(src, dst):
+    shutil.copyfile(src, dst)
+
+
+_COPIERS = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'copy': _copy,
+}
+
+
+def device_pair(src, dst):
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    return os.stat(src).st_dev, os.stat(dst_dir).st_dev
+
+
+def copyfile(src, dst):
+    """Copy the contents of src to dst like shutil.copyfile.
+
+    Tries a reflink first, then an in-kernel copy_file_range and falls back
+    to shutil.copyfile. Which modes a pair of filesystems supports is probed
+    on the first copy between them and cached for the rest of the run.
+    Returns the name of the mode that did the copy.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f'{src!r} and {dst!r} are the same file')
+
+    key = device_pair(src, dst)
+    start = _modes.get(key, 0)
+    for i in range(start, len(MODES)):
+        mode = MODES[i]
+        if not _available(mode):
+            continue
+        try:
+            _COPIERS[mode](src, dst)
+        except OSError as e:
+            if mode == 'copy' or e.errno not in UNSUPPORTED:
+                raise
+            logging.debug(f'{mode} not supported from {src} to {dst}: {e}')
+            with _lock:
+                _modes[key] = max(_modes.get(key, 0), i + 1)
+            continue
+
+        if instrument.enabled:
+            instrument.count('bytes copied', os.stat(dst).st_size)
+            instrument.count(f'files copied ({mode})')
+        with _lock:
+            report = (key, mode) not in _reported
+            _reported.add((key, mode))
+        if report:
+            logging.info(f'copying files from device {key[0]} to device '
+                         f'{key[1]} using {mode}')
+        return mode
+
+
+def copy2(src, dst):
+    """Like shutil.copy2 (for files) but copies the contents with copyfile."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def clear_cache():
+    with _lock:
+        _modes.clear()
+        _reported.clear()
@@ -2,7 +2,23 @@ import os
 import logging
 import enum
 import shutil
-import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotsync import fastcopy, instrument
+
+MAX_APPLY_WORKERS = 8
+
+
+# number of threads used to run independent file ops at the same time
+def apply_workers():
+    env = os.environ.get('DOTSYNC_APPLY_WORKERS')
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            logging.warning(f'invalid DOTSYNC_APPLY_WORKERS={env!r}, using default')
+    return min(MAX_APPLY_WORKERS, (os.cpu_count() or 1) * 2)
 
 
 class BatchApplyError(Exception):
@@ -64,54 +80,195 @@ class FileOps:
         self.check_dest_dir(dest)
         self.ops.append((plugin, (source, dest)))
 
-    def apply(self, dry_run=False, keep_going=False):
-        errors = []
-        for op in self.ops:
-            op, path = op
+    # splits the queued ops into waves. every op only depends on ops of
+    # earlier waves, ops in the same wave touch unrelated paths and can run
+    # in any order. two ops depend on each other if one of them writes a path
+    # the other one touches, or a parent of it. ops only reading the same
+    # source do not. returns lists of (index, op, path) where path is
+    # absolute and duplicate mkdirs dropped
+    def schedule(self):
+        # index of the last op that wrote each exact path
+        last_touch = {}
+        # ops reading each path since last_touch[path]
+        readers = {}
+        # ops touching something below a path since last_touch[path]
+        under = {}
+        levels = []
+        waves = []
 
+        for i, (op, path) in enumerate(self.ops):
             if type(path) is tuple:
-                src, dest = path
-                src, dest = self.check_path(src), self.check_path(dest)
-                logging.info(self.str_op(op, (src, dest)))
+                path = tuple(self.check_path(p) for p in path)
+                paths = path
+                # only a move changes its source
+                reads = () if op == Op.MOVE else path[:1]
             else:
                 path = self.check_path(path)
-                logging.info(self.str_op(op, path))
+                paths = (path,)
+                reads = ()
+
+            deps = []
+            parents = []
+            for p in paths:
+                parent = os.path.dirname(p)
+                while parent != p:
+                    parents.append(parent)
+                    p, parent = parent, os.path.dirname(parent)
+            for p in parents:
+                if p in last_touch:
+                    deps.append(last_touch[p])
 
-            if dry_run:
-                continue
-
-            def do_op():
-                if op == Op.LINK:
-                    src_rel = os.path.relpath(src, os.path.join(self.wd, os.path.dirname(dest)))
-                    os.symlink(src_rel, dest)
-                elif op == Op.COPY:
-                    shutil.copyfile(src, dest)
-                elif op == Op.MOVE:
-                    os.rename(src, dest)
-                elif op == Op.REMOVE:
-                    if os.path.isdir(path):
-                        shutil.rmtree(path)
+            if op == Op.MKDIR:
+                prev = last_touch.get(path)
+                if (prev is not None and self.ops[prev][0] == Op.MKDIR
+                        and all(d < prev for d in deps)):
+                    # nothing removed the dir since it was made
+                    levels.append(levels[prev])
+                    continue
+                # making a dir does not affect anything already below it
+                if prev is not None:
+                    deps.append(prev)
+            else:
+                for p in paths:
+                    if p in last_touch:
+                        deps.append(last_touch[p])
+                    if p in reads:
+                        deps.extend(under.get(p, ()))
                     else:
-                        os.remove(path)
-                elif op == Op.MKDIR:
-                    if not os.path.isdir(path):
-                        os.makedirs(path)
-                elif callable(op):
-                    op(src, dest)
+                        deps.extend(readers.pop(p, ()))
+                        deps.extend(under.pop(p, ()))
 
-            try:
-                do_op()
-            except Exception as e:
-                if keep_going:
-                    errors.append((self.str_op(op, path if type(path) is not tuple else (src, dest)), str(e)))
-                    logging.error(f'Failed: {e}')
+            level = 1 + max((levels[d] for d in deps), default=-1)
+            levels.append(level)
+            if level == len(waves):
+                waves.append([])
+            waves[level].append((i, op, path))
+
+            for p in paths:
+                if p in reads:
+                    readers.setdefault(p, []).append(i)
+                else:
+                    last_touch[p] = i
+            for p in parents:
+                under.setdefault(p, []).append(i)
+
+        return waves
+
+    def run_op(self, op, path):
+        if type(path) is tuple:
+            src, dest = path
+
+        if op == Op.LINK:
+            src_rel = os.path.relpath(src, os.path.join(self.wd, os.path.dirname(dest)))
+            os.symlink(src_rel, dest)
+        elif op == Op.COPY:
+            fastcopy.copyfile(src, dest)
+        elif op == Op.MOVE:
+            os.rename(src, dest)
+        elif op == Op.REMOVE:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        elif op == Op.MKDIR:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif callable(op):
+            op(src, dest)
+
+    @instrument.timed('FileOps.apply')
+    def apply(self, dry_run=False, keep_going=False):
+        if dry_run:
+            for op, path in self.ops:
+                if type(path) is tuple:
+                    path = tuple(self.check_path(p) for p in path)
                 else:
-                    raise
+                    path = self.check_path(path)
+                logging.info(self.str_op(op, path))
+            self.clear()
+            return
+
+        errors = []
+        workers = apply_workers()
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+        # set by the first failure unless keep_going, ops not started by then
+        # are skipped like the serial loop never got to them
+        stop = None if keep_going else threading.Event()
+        # plugins that ran ops, flushed once everything is done or failed
+        plugins = []
+        try:
+            for wave in self.schedule():
+                failed = self.run_wave(wave, pool, plugins, stop)
+                for op_str, e in failed:
+                    if not keep_going:
+                        raise e
+                    errors.append((op_str, str(e)))
+                    logging.error(f'Failed: {e}')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            for plugin in plugins:
+                plugin.flush()
 
         self.clear()
         if errors:
             raise BatchApplyError(errors)
 
+    # runs one wave of independent ops, ops of batchable plugins are handed to
+    # the plugin together. returns (op string, exception) for the failed ops
+    # in queue order. once stop (if given) is set no further op is started
+    def run_wave(self, wave, pool, plugins, stop=None):
+        failed = {}
+        batches = {}
+        singles = []
+
+        for i, op, path in wave:
+            logging.info(self.str_op(op, path))
+
+            owner = getattr(op, '__self__', None)
+            if callable(getattr(owner, 'flush', None)) and owner not in plugins:
+                plugins.append(owner)
+
+            if callable(op) and getattr(owner, 'batchable', False):
+                batches.setdefault(op, []).append((i, path))
+            else:
+                singles.append((i, op, path))
+
+        def run(single):
+            if stop is not None and stop.is_set():
+                return None
+            try:
+                self.run_op(*single[1:])
+            except Exception as e:
+                if stop is not None:
+                    stop.set()
+                return e
+
+        if pool is not None and len(singles) > 1:
+            results = pool.map(run, singles)
+        else:
+            results = map(run, singles)
+
+        # batches go to the plugins while the pool works on the other ops
+        for op, items in batches.items():
+            pairs = [path for _, path in items]
+            index = {path: i for i, path in items}
+            if stop is None:
+                errors = op.__self__.run_batch(op, pairs)
+            elif stop.is_set():
+                break
+            else:
+                errors = op.__self__.run_batch(op, pairs, stop=stop)
+            for src, dest, e in errors:
+                failed[index[(src, dest)]] = (self.str_op(op, (src, dest)), e)
+
+        for (i, op, path), e in zip(singles, results):
+            if e is not None:
+                failed[i] = (self.str_op(op, path), e)
+
+        return [failed[i] for i in sorted(failed)]
+
     def append(self, other):
         self.ops += other.ops
         return self
@@ -125,7 +282,7 @@ class FileOps:
         if type(op) is Op:
             op = op.name
         else:
-            op = dict(inspect.getmembers(op))['__self__'].strify(op)
+            op = op.__self__.strify(op)
 
         if type(path) is tuple:
             path = [strip_wd(p) for p in path]
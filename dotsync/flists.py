@@ -1,63 +1,234 @@
+import hashlib
+import json
 import logging
 import os
 import re
+import tempfile
+import time
 from dataclasses import asdict
 
 import dotsync.info as info
+from dotsync.manifest import CACHE_DIR, cache_dir
 from dotsync.tree import (
     TreeEntry,
+    TreeMatcher,
+    TreeWalkCache,
     expand_trees_from_repo,
-    pattern_has_glob,
-    pattern_walk_root,
+    normalize_home_rel,
+    scan_tree,
     walk_tree,
 )
 
 
+FILELIST_CACHE = 'filelist.json'
+# bump when the parsed representation changes
+FILELIST_CACHE_VERSION = 2
+# keys every valid cache has besides the parsed attributes
+CACHE_KEYS = ('stat', 'hash', 'written_ns')
+
+# a filelist written this close to when its cache was written could have
+# changed again within the same mtime tick, its content is verified instead
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def filelist_cache_path(fname):
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), CACHE_DIR,
+                        FILELIST_CACHE)
+
+
+def invalidate_filelist_cache(fname):
+    """Drop the parsed cache of fname, to be called after writing the filelist."""
+    try:
+        os.remove(filelist_cache_path(fname))
+    except FileNotFoundError:
+        pass
+
+
+class ActiveFiles(dict):
+    """Active files (path -> instance) as returned by Filelist.activate.
+
+    Keeps the paths partitioned by plugin so later stages can pick out one
+    plugin's files without scanning the whole dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._by_plugin = None
+
+    def __setitem__(self, path, instance):
+        if self._by_plugin is not None:
+            if path in self:
+                self._by_plugin = None
+            else:
+                self._by_plugin.setdefault(instance['plugin'], []).append(path)
+        super().__setitem__(path, instance)
+
+    # any other change drops the partition, it is rebuilt when next needed
+    def __delitem__(self, path):
+        self._by_plugin = None
+        super().__delitem__(path)
+
+    def pop(self, *args):
+        self._by_plugin = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self._by_plugin = None
+        return super().popitem()
+
+    def clear(self):
+        self._by_plugin = None
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        self._by_plugin = None
+        super().update(*args, **kwargs)
+
+    def setdefault(self, path, instance=None):
+        self._by_plugin = None
+        return super().setdefault(path, instance)
+
+    def by_plugin(self, plugin):
+        """The active files handled by plugin."""
+        if self._by_plugin is None:
+            self._by_plugin = {}
+            for path, instance in self.items():
+                self._by_plugin.setdefault(instance['plugin'], []).append(path)
+        return {path: self[path] for path in self._by_plugin.get(plugin, ())}
+
+
 class Filelist:
-    def __init__(self, fname):
+    # the attributes stored in the parsed cache
+    PARSED = ('groups', 'group_lines', 'files', 'trees')
+
+    def __init__(self, fname, use_cache=False):
         self.groups = {}
+        # group definition lines as written, for display
+        self.group_lines = []
         self.files = {}
         self.trees = []
+        # set by cache_trees(); None means every expansion walks again
+        self.tree_cache = None
+        self._expanded = {}
+        self._repo_expanded = {}
+        self._matcher = None
+        # built on first use by _category_index, see there
+        self._categories = None
+        self._flattened = {}
+        self._manifest = None
+
+        if use_cache:
+            self._load_cached(fname)
+            return
 
         logging.debug(f'parsing filelist in {fname}')
-
         with open(fname, 'r') as f:
-            for line in f.readlines():
-                line = line.strip()
+            self._parse(f.read())
+
+    # loads the parsed filelist from the repo's cache dir if it is still
+    # valid for fname (and this host), otherwise parses and stores it there
+    def _load_cached(self, fname):
+        path = filelist_cache_path(fname)
+        st = os.stat(fname)
+        stat = (st.st_size, st.st_mtime_ns)
+
+        # json, not pickle: the cache sits in the repo directory, where a
+        # cloned repo could put anything
+        cached = None
+        try:
+            with open(path, 'r') as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.debug(f'ignoring unreadable filelist cache {path}: {e}')
+
+        if (not isinstance(cached, dict)
+                or cached.get('version') != FILELIST_CACHE_VERSION
+                or cached.get('hostname') != info.hostname
+                or not all(k in cached for k in self.PARSED + CACHE_KEYS)
+                or not isinstance(cached['written_ns'], int)
+                or not all(isinstance(cached[attr], type(getattr(self, attr)))
+                           for attr in self.PARSED)):
+            cached = None
+
+        if cached is not None and cached['stat'] == list(stat) \
+                and stat[1] < cached['written_ns'] - RACY_WINDOW_NS:
+            logging.debug(f'using cached filelist for {fname}')
+            self._restore(cached)
+            return
+
+        with open(fname, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached is not None and cached['hash'] == digest:
+            logging.debug(f'filelist {fname} touched but unchanged, using cache')
+            self._restore(cached)
+        else:
+            logging.debug(f'parsing filelist in {fname}')
+            self._parse(content.decode())
+
+        data = {attr: getattr(self, attr) for attr in self.PARSED}
+        data.update(version=FILELIST_CACHE_VERSION, hostname=info.hostname,
+                    stat=stat, hash=digest, written_ns=time.time_ns())
+        self._save_cache(fname, data)
+
+    def _restore(self, cached):
+        for attr in self.PARSED:
+            setattr(self, attr, cached[attr])
+
+    def _save_cache(self, fname, data):
+        try:
+            dirname = cache_dir(os.path.dirname(os.path.abspath(fname)))
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.filelist-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, filelist_cache_path(fname))
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError as e:
+            logging.debug(f'unable to write filelist cache: {e}')
+
+    def _parse(self, content):
+        for line in content.split('\n'):
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
 
-                if not line or line.startswith('#'):
-                    continue
+            if line.startswith('@tree:'):
+                self._parse_tree_line(line[len('@tree:'):])
+                continue
 
-                if line.startswith('@tree:'):
-                    self._parse_tree_line(line[len('@tree:'):])
-                    continue
+            # group
+            if '=' in line:
+                self.group_lines.append(line)
+                group, categories = line.split('=')
+                categories = categories.split(',')
+                if group == info.hostname:
+                    categories.append(info.hostname)
+                self.groups[group] = categories
+            # file
+            else:
+                split = re.split('[:|]', line)
 
-                # group
-                if '=' in line:
-                    group, categories = line.split('=')
-                    categories = categories.split(',')
-                    if group == info.hostname:
-                        categories.append(info.hostname)
-                    self.groups[group] = categories
-                # file
-                else:
-                    split = re.split('[:|]', line)
-
-                    path, categories, plugin = split[0], ['common'], 'plain'
-                    if len(split) >= 2:
-                        if ':' in line:
-                            categories = split[1].split(',')
-                        else:
-                            plugin = split[1]
-                    if len(split) >= 3:
-                        plugin = split[2]
-
-                    if path not in self.files:
-                        self.files[path] = []
-                    self.files[path].append({
-                        'categories': categories,
-                        'plugin': plugin
-                    })
+                path, categories, plugin = split[0], ['common'], 'plain'
+                if len(split) >= 2:
+                    if ':' in line:
+                        categories = split[1].split(',')
+                    else:
+                        plugin = split[1]
+                if len(split) >= 3:
+                    plugin = split[2]
+
+                if path not in self.files:
+                    self.files[path] = []
+                self.files[path].append({
+                    'categories': categories,
+                    'plugin': plugin
+                })
 
     def _parse_tree_line(self, line):
         split = re.split('[:|]', line)
@@ -77,37 +248,96 @@ class Filelist:
             plugin=plugin,
         )))
 
+    # interns every category named by a file or tree instance to a bit and
+    # returns (category -> bit, [(path, instance, mask)], [tree mask]). an
+    # instance is active when its mask shares a bit with the active mask
+    def _category_index(self):
+        if self._categories is None:
+            ids = {}
+
+            def mask(categories):
+                m = 0
+                for category in categories:
+                    m |= 1 << ids.setdefault(category, len(ids))
+                return m
+
+            file_masks = [(path, instance, mask(instance['categories']))
+                          for path, instances in self.files.items()
+                          for instance in instances]
+            tree_masks = [mask(tree['categories']) for tree in self.trees]
+            self._categories = (ids, file_masks, tree_masks)
+        return self._categories
+
+    def category_mask(self, categories):
+        """Bit mask of the (group expanded) categories."""
+        return self._mask_of(self._flatten_categories(categories))
+
+    # bit mask of already flattened categories, groups are not expanded again
+    def _mask_of(self, flat):
+        ids = self._category_index()[0]
+        m = 0
+        for category in flat:
+            if category in ids:
+                m |= 1 << ids[category]
+        return m
+
     def activate(self, categories):
-        # expand groups
-        categories = [self.groups.get(c, [c]) for c in categories]
-        # flatten category list
-        categories = [c for cat in categories for c in cat]
+        active = self.category_mask(categories)
 
-        files = {}
-        for path in self.files:
-            for group in self.files[path]:
-                cat_list = group['categories']
-                if set(categories) & set(cat_list):
-                    if path in files:
-                        logging.error('multiple category lists active for '
-                                      f'{path}: {files[path]["categories"]} '
-                                      f'and {cat_list}')
-                        raise RuntimeError
-                    else:
-                        files[path] = group
+        files = ActiveFiles()
+        for path, group, mask in self._category_index()[1]:
+            if mask & active:
+                if path in files:
+                    logging.error('multiple category lists active for '
+                                  f'{path}: {files[path]["categories"]} '
+                                  f'and {group["categories"]}')
+                    raise RuntimeError
+                else:
+                    files[path] = group
 
         return files
 
+    def cache_trees(self):
+        """Memoize tree walks and expansions from now on.
+
+        Meant to be called once per invocation: afterwards every caller
+        expanding the same trees shares one walk per (home, pattern).
+        """
+        self.tree_cache = TreeWalkCache()
+        self._expanded.clear()
+        self._repo_expanded.clear()
+
+    def invalidate_trees(self):
+        if self.tree_cache is not None:
+            self.tree_cache.clear()
+        self._expanded.clear()
+        self._repo_expanded.clear()
+
+    def walk_tree(self, home, pattern):
+        if self.tree_cache is None:
+            return walk_tree(home, pattern)
+        return self.tree_cache.walk(home, pattern)
+
     def expand_trees(self, home, categories):
-        categories = [self.groups.get(c, [c]) for c in categories]
-        categories = [c for cat in categories for c in cat]
+        categories = self._flatten_categories(categories)
+        if self.tree_cache is None:
+            return self._expand_trees(home, categories)
 
+        key = (str(home), tuple(categories))
+        if key in self._expanded:
+            logging.debug(f'reusing tree expansion for {categories}')
+        else:
+            self._expanded[key] = self._expand_trees(home, categories)
+        return dict(self._expanded[key])
+
+    def _expand_trees(self, home, categories):
         files = {}
-        for tree in self.trees:
-            if not set(categories) & set(tree['categories']):
+        active = self._mask_of(categories)
+        for tree, mask in zip(self.trees, self._category_index()[2]):
+            if not mask & active:
                 continue
 
-            for path, node in walk_tree(home, tree['pattern']).items():
+            for path, node in self.walk_tree(home, tree['pattern']).items():
                 if path in files:
                     logging.error('multiple tree entries active for '
                                   f'{path}: {files[path]["categories"]} '
@@ -121,9 +351,26 @@ class Filelist:
 
         return files
 
+    def expand_repo_trees(self, plugin_dir, categories):
+        """expand_trees_from_repo for this filelist's trees, memoized like
+        expand_trees once cache_trees() was called."""
+        if self.tree_cache is None:
+            return expand_trees_from_repo(plugin_dir, self.trees, categories)
+
+        key = (str(plugin_dir), tuple(categories))
+        if key not in self._repo_expanded:
+            self._repo_expanded[key] = expand_trees_from_repo(
+                plugin_dir, self.trees, categories
+            )
+        return dict(self._repo_expanded[key])
+
+    # expands groups to their categories
     def _flatten_categories(self, categories):
-        expanded = [self.groups.get(c, [c]) for c in categories]
-        return [c for cat in expanded for c in cat]
+        key = tuple(categories)
+        if key not in self._flattened:
+            expanded = [self.groups.get(c, [c]) for c in categories]
+            self._flattened[key] = [c for cat in expanded for c in cat]
+        return list(self._flattened[key])
 
     def merge_active(self, home, categories, plugin_dir=None, from_repo=False):
         """Merge atomic active files with tree entries from home or repo."""
@@ -131,7 +378,7 @@ class Filelist:
         if from_repo:
             if plugin_dir is None:
                 raise ValueError('plugin_dir is required when from_repo=True')
-            trees = expand_trees_from_repo(plugin_dir, self.trees, categories)
+            trees = self.expand_repo_trees(plugin_dir, categories)
         else:
             trees = self.expand_trees(home, categories)
 
@@ -144,6 +391,71 @@ class Filelist:
 
         return files
 
+    def scope_active(self, active, home, paths, categories):
+        """Restrict the merged active filelist to the given absolute paths.
+
+        A directory stands for every entry below it. Files that appeared in an
+        active tree since active was built are added to it, tree files that
+        no longer exist in home are dropped from it. Returns (scoped, gone,
+        unknown) where gone maps the tree paths missing from home to their
+        entries and unknown lists the paths that are not managed at all.
+        """
+        active_mask = self.category_mask(categories)
+        tree_masks = {id(tree): mask for tree, mask
+                      in zip(self.trees, self._category_index()[2])}
+
+        # (given path, home relative path) for every file to look at
+        rels = []
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            rel = os.path.relpath(abs_path, home)
+            if rel == '.' or rel.startswith('..' + os.sep) or rel == '..':
+                rels.append((path, None))
+            elif os.path.isdir(abs_path) and not os.path.islink(abs_path):
+                prefix = normalize_home_rel(home, abs_path) + '/'
+                below = [p for p in active if p.startswith(prefix)]
+                below += [r for r, _ in scan_tree(home, abs_path)]
+                rels.extend((path, r) for r in dict.fromkeys(below))
+                if not below:
+                    rels.append((path, None))
+            elif rel in active or rel in self.files:
+                rels.append((path, rel))
+            else:
+                rels.append((path, normalize_home_rel(home, abs_path)))
+
+        scoped = ActiveFiles()
+        gone = {}
+        unknown = []
+        for path, rel in rels:
+            entry = None if rel is None else active.get(rel)
+            if entry is not None and 'kind' not in entry:
+                # atomic entries stay active whether or not the file exists
+                scoped[rel] = entry
+                continue
+
+            abs_path = None if rel is None else os.path.join(home, rel)
+            if entry is None:
+                tree = None if rel is None else self.find_tree_for_path(rel)
+                if tree is None or not tree_masks[id(tree)] & active_mask:
+                    unknown.append(path)
+                    continue
+                entry = {
+                    'categories': tree['categories'],
+                    'plugin': tree['plugin'],
+                    'kind': 'symlink' if os.path.islink(abs_path) else 'file',
+                }
+                if not os.path.lexists(abs_path):
+                    # deleted before it was ever seen, its mirror may exist
+                    gone[rel] = entry
+                    continue
+                active[rel] = entry
+            elif not os.path.lexists(abs_path):
+                gone[rel] = active.pop(rel)
+                continue
+            scoped[rel] = entry
+
+        return scoped, gone, unknown
+
     def build_save_manifest(self, home, categories, symlink_canonicals=None):
         """Manifest of allowed repo paths including expanded trees."""
         manifest = self.manifest()
@@ -153,7 +465,7 @@ class Filelist:
             if info.get('kind') == 'symlink':
                 continue
             plugin = info['plugin']
-            for category in self._expand_category_names(info['categories']):
+            for category in self._flatten_categories(info['categories']):
                 manifest.setdefault(plugin, []).append(os.path.join(category, path))
 
         if symlink_canonicals:
@@ -162,34 +474,15 @@ class Filelist:
 
         return manifest
 
-    def _expand_category_names(self, category_names):
-        expanded = []
-        for category in category_names:
-            if category in self.groups:
-                expanded.extend(self.groups[category])
-            else:
-                expanded.append(category)
-        return expanded
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            self._matcher = TreeMatcher(self.trees)
+        return self._matcher
 
     def find_tree_for_path(self, normalized_path):
         """Return tree entry whose pattern matches normalized_path, if any."""
-        for tree in self.trees:
-            pattern = tree['pattern']
-            walk_root = pattern_walk_root(pattern)
-            if walk_root and not (
-                normalized_path == walk_root
-                or normalized_path.startswith(walk_root + '/')
-            ):
-                continue
-            if pattern_has_glob(pattern):
-                import fnmatch
-                if fnmatch.fnmatch(normalized_path, pattern):
-                    return tree
-                if fnmatch.fnmatch(normalized_path + '/', pattern + '/*'):
-                    return tree
-            elif normalized_path == pattern or normalized_path.startswith(pattern + '/'):
-                return tree
-        return None
+        return self.matcher.owner(normalized_path)
 
     def build_restore_manifest(self, plugin_dirs, categories, dotsync_repo):
         """Manifest of allowed repo paths for restore/clean after pull."""
@@ -199,11 +492,11 @@ class Filelist:
         active_cats = self._flatten_categories(categories)
 
         for plugin_name, plugin_dir in plugin_dirs.items():
-            tree_files = expand_trees_from_repo(plugin_dir, self.trees, active_cats)
+            tree_files = self.expand_repo_trees(plugin_dir, active_cats)
             for path, info in tree_files.items():
                 if info['plugin'] != plugin_name:
                     continue
-                for category in self._expand_category_names(info['categories']):
+                for category in self._flatten_categories(info['categories']):
                     manifest.setdefault(plugin_name, []).append(
                         os.path.join(category, path)
                     )
@@ -217,21 +510,14 @@ class Filelist:
     # generates a list of all the filenames in each plugin for later use when
     # cleaning the repo
     def manifest(self):
-        manifest = {}
-
-        for path in self.files:
-            for instance in self.files[path]:
-                plugin = instance['plugin']
-                for category in instance['categories']:
-                    if category in self.groups:
-                        categories = self.groups[category]
-                    else:
-                        categories = [category]
+        if self._manifest is None:
+            manifest = {}
 
-                    if plugin not in manifest:
-                        manifest[plugin] = []
+            for path, instance, _ in self._category_index()[1]:
+                paths = manifest.setdefault(instance['plugin'], [])
+                for category in self._flatten_categories(instance['categories']):
+                    paths.append(os.path.join(category, path))
 
-                    for category in categories:
-                        manifest[plugin].append(os.path.join(category, path))
+            self._manifest = manifest
 
-        return manifest
+        return {plugin: list(paths) for plugin, paths in self._manifest.items()}
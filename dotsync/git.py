@@ -3,12 +3,27 @@ import subprocess
 import shlex
 import logging
 import enum
+import hashlib
+import contextlib
+
+from dotsync import instrument, proc
 
 
 class GitPullError(Exception):
     pass
 
 
+# seconds a git command may take before it is killed, None for no limit
+def git_timeout():
+    env = os.environ.get('DOTSYNC_GIT_TIMEOUT')
+    if env:
+        try:
+            return float(env)
+        except ValueError:
+            logging.warning(f'invalid DOTSYNC_GIT_TIMEOUT={env!r}, ignoring')
+    return None
+
+
 class FileState(enum.Enum):
     MODIFIED = 'M'
     ADDED = 'A'
@@ -19,12 +34,108 @@ class FileState(enum.Enum):
     UNTRACKED = '?'
 
 
+class StatusEntry:
+    """One path from `git status --porcelain=v2`.
+
+    stage/work hold the index and working tree state characters (' ' when
+    unchanged), orig_path is set for renames and copies and head_hash is the
+    object name of the file in HEAD (if it is in HEAD).
+    """
+
+    def __init__(self, stage, work, path, orig_path=None, head_hash=None,
+                 index_hash=None):
+        self.stage = stage
+        self.work = work
+        self.path = path
+        self.orig_path = orig_path
+        self.head_hash = head_hash
+        self.index_hash = index_hash
+
+    def __repr__(self):
+        return f'StatusEntry({self.stage!r}, {self.work!r}, {self.path!r})'
+
+
+# parses the NUL separated output of `git status --porcelain=v2 -z`
+def parse_status_v2(out):
+    entries = []
+    records = out.split('\0')
+    i = 0
+    while i < len(records):
+        record = records[i]
+        i += 1
+        if not record:
+            continue
+
+        kind = record[0]
+        if kind == '?':
+            entries.append(StatusEntry('?', '?', record[2:]))
+        elif kind == '1':
+            # 1 XY sub mH mI mW hH hI path
+            fields = record.split(' ', 8)
+            xy = fields[1].replace('.', ' ')
+            entries.append(StatusEntry(xy[0], xy[1], fields[8],
+                                       head_hash=fields[6],
+                                       index_hash=fields[7]))
+        elif kind == '2':
+            # 2 XY sub mH mI mW hH hI Xscore path, followed by the origPath
+            # record
+            fields = record.split(' ', 9)
+            xy = fields[1].replace('.', ' ')
+            entries.append(StatusEntry(xy[0], xy[1], fields[9],
+                                       orig_path=records[i],
+                                       head_hash=fields[6],
+                                       index_hash=fields[7]))
+            i += 1
+        elif kind == 'u':
+            # u XY sub m1 m2 m3 mW h1 h2 h3 path
+            fields = record.split(' ', 10)
+            entries.append(StatusEntry(fields[1][0], fields[1][1], fields[10]))
+        elif kind not in '#!':
+            logging.warning(f'Unexpected git status record: {record}')
+
+    return entries
+
+
+# object name git would give the contents of the file at path
+def blob_hash(path, hash_name='sha1'):
+    with open(path, 'rb') as f:
+        data = f.read()
+    h = hashlib.new(hash_name)
+    h.update(f'blob {len(data)}\0'.encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def _display_path(entry):
+    if entry.orig_path is not None:
+        return f'{entry.orig_path} -> {entry.path}'
+    return entry.path
+
+
 class Git:
+    # number of git processes started during this run, across all instances
+    spawned = 0
+
     def __init__(self, repo_dir):
         if not os.path.isdir(repo_dir):
             raise FileNotFoundError
 
         self.repo_dir = repo_dir
+        # results of read-only ref queries (remotes, branch, upstream, HEAD),
+        # dropped by every command that changes the repo
+        self.cache = {}
+        # status entries shared by queries inside a snapshot() block
+        self.snapshot_entries = None
+        self.in_snapshot = False
+        self.timeout = git_timeout()
+        # a `git fetch` started by start_fetch that fetch has not waited for
+        self.pending_fetch = None
+
+    @classmethod
+    def count_spawn(cls, cmd):
+        cls.spawned += 1
+        instrument.count('subprocesses')
+        logging.debug(f'git process #{cls.spawned}: {cmd}')
 
     @classmethod
     def clone(cls, url, dest_dir):
@@ -35,111 +146,212 @@ class Git:
         if parent:
             os.makedirs(parent, exist_ok=True)
         logging.info(f'cloning {url} to {dest_dir}')
+        cmd = ['git', 'clone', url, dest_dir]
+        cls.count_spawn(cmd)
         try:
-            subprocess.run(
-                ['git', 'clone', url, dest_dir],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-        except subprocess.CalledProcessError as e:
+            with instrument.span('Git.run clone'):
+                proc.run(cmd, timeout=git_timeout())
+        except proc.ProcessError as e:
             err = (e.stderr or b'').decode().strip()
             raise GitPullError(f'git clone failed: {err}') from e
+        except subprocess.TimeoutExpired as e:
+            raise GitPullError(f'git clone timed out after {e.timeout}s') from e
         return cls(dest_dir)
 
-    def run(self, cmd):
+    @staticmethod
+    def log_failure(cmd, e):
+        for output in (e.stdout, e.stderr):
+            if output:
+                logging.error(output.decode(errors='replace'))
+        logging.error(f'git command {cmd} failed with exit code '
+                      f'{e.returncode}\n')
+
+    # runs cmd and returns its stdout. with check off a failing command is
+    # not an error. interactive commands (push, pull) write their progress
+    # and remote messages to our stderr instead of having them captured
+    def run(self, cmd, input=None, check=True, interactive=False):
         if type(cmd) is not list:
             cmd = shlex.split(cmd)
         logging.info(f'running git command {cmd}')
+        self.count_spawn(cmd)
+        stderr = None if interactive else subprocess.PIPE
         try:
-            proc = subprocess.run(cmd, cwd=self.repo_dir,
-                                  stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(e.stdout.decode())
-            logging.error(f'git command {cmd} failed with exit code '
-                          f'{e.returncode}\n')
+            with instrument.span(f'Git.run {cmd[1] if len(cmd) > 1 else ""}'):
+                result = proc.run(cmd, cwd=self.repo_dir, input=input,
+                                  timeout=self.timeout, check=check,
+                                  stderr=stderr)
+        except proc.ProcessError as e:
+            self.log_failure(cmd, e)
             raise
+        except subprocess.TimeoutExpired:
+            logging.error(f'git command {cmd} timed out after '
+                          f'{self.timeout}s')
+            raise
+        if result.stderr:
+            logging.debug(result.stderr.decode(errors='replace'))
         logging.debug(f'git command {cmd} succeeded')
-        return proc.stdout.decode()
+        return result.stdout.decode()
 
     def init(self):
+        self.invalidate()
         self.run('git init')
 
     def reset(self, fname=None):
+        self.invalidate()
         self.run('git reset' if fname is None else f'git reset {fname}')
 
     def add(self, fname=None):
+        self.invalidate()
         self.run('git add --all' if fname is None else f'git add {fname}')
 
     def commit(self, message=None):
         if message is None:
             message = self.gen_commit_message()
-        return self.run(['git', 'commit', '-m', message])
+        self.invalidate()
+        # the message lists every changed file and can outgrow the limit on
+        # a single command line argument, so it goes through stdin
+        return self.run(['git', 'commit', '-F', '-'], input=message.encode())
+
+    # drops cached query results, called before any command that changes
+    # the index, refs or remotes
+    def invalidate(self):
+        self.cache.clear()
+        self.snapshot_entries = None
+
+    # returns the cached result of query, running it on the first call
+    def cached(self, key, query):
+        if key not in self.cache:
+            self.cache[key] = query()
+        return self.cache[key]
+
+    # inside this block has_changes, status, pending_changes, diff and
+    # gen_commit_message share a single `git status` call. commands changing
+    # the index (add, reset, commit) start a new one
+    @contextlib.contextmanager
+    def snapshot(self):
+        outer = self.in_snapshot
+        self.in_snapshot = True
+        try:
+            yield self
+        finally:
+            self.in_snapshot = outer
+            if not outer:
+                self.invalidate()
+
+    def status_entries(self):
+        if self.in_snapshot and self.snapshot_entries is not None:
+            return self.snapshot_entries
+        out = self.run(['git', 'status', '--porcelain=v2', '-z',
+                        '--untracked-files=all'])
+        entries = parse_status_v2(out)
+        if self.in_snapshot:
+            self.snapshot_entries = entries
+        return entries
 
     def status(self, staged=True):
-        out = self.run('git status --porcelain').strip()
         status = []
-        
-        # Handle empty output
-        if not out:
-            return status
-        
-        for line in out.split('\n'):
-            # Skip empty lines
-            if not line.strip():
-                continue
-            
-            # git status --porcelain format: XY filename
-            # X = staged state, Y = working tree state
-            # Both can be: M=modified, A=added, D=deleted, R=renamed, C=copied, U=updated, ?=untracked
-            # Space means no change in that area
-            if len(line) < 3:
-                logging.warning(f'Unexpected git status line format: {line}')
-                continue
-            
-            state_chars = line[:2]
-            path = line[3:].strip() if len(line) > 3 else ''
-            
-            # Handle special cases that don't follow XY format
-            if state_chars in ['!!', '##']:
-                continue
-            
-            # Extract stage and work states
-            stage_char = state_chars[0]
-            work_char = state_chars[1]
-            
+        for entry in self.status_entries():
             # Choose which state to use based on staged parameter
-            # If preferred state is space, try the other one
+            # If preferred state is unchanged, try the other one
             if staged:
-                state_char = stage_char if stage_char != ' ' else work_char
+                state_char = entry.stage if entry.stage != ' ' else entry.work
             else:
-                state_char = work_char if work_char != ' ' else stage_char
-            
-            # Skip if both states are spaces (no change)
+                state_char = entry.work if entry.work != ' ' else entry.stage
+
+            # Skip if both states are unchanged
             if state_char == ' ':
                 continue
-            
-            # Only process if we have a valid path
-            if not path:
-                continue
-            
+
             try:
                 file_state = FileState(state_char)
             except ValueError:
-                # Handle unknown states gracefully (might be submodule states, etc.)
-                logging.debug(f'Unknown file state: {state_char} in line: {line}, skipping')
+                # Handle unknown states gracefully (type changes, etc.)
+                logging.debug(f'Unknown file state: {state_char} for '
+                              f'{entry.path}, skipping')
                 continue
-            
-            status.append((file_state, path))
-        
+
+            status.append((file_state, _display_path(entry)))
+
         return sorted(status, key=lambda s: s[1])
 
+    # the changes `git add --all` would stage relative to HEAD, worked out
+    # without touching the index. renames are detected when a file was moved
+    # without changing its content
+    def pending_changes(self):
+        changes = []
+        deleted = {}
+        added = []
+
+        for entry in self.status_entries():
+            if entry.stage == '?':
+                added.append(entry)
+                continue
+            if entry.stage == 'A':
+                if entry.work != 'D':
+                    added.append(entry)
+                continue
+            if entry.orig_path is not None:
+                if entry.work == 'D':
+                    deleted[entry.orig_path] = entry
+                elif entry.stage == 'R':
+                    changes.append((FileState.RENAMED, _display_path(entry)))
+                else:
+                    # copies keep their source, only the copy is new
+                    added.append(entry)
+                continue
+            if 'D' in (entry.stage, entry.work):
+                deleted[entry.path] = entry
+            elif 'U' in (entry.stage, entry.work):
+                changes.append((FileState.UPDATED, entry.path))
+            else:
+                changes.append((FileState.MODIFIED, entry.path))
+
+        # a path deleted from the index but still in the working tree shows up
+        # as both deleted and untracked
+        for entry in list(added):
+            if entry.path in deleted:
+                added.remove(entry)
+                head_hash = deleted.pop(entry.path).head_hash
+                if self.worktree_hash(entry.path, head_hash) != head_hash:
+                    changes.append((FileState.MODIFIED, entry.path))
+
+        # pair deleted files with new files holding exactly the same content
+        by_hash = {}
+        for path, entry in deleted.items():
+            if entry.head_hash and entry.head_hash.strip('0'):
+                by_hash.setdefault(entry.head_hash, []).append(path)
+        for entry in added:
+            renamed_from = None
+            if by_hash:
+                content_hash = self.worktree_hash(entry.path, next(iter(by_hash)))
+                if by_hash.get(content_hash):
+                    renamed_from = by_hash[content_hash].pop(0)
+                    deleted.pop(renamed_from)
+            if renamed_from is not None:
+                changes.append((FileState.RENAMED, f'{renamed_from} -> {entry.path}'))
+            else:
+                changes.append((FileState.ADDED, entry.path))
+
+        changes.extend((FileState.DELETED, path) for path in deleted)
+        return sorted(changes, key=lambda s: s[1])
+
+    # object name of a file in the working tree, using the same hash
+    # algorithm as the object name like
+    def worktree_hash(self, path, like):
+        try:
+            return blob_hash(os.path.join(self.repo_dir, path),
+                             'sha1' if len(like) == 40 else 'sha256')
+        except OSError:
+            return None
+
     def has_changes(self):
-        return bool(self.run('git status -s --porcelain').strip())
+        return bool(self.status_entries())
 
-    def gen_commit_message(self, ignore=[]):
+    # pending: describe the changes `git add --all` would stage (see
+    # pending_changes) instead of what is currently staged
+    def gen_commit_message(self, ignore=[], pending=False):
         mods = []
-        for stat in self.status():
+        for stat in (self.pending_changes() if pending else self.status()):
             state, path = stat
             # skip all untracked files since they will not be committed
             if state == FileState.UNTRACKED:
@@ -161,42 +373,104 @@ class Git:
     def last_commit(self):
         return self.commits()[-1]
 
+    def remotes(self):
+        return self.cached('remotes', lambda: self.run('git remote').split())
+
     def has_remote(self):
-        return bool(self.run('git remote').strip())
+        return bool(self.remotes())
+
+    # with check off None is returned for a repo with no commits, without
+    # logging an error
+    def head_sha(self, check=True):
+        if not check and 'head' not in self.cache:
+            sha = self.run(['git', 'rev-parse', '--verify', '--quiet', 'HEAD'],
+                           check=False).strip()
+            return sha or None
+        return self.cached('head', lambda: self.run('git rev-parse HEAD').strip())
+
+    def branch(self):
+        return self.cached(
+            'branch', lambda: self.run('git rev-parse --abbrev-ref HEAD').strip())
+
+    # name of the upstream branch or None if the branch has none
+    def upstream(self):
+        def query():
+            try:
+                return self.run('git rev-parse --abbrev-ref @{upstream}').strip()
+            except subprocess.CalledProcessError:
+                return None
+        return self.cached('upstream', query)
 
-    def head_sha(self):
-        return self.run('git rev-parse HEAD').strip()
+    # starts `git fetch` in the background, the next fetch (or pull_ff_only)
+    # waits for it instead of fetching again
+    def start_fetch(self):
+        cmd = ['git', 'fetch']
+        logging.info(f'starting git command {cmd} in the background')
+        self.count_spawn(cmd)
+        self.invalidate()
+        self.pending_fetch = proc.start(cmd, cwd=self.repo_dir,
+                                        timeout=self.timeout)
 
     def fetch(self):
-        self.run('git fetch')
+        self.invalidate()
+        pending, self.pending_fetch = self.pending_fetch, None
+        if pending is None:
+            self.run('git fetch')
+            return
+
+        try:
+            with instrument.span('Git.run fetch (wait)'):
+                proc.wait(pending)
+        except proc.ProcessError as e:
+            self.log_failure(e.cmd, e)
+            raise
+        logging.debug('background git fetch succeeded')
+
+    # waits for a fetch start_fetch started that nothing else waited for, so
+    # no git process is left running. its errors were not asked for
+    def wait_fetch(self):
+        pending, self.pending_fetch = self.pending_fetch, None
+        if pending is None:
+            return
+        try:
+            proc.wait(pending)
+        except (proc.ProcessError, subprocess.TimeoutExpired) as e:
+            logging.debug(f'background git fetch failed: {e}')
 
     def pull_ff_only(self):
         try:
             self.fetch()
-            self.run('git pull --ff-only')
+            self.invalidate()
+            self.run('git pull --ff-only', interactive=True)
         except subprocess.CalledProcessError as e:
-            output = getattr(e, 'output', None) or getattr(e, 'stdout', b'') or b''
-            raise GitPullError(output.decode().strip()) from e
+            output = (getattr(e, 'output', None) or getattr(e, 'stdout', b'')
+                      or getattr(e, 'stderr', b'') or b'')
+            # the error of an interactive pull was already shown by git
+            raise GitPullError(output.decode().strip()
+                               or f'exit code {e.returncode}') from e
+        except subprocess.TimeoutExpired as e:
+            raise GitPullError(f'timed out after {e.timeout}s') from e
         return self.head_sha()
 
     def add_remote(self, name, url):
+        self.invalidate()
         self.run(['git', 'remote', 'add', name, url])
 
     def push(self):
-        branch = self.run('git rev-parse --abbrev-ref HEAD').strip()
-        try:
-            self.run('git rev-parse --abbrev-ref @{upstream}')
-        except subprocess.CalledProcessError:
-            self.run(['git', 'push', '-u', 'origin', branch])
+        branch = self.branch()
+        upstream = self.upstream()
+        self.invalidate()
+        if upstream is None:
+            self.run(['git', 'push', '-u', 'origin', branch], interactive=True)
         else:
-            self.run('git push')
+            self.run('git push', interactive=True)
 
     def has_unpushed_commits(self):
         """Check if there are commits that haven't been pushed to remote"""
         if not self.has_remote():
             return False
         try:
-            branch = self.run('git rev-parse --abbrev-ref HEAD').strip()
+            branch = self.branch()
             result = self.run(f'git rev-list --left-right --count {branch}...origin/{branch}')
             if result.strip():
                 ahead, behind = map(int, result.strip().split('\t'))
@@ -210,16 +484,14 @@ class Git:
                 return False
 
     def diff(self, ignore=[]):
-        if not self.has_changes():
-            return ['no changes']
-
-        self.add()
-        status = self.status()
-        self.reset()
+        with self.snapshot():
+            if not self.has_changes():
+                return ['no changes']
+            changes = self.pending_changes()
 
         diff = []
 
-        for path in status:
+        for path in changes:
             # ignore the paths specified in ignore
             if any((path[1].startswith(i) for i in ignore)):
                 continue
@@ -0,0 +1,75 @@
+import hashlib
+import mmap
+import os
+
+from dotsync import instrument
+
+# read size for hashing and comparing. hashlib releases the GIL for updates
+# this large, so concurrent hashing (gpg batches, tree walks) scales
+BUFSIZE = 1 << 20
+
+# files at least this large are hashed from a memory map in a single update
+# instead of being read in chunks
+MMAP_THRESHOLD = 64 << 20
+
+# hash for hashes that are stored or compared across versions (encrypt plugin
+# metadata)
+STORED = 'sha256'
+# hash for local change detection only, cheaper than sha256 on most CPUs
+FAST = 'blake2b'
+FAST_DIGEST_SIZE = 16
+
+
+def new_hash(algorithm=STORED):
+    if algorithm == FAST:
+        return hashlib.blake2b(digest_size=FAST_DIGEST_SIZE)
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm=STORED):
+    """Return the hex digest of the contents of the file at path.
+
+    algorithm is any hashlib name. Use the default (sha256) for hashes that
+    are stored and FAST for hashes that only detect local changes.
+    """
+    h = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        instrument.count('bytes hashed', size)
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+            return h.hexdigest()
+
+        buf = bytearray(min(BUFSIZE, max(size, 1)))
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+
+    return h.hexdigest()
+
+
+def samecontent(a, b):
+    """Return whether the files a and b hold the same bytes.
+
+    Files of different sizes are told apart from their stat alone, otherwise
+    both are read side by side until the first difference.
+    """
+    st_a = os.stat(a)
+    st_b = os.stat(b)
+    if st_a.st_size != st_b.st_size:
+        return False
+    if os.path.samestat(st_a, st_b):
+        return True
+
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            chunk = fa.read(BUFSIZE)
+            instrument.count('bytes compared', 2 * len(chunk))
+            if chunk != fb.read(BUFSIZE):
+                return False
+            if not chunk:
+                return True
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+from dotsync import hashing
+from dotsync.manifest import CACHE_DIR, cache_dir
+
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 2
+
+# a file modified this close to the moment we snapshot it could change again
+# within the same mtime tick, so such snapshots are not trusted later on
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def stat_tuple(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _hash_file(path):
+    return hashing.hash_file(path, hashing.FAST)
+
+
+class StatIndex:
+    """Persistent record of repo/home file pairs known to hold the same content.
+
+    Each entry is keyed by the repo file (relative to the dotsync repo) and
+    stores the home path, a (size, mtime_ns, inode) tuple for both sides and
+    the content hash of the home file. As long as neither stat tuple changed
+    the pair is considered in sync without reading either file.
+    """
+
+    def __init__(self, repo, rehash=False):
+        self.repo = str(repo)
+        self.path = os.path.join(self.repo, CACHE_DIR, INDEX_FILE)
+        self.rehash = rehash
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f'ignoring unreadable stat index {self.path}: {e}')
+            return
+        if data.get('version') != INDEX_VERSION:
+            logging.debug('stat index version changed, starting from scratch')
+            return
+        self.entries = data.get('entries', {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        dirname = cache_dir(self.repo)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.index-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'entries': self.entries}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.dirty = False
+        logging.debug(f'stat index: {self.hits} hit(s), {self.misses} miss(es), '
+                      f'{len(self.entries)} entries saved')
+
+    def _key(self, repo_file):
+        return os.path.relpath(str(repo_file), self.repo)
+
+    # returns True if repo_file and ext_file are known to be the same without
+    # looking at their content. a False result only means "unknown"
+    def lookup(self, repo_file, ext_file):
+        if self.rehash:
+            return False
+
+        key = self._key(repo_file)
+        entry = self.entries.get(key)
+        ext_file = os.path.abspath(str(ext_file))
+        if entry is None or entry['ext'] != ext_file:
+            self.misses += 1
+            return False
+
+        try:
+            repo_stat = stat_tuple(repo_file)
+            ext_stat = stat_tuple(ext_file)
+        except OSError:
+            self.forget(repo_file)
+            self.misses += 1
+            return False
+
+        if repo_stat != entry['repo_stat']:
+            self.misses += 1
+            return False
+
+        if ext_stat != entry['ext_stat']:
+            # home file was touched or rewritten, its content may still be
+            # the same so compare against the recorded hash (one read
+            # instead of two)
+            if entry.get('hash') is None or _hash_file(ext_file) != entry['hash']:
+                self.misses += 1
+                return False
+            entry['ext_stat'] = ext_stat
+            self.dirty = True
+
+        self.hits += 1
+        return True
+
+    # records that repo_file and ext_file currently hold the same content
+    def record(self, repo_file, ext_file):
+        ext_file = os.path.abspath(str(ext_file))
+        try:
+            repo_stat = stat_tuple(repo_file)
+            ext_stat = stat_tuple(ext_file)
+        except OSError:
+            self.forget(repo_file)
+            return
+
+        racy = time.time_ns() - RACY_WINDOW_NS
+        if repo_stat[1] >= racy or ext_stat[1] >= racy:
+            logging.debug(f'not indexing recently modified {ext_file}')
+            self.forget(repo_file)
+            return
+
+        self.entries[self._key(repo_file)] = {
+            'ext': ext_file,
+            'repo_stat': repo_stat,
+            'ext_stat': ext_stat,
+            'hash': _hash_file(ext_file),
+        }
+        self.dirty = True
+
+    def forget(self, repo_file):
+        if self.entries.pop(self._key(repo_file), None) is not None:
+            self.dirty = True
@@ -1,5 +1,5 @@
+import os
 from os.path import expanduser
-import socket
 
 __version__ = '2.0.5'
 __author__ = 'Harvey'
@@ -8,4 +8,16 @@ __url__ = 'https://github.com/HarveyGG/dotsync'
 __license__ = 'MIT License (Non-Commercial Use Only)'
 
 home = expanduser('~')
-hostname = socket.gethostname()
+
+
+# hostname is looked up on first use (PEP 562) instead of at import time
+def __getattr__(name):
+    if name == 'hostname':
+        global hostname
+        if hasattr(os, 'uname'):
+            hostname = os.uname().nodename
+        else:
+            import socket
+            hostname = socket.gethostname()
+        return hostname
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
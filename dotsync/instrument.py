@@ -0,0 +1,118 @@
+import functools
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# instrumentation is off unless --profile is given. every hook checks this
+# flag first so a normal run only pays for a global lookup
+enabled = False
+
+# span name -> [calls, seconds]. spans on worker threads are summed, so the
+# seconds of a span may exceed the wall time of the run
+_spans = {}
+_counters = {}
+_lock = threading.Lock()
+_started = None
+
+
+def enable():
+    global enabled, _started
+    reset()
+    enabled = True
+    _started = time.perf_counter()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def _record(name, seconds):
+    with _lock:
+        entry = _spans.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block under name when instrumentation is enabled."""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator timing every call of the decorated function as span name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def report():
+    with _lock:
+        spans = {name: {'calls': calls, 'seconds': round(seconds, 6)}
+                 for name, (calls, seconds) in _spans.items()}
+        counters = dict(_counters)
+    total = None if _started is None else time.perf_counter() - _started
+    return {
+        'total_seconds': None if total is None else round(total, 6),
+        'spans': dict(sorted(spans.items(),
+                             key=lambda item: -item[1]['seconds'])),
+        'counters': dict(sorted(counters.items())),
+    }
+
+
+def format_table(data):
+    lines = [f'{"span":<36}{"calls":>8}{"seconds":>12}']
+    for name, s in data['spans'].items():
+        lines.append(f'{name:<36}{s["calls"]:>8}{s["seconds"]:>12.3f}')
+    if data['total_seconds'] is not None:
+        lines.append(f'{"total (wall)":<36}{"":>8}'
+                     f'{data["total_seconds"]:>12.3f}')
+    if data['counters']:
+        lines.append('')
+        lines.append(f'{"counter":<36}{"value":>20}')
+        for name, value in data['counters'].items():
+            lines.append(f'{name:<36}{value:>20}')
+    return '\n'.join(lines)
+
+
+# prints the collected spans and counters to stderr, so the output of the
+# command itself stays usable
+def print_report(fmt='table', file=None):
+    file = sys.stderr if file is None else file
+    data = report()
+    if fmt == 'json':
+        import json
+        print(json.dumps(data, indent=2), file=file)
+    else:
+        print(format_table(data), file=file)
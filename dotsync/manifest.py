@@ -1,8 +1,15 @@
 import json
+import logging
 import os
 
 MANIFESTS_DIR = '.dotsync/manifests'
 MATERIALIZED_DIR = '.dotsync/materialized'
+# machine-local state (stat snapshots, parsed caches); never committed
+CACHE_DIR = '.dotsync/cache'
+# machine-local content store the mirror paths are hardlinked to, see objects
+OBJECTS_DIR = '.dotsync/objects'
+# repo wide settings, committed with the repo
+CONFIG_FILE = '.dotsync/config.json'
 
 
 def manifest_path(repo, category):
@@ -23,3 +30,34 @@ def write_manifest(repo, category, entries):
     with open(path, 'w') as f:
         json.dump(entries, f, indent=2)
         f.write('\n')
+
+
+def ensure_ignored_dir(path):
+    """Create path with a .gitignore that keeps its contents out of git."""
+    os.makedirs(path, exist_ok=True)
+    ignore = os.path.join(path, '.gitignore')
+    if not os.path.exists(ignore):
+        with open(ignore, 'w') as f:
+            f.write('*\n')
+    return path
+
+
+def cache_dir(repo):
+    return ensure_ignored_dir(os.path.join(repo, CACHE_DIR))
+
+
+def read_config(repo):
+    """Repo wide settings from .dotsync/config.json, {} if there are none."""
+    path = os.path.join(repo, CONFIG_FILE)
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f'ignoring unreadable {path}: {e}')
+        return {}
+    if not isinstance(config, dict):
+        logging.warning(f'ignoring {path}, expected a JSON object')
+        return {}
+    return config
@@ -0,0 +1,139 @@
+import errno
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+from dotsync import fastcopy, hashing, instrument
+from dotsync.manifest import OBJECTS_DIR, ensure_ignored_dir, read_config
+
+# .dotsync/config.json key turning the store on
+CONFIG_KEY = 'object_store'
+
+# errors meaning the filesystem cannot hardlink dest to the store, dest is
+# copied instead
+LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+                    errno.ENOTSUP}
+
+
+class ObjectStore:
+    """Content addressed store that mirror files are hardlinked into.
+
+    Every distinct (content, permission bits) pair is stored once as
+    .dotsync/objects/<sha256[:2]>/<sha256>-<mode> and each mirror path holding
+    that content is a hardlink to it, so identical files under several
+    categories, hosts or materialized symlink targets take the space (and
+    copy) of one. The store is machine-local and git-ignored; git itself
+    already stores every content once.
+
+    Mirror paths are only ever replaced, never written in place, so
+    changing one file cannot change the others sharing its object.
+    """
+
+    def __init__(self, repo):
+        self.root = os.path.join(repo, OBJECTS_DIR)
+        self.fallback = False
+        self._lock = threading.Lock()
+
+    def object_path(self, digest, mode):
+        return os.path.join(self.root, digest[:2], f'{digest}-{mode:o}')
+
+    # returns the object holding the contents of source, storing it first if
+    # needed
+    def store(self, source):
+        ensure_ignored_dir(self.root)
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.object-')
+        os.close(fd)
+        try:
+            # the object is named by the hash of the copy, so it holds exactly
+            # the hashed bytes even if source changes meanwhile
+            fastcopy.copyfile(source, tmp)
+            shutil.copystat(source, tmp)
+            mode = stat.S_IMODE(os.stat(tmp).st_mode)
+            path = self.object_path(hashing.hash_file(tmp), mode)
+            if os.path.exists(path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # linking fails if another worker stored the same object in the
+            # meantime. replacing it would orphan what was already linked to it
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                return path
+            except OSError as e:
+                if e.errno not in LINK_UNSUPPORTED:
+                    raise
+                os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        instrument.count('objects stored')
+        return path
+
+    def link(self, source, dest):
+        """Make dest a hardlink to the stored contents of source.
+
+        Falls back to a copy where dest cannot be linked to the store (e.g.
+        another filesystem). Returns dest like shutil.copy2.
+        """
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(source))
+        obj = self.store(source)
+
+        dirname = os.path.dirname(os.path.abspath(dest))
+        tmp = os.path.join(dirname, f'.{os.path.basename(dest)}-{os.getpid()}-'
+                                    f'{threading.get_ident()}')
+        linked = True
+        try:
+            os.link(obj, tmp)
+        except OSError as e:
+            if e.errno not in LINK_UNSUPPORTED:
+                raise
+            with self._lock:
+                report = not self.fallback
+                self.fallback = True
+            if report:
+                logging.warning(f'unable to hardlink into {self.root} ({e}), '
+                                'copying files instead')
+            linked = False
+
+        try:
+            # dest may itself be a link to a shared object, so the copy goes
+            # to tmp as well and replaces dest instead of writing into it
+            if not linked:
+                fastcopy.copy2(source, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        if linked:
+            instrument.count('objects linked')
+        return dest
+
+    def prune(self):
+        """Remove objects no mirror path links to anymore."""
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for entry in os.scandir(self.root):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            for obj in os.scandir(entry.path):
+                if obj.is_file(follow_symlinks=False) \
+                        and obj.stat(follow_symlinks=False).st_nlink == 1:
+                    os.remove(obj.path)
+                    removed += 1
+        if removed:
+            logging.info(f'removed {removed} unused object(s) from {self.root}')
+        return removed
+
+
+def object_store(repo):
+    """The repo's ObjectStore if it is enabled in .dotsync/config.json."""
+    if not read_config(repo).get(CONFIG_KEY, False):
+        return None
+    return ObjectStore(repo)
@@ -2,6 +2,10 @@ import os
 
 
 class Plugin:
+    # set by plugins whose run_batch does better than calling an op once per
+    # file. FileOps then hands all queued ops of such a plugin to run_batch
+    batchable = False
+
     def __init__(self, data_dir, repo_dir=None):
         self.data_dir = data_dir
         self.repo_dir = '/' if repo_dir is None else repo_dir
@@ -31,6 +35,29 @@ class Plugin:
     def remove(self, source, dest):
         pass
 
+    # takes a callable (one of the plugin's ops) and a list of (source, dest)
+    # pairs and runs the op on all of them. returns a list of
+    # (source, dest, exception) for the pairs that failed, the others must
+    # have been completed. if stop (a threading.Event) is given, a failure
+    # sets it and pairs not started once it is set are skipped
+    def run_batch(self, op, pairs, stop=None):
+        errors = []
+        for source, dest in pairs:
+            if stop is not None and stop.is_set():
+                break
+            try:
+                op(source, dest)
+            except Exception as e:
+                errors.append((source, dest, e))
+                if stop is not None:
+                    stop.set()
+        return errors
+
+    # writes out any state the plugin's ops buffered in memory. called by
+    # FileOps once it is done applying ops, also when one of them failed
+    def flush(self):
+        pass
+
     # takes a path to a repo_file and an ext_file and compares them, should
     # return true if they are the same file
     def samefile(self, repo_file, ext_file):
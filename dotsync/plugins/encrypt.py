@@ -1,66 +1,171 @@
-import subprocess
 import shlex
 import logging
 import json
 import getpass
 import hashlib
 import os
+import shutil
 import tempfile
-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotsync import fastcopy, instrument, proc
+from dotsync.hashing import BUFSIZE, hash_file, new_hash
+from dotsync.index import RACY_WINDOW_NS
+from dotsync.manifest import ensure_ignored_dir
 from dotsync.plugin import Plugin
 
+MAX_GPG_WORKERS = 8
+
+# directory under the repo cache holding the ciphertexts apply can reuse
+CIPHERTEXT_CACHE = 'encrypt'
+# cached ciphertexts no file has had for this many seconds are dropped
+CIPHERTEXT_MAX_AGE = 30 * 24 * 3600
+
+
+# number of gpg processes run concurrently when encrypting/decrypting a batch
+def gpg_workers():
+    env = os.environ.get('DOTSYNC_GPG_WORKERS')
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            logging.warning(f'invalid DOTSYNC_GPG_WORKERS={env!r}, using default')
+    return min(MAX_GPG_WORKERS, os.cpu_count() or 1)
+
 
 class GPG:
     def __init__(self, password):
         self.password = password
 
+    # these are needed to read the password from fd (stdin by default) and to
+    # not ask questions
+    @staticmethod
+    def options(fd=0):
+        return ['--passphrase-fd', str(fd), '--pinentry-mode', 'loopback',
+                '--batch', '--yes']
+
+    @staticmethod
+    def log_failure(e):
+        logging.error((e.stderr or b'').decode(errors='replace'))
+        logging.error(f'gpg command {e.cmd} failed with exit code '
+                      f'{e.returncode}\n')
+
     def run(self, cmd):
         if type(cmd) is not list:
             cmd = shlex.split(cmd)
 
-        # these are needed to read the password from stdin and to not ask
-        # questions
-        pre = ['--passphrase-fd', '0', '--pinentry-mode', 'loopback',
-               '--batch', '--yes']
-        # insert pre into the gpg command string
-        cmd = cmd[:1] + pre + cmd[1:]
+        # insert the options into the gpg command string
+        cmd = cmd[:1] + self.options() + cmd[1:]
 
         logging.debug(f'running gpg command {cmd}')
+        instrument.count('subprocesses')
 
         try:
-            proc = subprocess.run(cmd, input=self.password.encode(),
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(e.stderr.decode())
-            logging.error(f'gpg command {cmd} failed with exit code '
-                          f'{e.returncode}\n')
+            with instrument.span('GPG.run'):
+                result = proc.run(cmd, input=self.password.encode())
+        except proc.ProcessError as e:
+            self.log_failure(e)
             raise
 
         logging.debug(f'gpg command {cmd} succeeded')
-        return proc.stdout.decode()
+        return result.stdout.decode()
+
+    # gpg options choosing ASCII armored or binary OpenPGP output
+    @staticmethod
+    def format_options(armor):
+        return ['--armor'] if armor else []
 
-    def encrypt(self, input_file, output_file):
-        self.run(f'gpg --armor --output {shlex.quote(output_file)} '
-                 f'--symmetric {shlex.quote(input_file)}')
+    def encrypt(self, input_file, output_file, armor=True):
+        self.run(['gpg'] + self.format_options(armor)
+                 + ['--output', output_file, '--symmetric', input_file])
 
     def decrypt(self, input_file, output_file):
         self.run(f'gpg --output {shlex.quote(output_file)} '
                  f'--decrypt {shlex.quote(input_file)}')
 
+    # returns the read end of a pipe holding password, for --passphrase-fd
+    @staticmethod
+    def password_fd(password):
+        pw_read, pw_write = os.pipe()
+        try:
+            # a password is far below the pipe buffer size, this cannot block
+            os.write(pw_write, password.encode())
+        finally:
+            os.close(pw_write)
+        return pw_read
+
+    def encrypt_hashed(self, input_file, output_file, armor=True,
+                       digest=None):
+        """Encrypt input_file like encrypt and return the sha256 of its contents.
+
+        The file is read once and every chunk is both hashed and piped to gpg,
+        so the hash is the one of exactly the bytes that were encrypted even
+        if the file changes meanwhile. A digest the caller already computed
+        is returned as is and the chunks are not hashed again.
+        """
+        pw_read = self.password_fd(self.password)
+        cmd = (['gpg'] + self.options(pw_read) + self.format_options(armor)
+               + ['--output', output_file, '--symmetric'])
+        logging.debug(f'running gpg command {cmd}')
+        instrument.count('subprocesses')
 
-# calculates the sha256 hash of the file at fpath
-def hash_file(path):
-    h = hashlib.sha256()
+        h = new_hash() if digest is None else None
 
-    with open(path, 'rb') as f:
-        while True:
-            chunk = f.read(h.block_size)
-            if not chunk:
-                break
-            h.update(chunk)
+        def chunks():
+            with open(input_file, 'rb') as f:
+                while True:
+                    chunk = f.read(BUFSIZE)
+                    if not chunk:
+                        break
+                    if h is not None:
+                        instrument.count('bytes hashed', len(chunk))
+                        h.update(chunk)
+                    yield chunk
 
-    return h.hexdigest()
+        try:
+            with instrument.span('GPG.run'):
+                proc.run(cmd, input=chunks(), pass_fds=(pw_read,))
+        except proc.ProcessError as e:
+            self.log_failure(e)
+            raise
+        finally:
+            os.close(pw_read)
+
+        logging.debug(f'gpg command {cmd} succeeded')
+        return digest if h is None else h.hexdigest()
+
+    def rekey(self, input_file, output_file, password, armor=True):
+        """Re-encrypt input_file with password into output_file.
+
+        gpg --decrypt is piped straight into gpg --symmetric, the plaintext
+        never touches the disk. Each gpg reads its password from its own fd.
+        input_file may be armored or binary, output_file is written in the
+        format armor asks for.
+        """
+        pw_read = self.password_fd(password)
+
+        decrypt_cmd = (['gpg'] + self.options()
+                       + ['--decrypt', input_file])
+        encrypt_cmd = (['gpg'] + self.options(pw_read)
+                       + self.format_options(armor)
+                       + ['--output', output_file, '--symmetric'])
+        logging.debug(f'running gpg commands {decrypt_cmd} | {encrypt_cmd}')
+        instrument.count('subprocesses', 2)
+
+        try:
+            with instrument.span('GPG.run'):
+                proc.pipeline([decrypt_cmd, encrypt_cmd],
+                              input=self.password.encode(),
+                              pass_fds=(pw_read,))
+        except proc.ProcessError as e:
+            self.log_failure(e)
+            raise
+        finally:
+            os.close(pw_read)
+
+        logging.debug(f'gpg commands {decrypt_cmd} | {encrypt_cmd} succeeded')
 
 
 # hash password using suitable key-stretching algorithm
@@ -76,20 +181,58 @@ def key_stretch(password, salt):
     return key.hex()
 
 
+# hashes values used to be the bare sha256 of the plaintext, this turns them
+# into an entry without a stat snapshot
+def hash_entry(value):
+    if isinstance(value, str):
+        return {'hash': value}
+    return value
+
+
+# the size and mtime_ns of a plaintext file as stored with its hash, or None if
+# it was modified too recently for its mtime to tell later changes apart
+def stat_snapshot(st):
+    if st.st_mtime_ns >= time.time_ns() - RACY_WINDOW_NS:
+        return None
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
 class EncryptPlugin(Plugin):
+    batchable = True
+
     def __init__(self, data_dir, *args, **kwargs):
         self.hard = kwargs.pop('hard', False)
+        # the repo's machine-local cache dir. ciphertexts are kept there by the
+        # hash of their plaintext, so encrypting content that was encrypted
+        # before gives the same ciphertext (and git blob) again
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        # whether files are encrypted to ASCII armored or binary OpenPGP. the
+        # format of each file is recorded in hashes, 'armor': False for binary
+        # ones, so either is decrypted and re-encrypted as such
+        self.armor = kwargs.pop('armor', True)
+        self._ciphertext_dir = None
+        # compare hashes even if the stat snapshot says a file is unchanged
+        self.rehash = False
         self.gpg = None
+        self.dirty = False
+        self.lock = threading.Lock()
         self.hashes_path = os.path.join(data_dir, 'hashes')
         self.modes_path = os.path.join(data_dir, 'modes')
         self.pword_path = os.path.join(data_dir, 'passwd')
+        self.journal_path = os.path.join(data_dir, 'journal')
         super().__init__(*args, data_dir=data_dir, **kwargs)
 
-    # reads the stored hashes
+    # reads the stored hashes and replays the journal of a run that did not
+    # get to save them
     def setup_data(self):
         if os.path.exists(self.hashes_path):
             with open(self.hashes_path, 'r') as f:
-                self.hashes = json.load(f)
+                hashes = json.load(f)
+            self.hashes = {path: hash_entry(value)
+                           for path, value in hashes.items()}
+            if any(isinstance(value, str) for value in hashes.values()):
+                logging.debug('converting encrypt hashes to the current format')
+                self.dirty = True
         else:
             self.hashes = {}
 
@@ -99,6 +242,30 @@ class EncryptPlugin(Plugin):
         else:
             self.modes = {}
 
+        if os.path.exists(self.journal_path):
+            self.replay_journal()
+
+    # applies the entries of a leftover journal. every entry was written after
+    # its file was encrypted, so they are all safe to keep. a torn last line
+    # (crash while writing it) is dropped, that file just gets re-encrypted
+    def replay_journal(self):
+        replayed = 0
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning('ignoring incomplete encrypt journal entry')
+                    continue
+                self.hashes[entry['path']] = hash_entry(entry['hash'])
+                self.modes[entry['path']] = entry['mode']
+                replayed += 1
+
+        logging.info(f'recovered {replayed} encrypted file record(s) from an '
+                     f'interrupted run')
+        self.dirty = True
+        self.save_data()
+
     # removes file entries in modes and hashes that are no longer in the
     # manifest
     def clean_data(self, manifest):
@@ -107,13 +274,102 @@ class EncryptPlugin(Plugin):
             for key in diff:
                 data.pop(key)
         self.save_data()
+        self.prune_ciphertexts()
+
+    # the directory holding the cached ciphertexts for the current password,
+    # None if there is no cache. named after the password's salt, which
+    # changes with every password change on any machine
+    def ciphertext_dir(self):
+        if self.cache_dir is None or not os.path.exists(self.pword_path):
+            return None
+        if self._ciphertext_dir is None:
+            with open(self.pword_path, 'r') as f:
+                salt = json.load(f)['salt']
+            self._ciphertext_dir = os.path.join(self.cache_dir,
+                                                CIPHERTEXT_CACHE, salt[:16])
+        return self._ciphertext_dir
+
+    def ciphertext_path(self, digest, armor=True):
+        dirname = self.ciphertext_dir()
+        if dirname is None:
+            return None
+        ext = 'asc' if armor else 'gpg'
+        return os.path.join(dirname, digest[:2], f'{digest}.{ext}')
+
+    # returns the cached ciphertext of the plaintext with hash digest, if any
+    def cached_ciphertext(self, digest, armor=True):
+        path = self.ciphertext_path(digest, armor)
+        if path is not None and os.path.isfile(path):
+            return path
+        return None
+
+    # keeps a copy of ciphertext, the encryption of a plaintext with hash
+    # digest. failing to do so only costs a new ciphertext later
+    def cache_ciphertext(self, digest, ciphertext, armor=True):
+        path = self.ciphertext_path(digest, armor)
+        if path is None or os.path.exists(path):
+            return
+        tmp = f'{path}-{os.getpid()}-{threading.get_ident()}'
+        try:
+            ensure_ignored_dir(self.cache_dir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fastcopy.copyfile(ciphertext, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.debug(f'unable to cache ciphertext {path}: {e}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # drops the cached ciphertexts of old passwords, and the ones of contents
+    # no file has had for CIPHERTEXT_MAX_AGE. the ones in use are touched so
+    # their age counts from the last time they were
+    def prune_ciphertexts(self):
+        if self.cache_dir is None:
+            return
+        root = os.path.join(self.cache_dir, CIPHERTEXT_CACHE)
+        if not os.path.isdir(root):
+            return
 
-    # saves the current hashes and modes to the data dir
+        current = self.ciphertext_dir()
+        in_use = {entry['hash'] for entry in self.hashes.values()}
+        cutoff = time.time() - CIPHERTEXT_MAX_AGE
+        for entry in os.scandir(root):
+            if entry.path != current:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            for subdir in os.scandir(entry.path):
+                for blob in os.scandir(subdir.path):
+                    digest = blob.name.split('.')[0]
+                    if digest in in_use:
+                        os.utime(blob.path)
+                    elif blob.stat().st_mtime < cutoff:
+                        os.remove(blob.path)
+
+    # atomically writes the current hashes and modes to the data dir and
+    # drops the journal they now include
     def save_data(self):
-        with open(self.hashes_path, 'w') as f:
-            json.dump(self.hashes, f)
-        with open(self.modes_path, 'w') as f:
-            json.dump(self.modes, f)
+        for path, data in [(self.hashes_path, self.hashes),
+                           (self.modes_path, self.modes)]:
+            fd, tmp = tempfile.mkstemp(dir=self.data_dir,
+                                       prefix=f'.{os.path.basename(path)}-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.dirty = False
+
+    # saves the hashes and modes recorded since the last save
+    def flush(self):
+        if self.dirty:
+            self.save_data()
 
     # sets the password in the plugin's data dir. do not use directly, use
     # change_password instead
@@ -127,6 +383,7 @@ class EncryptPlugin(Plugin):
         with open(self.pword_path, 'w') as f:
             d = {'pword': key, 'salt': salt.hex(), 'secret': password}
             json.dump(d, f)
+        self._ciphertext_dir = None
 
     def read_stored_password(self):
         """Return the stored encryption password for local display."""
@@ -164,33 +421,108 @@ class EncryptPlugin(Plugin):
 
         if repo is not None:
             self.init_password()
-
-            for root, dirs, files in os.walk(repo):
-                for fname in files:
-                    fname = os.path.join(root, fname)
-                    logging.info(f'changing passphrase for '
-                                 f'{os.path.relpath(fname, repo)}')
-
-                    # make a secure temporary file
-                    fs, sfname = tempfile.mkstemp()
-                    # close the file-handle since we won't be using it (just
-                    # there for gpg to write to)
-                    os.close(fs)
-
-                    try:
-                        # decrypt with old passphrase and re-encrypt with new
-                        # passphrase
-                        self.gpg.decrypt(fname, sfname)
-                        new_gpg.encrypt(sfname, fname)
-                    except:  # noqa: E722
-                        raise
-                    finally:
-                        os.remove(sfname)
+            self.rekey(new_pword)
 
         self.gpg = new_gpg
         self.save_password(new_pword)
         return new_pword
 
+    # whether the repo file at path (relative to the repo dir) is armored
+    def armored(self, path):
+        return self.hashes.get(path, {}).get('armor', True)
+
+    # re-encrypts the files that are not in the format armor asks for, keeping
+    # the password. returns the number of files converted
+    def convert(self, armor):
+        self.init_password()
+        paths = [path for path in sorted(self.hashes)
+                 if self.armored(path) != armor]
+        if paths:
+            self.rekey(self.gpg.password, paths, armor)
+        return len(paths)
+
+    # re-encrypts the files in paths (default: every file in hashes) with
+    # password, in their current format unless armor is given. uses a pool of
+    # gpg pipelines. all new ciphertexts are written next to their files first
+    # and only moved into place once every one of them succeeded. if anything
+    # fails the repo is left as it was
+    def rekey(self, password, paths=None, armor=None):
+        if paths is None:
+            paths = sorted(self.hashes)
+        targets = {}
+        for path in paths:
+            abs_path = os.path.join(self.repo_dir, path)
+            if os.path.isfile(abs_path):
+                targets[abs_path] = self.armored(path) if armor is None \
+                    else armor
+            else:
+                logging.warning(f'{path} is missing from the repo, not '
+                                f're-encrypting it')
+        paths = list(targets)
+        if not paths:
+            return
+
+        tmps = {}
+        failed = threading.Event()
+
+        def run(path):
+            if failed.is_set():
+                return
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=f'.{os.path.basename(path)}-')
+            os.close(fd)
+            with self.lock:
+                tmps[path] = tmp
+            logging.info(f're-encrypting {self.strip_repo(path)}')
+            try:
+                self.gpg.rekey(path, tmp, password, targets[path])
+            except BaseException:
+                failed.set()
+                raise
+
+        workers = min(gpg_workers(), len(paths))
+        logging.debug(f're-encrypting {len(paths)} file(s) with {workers} '
+                      f'gpg worker(s)')
+
+        backups = {}
+        try:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(run, path) for path in paths]
+                for future in futures:
+                    future.result()
+            else:
+                for path in paths:
+                    run(path)
+
+            try:
+                for path in paths:
+                    backup = f'{tmps[path]}-old'
+                    os.replace(path, backup)
+                    backups[path] = backup
+                    os.replace(tmps.pop(path), path)
+            except BaseException:
+                logging.error('unable to move the re-encrypted files into '
+                              'place, restoring the old ones')
+                for path, backup in backups.items():
+                    os.replace(backup, path)
+                backups.clear()
+                raise
+        finally:
+            for tmp in list(tmps.values()) + list(backups.values()):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        if armor is not None:
+            for path in paths:
+                entry = self.hashes[self.strip_repo(path)]
+                if armor:
+                    entry.pop('armor', None)
+                else:
+                    entry['armor'] = False
+            self.dirty = True
+            self.save_data()
+
     # gets the password from the user if needed
     def init_password(self):
         if self.gpg is not None:
@@ -209,17 +541,53 @@ class EncryptPlugin(Plugin):
 
         self.gpg = GPG(password)
 
-    # encrypts a file from outside the repo and stores it inside the repo
+    # encrypts a file from outside the repo and stores it inside the repo.
+    # the hash and mode are kept in memory (and the journal) until flush
     def apply(self, source, dest):
         self.init_password()
-        self.gpg.encrypt(source, dest)
 
-        # calculate and store file hash
-        self.hashes[self.strip_repo(dest)] = hash_file(source)
-        # store file mode data (metadata)
-        self.modes[self.strip_repo(dest)] = os.stat(source).st_mode & 0o777
+        # stat first, a change while hashing or encrypting then shows up as a
+        # different mtime next time
+        st = os.stat(source)
+        digest = None
+        if self.ciphertext_dir() is not None:
+            digest = hash_file(source)
+
+        # encrypt next to dest and move into place, so dest never holds a
+        # partial ciphertext
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                   prefix=f'.{os.path.basename(dest)}-')
+        os.close(fd)
+        try:
+            cached = self.cached_ciphertext(digest, self.armor) if digest \
+                else None
+            if cached is not None:
+                logging.debug(f'reusing the ciphertext of {source}')
+                instrument.count('ciphertexts reused')
+                fastcopy.copyfile(cached, tmp)
+            else:
+                digest = self.gpg.encrypt_hashed(source, tmp, self.armor,
+                                                 digest=digest)
+                self.cache_ciphertext(digest, tmp, self.armor)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
 
-        self.save_data()
+        # store file hash, size, mtime and mode (metadata)
+        entry = {
+            'path': self.strip_repo(dest),
+            'hash': {'hash': digest, **(stat_snapshot(st) or {}),
+                     **({} if self.armor else {'armor': False})},
+            'mode': st.st_mode & 0o777,
+        }
+        with self.lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.hashes[entry['path']] = entry['hash']
+            self.modes[entry['path']] = entry['mode']
+            self.dirty = True
 
     # decrypts source and saves it in dest
     def remove(self, source, dest):
@@ -227,13 +595,61 @@ class EncryptPlugin(Plugin):
         self.gpg.decrypt(source, dest)
         os.chmod(dest, self.modes.get(self.strip_repo(source), 0o644))
 
+    # runs op on all pairs with a pool of concurrent gpg processes. the
+    # password is asked for once up front
+    def run_batch(self, op, pairs, stop=None):
+        self.init_password()
+
+        workers = min(gpg_workers(), len(pairs))
+        logging.debug(f'running {len(pairs)} {self.strify(op)} op(s) with '
+                      f'{workers} gpg worker(s)')
+
+        def run(pair):
+            if stop is not None and stop.is_set():
+                return None
+            try:
+                op(*pair)
+            except Exception as e:
+                if stop is not None:
+                    stop.set()
+                return e
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(run, pairs))
+        else:
+            results = [run(pair) for pair in pairs]
+
+        return [(source, dest, e) for (source, dest), e in zip(pairs, results)
+                if e is not None]
+
     # compares the ext_file to repo_file and returns true if they are the same.
-    # does this by looking at the repo_file's hash and calculating the hash of
-    # the ext_file
+    # ext_file is unchanged if its size and mtime match the ones stored when it
+    # was encrypted, otherwise its hash is calculated and compared to the
+    # stored one
     def samefile(self, repo_file, ext_file):
-        ext_hash = hash_file(ext_file)
-        repo_file = self.strip_repo(repo_file)
-        return self.hashes.get(repo_file, None) == ext_hash
+        entry = self.hashes.get(self.strip_repo(repo_file))
+        if entry is None:
+            return False
+
+        st = os.stat(ext_file)
+        if not self.rehash and 'size' in entry \
+                and entry['size'] == st.st_size \
+                and entry['mtime_ns'] == st.st_mtime_ns:
+            instrument.count('hashes avoided')
+            return True
+
+        same = hash_file(ext_file) == entry['hash']
+        # entries converted from the old format get the snapshot they lack.
+        # others keep the one from encryption time, hashes is shared between
+        # machines and refreshing it on every one would never settle
+        if same and 'size' not in entry:
+            snapshot = stat_snapshot(st)
+            if snapshot is not None:
+                with self.lock:
+                    entry.update(snapshot)
+                    self.dirty = True
+        return same
 
     def strify(self, op):
         if op == self.apply:
@@ -1,13 +1,14 @@
 import os
-import shutil
-import filecmp
 
+from dotsync import fastcopy, hashing
 from dotsync.plugin import Plugin
 
 
 class PlainPlugin(Plugin):
     def __init__(self, *args, **kwargs):
         self.hard = kwargs.pop('hard', False)
+        # an objects.ObjectStore to hardlink repo files into, if enabled
+        self.store = kwargs.pop('store', None)
         super().__init__(*args, **kwargs)
 
     def setup_data(self):
@@ -15,17 +16,20 @@ class PlainPlugin(Plugin):
 
     # copies file from outside the repo to the repo
     def apply(self, source, dest):
-        shutil.copy2(source, dest)
+        if self.store is not None:
+            self.store.link(source, dest)
+        else:
+            fastcopy.copy2(source, dest)
 
     def remove(self, source, dest):
-        shutil.copy2(source, dest)
+        fastcopy.copy2(source, dest)
 
     def samefile(self, repo_file, ext_file):
         if os.path.islink(ext_file):
             return os.path.realpath(ext_file) == os.path.abspath(repo_file)
         if not os.path.exists(repo_file):
             return False
-        return filecmp.cmp(repo_file, ext_file, shallow=False)
+        return hashing.samecontent(repo_file, ext_file)
 
     def strify(self, op):
         if op == self.apply:
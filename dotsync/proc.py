@@ -0,0 +1,261 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import subprocess
+import threading
+
+MAX_PROC_WORKERS = 16
+
+
+# number of child processes (or pipelines) run at the same time
+def proc_workers():
+    env = os.environ.get('DOTSYNC_PROC_WORKERS')
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            logging.warning(f'invalid DOTSYNC_PROC_WORKERS={env!r}, using '
+                            f'default')
+    return min(MAX_PROC_WORKERS, 2 * (os.cpu_count() or 1))
+
+
+class ProcessError(subprocess.CalledProcessError):
+    """A process exited with a non-zero code.
+
+    Carries the command, exit code and captured stdout and stderr (bytes),
+    like the CalledProcessError it is, so existing handlers keep working.
+    """
+
+    def __str__(self):
+        msg = super().__str__()
+        err = (self.stderr or b'').decode(errors='replace').strip()
+        return f'{msg.rstrip(".")}: {err}' if err else msg
+
+
+async def _feed(stream, input):
+    try:
+        if isinstance(input, (bytes, bytearray, memoryview)):
+            stream.write(input)
+            await stream.drain()
+        else:
+            # iterables may read and hash files, which must not hold up the
+            # loop and every other process on it
+            loop = asyncio.get_running_loop()
+            chunks = iter(input)
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                stream.write(chunk)
+                await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the process exited early, its exit code tells why
+        pass
+    finally:
+        stream.close()
+
+
+# the output of a captured stream, None if it was not captured
+async def _read(stream):
+    return None if stream is None else await stream.read()
+
+
+class Runner:
+    """Runs child processes on an asyncio loop in a background thread.
+
+    Any thread can call run/pipeline (blocking) or start (returns a
+    concurrent.futures.Future), so independent git and gpg calls overlap
+    with each other and with work in the calling threads. At most limit
+    processes (a pipeline counts as one) run at the same time.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is not None:
+                return self._loop
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='dotsync-proc',
+                             daemon=True).start()
+
+            async def make_semaphore():
+                return asyncio.Semaphore(self.limit)
+
+            self._semaphore = asyncio.run_coroutine_threadsafe(
+                make_semaphore(), loop).result()
+            self._loop = loop
+            return loop
+
+    def submit(self, coro):
+        """Run coro on the loop, return a concurrent.futures.Future of it."""
+        loop = self._ensure_loop()
+        future = concurrent.futures.Future()
+
+        def copy_result(task):
+            if task.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                coro.close()
+                return
+            # only used on the loop thread, by wait
+            future.task = loop.create_task(coro)
+            future.task.add_done_callback(copy_result)
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def wait(self, future):
+        """Return the result of a future from submit or start.
+
+        If the wait is interrupted (e.g. KeyboardInterrupt) the coroutine is
+        cancelled and its processes killed before the exception propagates,
+        so no child outlives the command that started it.
+        """
+        try:
+            return future.result()
+        except BaseException:
+            if not future.done() and not future.cancel():
+                def cancel():
+                    task = getattr(future, 'task', None)
+                    if task is not None:
+                        task.cancel()
+
+                # runs after start() since both go through call_soon
+                self._loop.call_soon_threadsafe(cancel)
+                concurrent.futures.wait([future])
+            raise
+
+    def start(self, cmd, **kwargs):
+        """Start cmd and return a Future of its CompletedProcess."""
+        return self.submit(self.pipeline_async([cmd], **kwargs))
+
+    def run(self, cmd, **kwargs):
+        """Run cmd and return its CompletedProcess, see pipeline_async."""
+        return self.wait(self.start(cmd, **kwargs))
+
+    def pipeline(self, cmds, **kwargs):
+        return self.wait(self.submit(self.pipeline_async(cmds, **kwargs)))
+
+    async def pipeline_async(self, cmds, input=None, cwd=None, timeout=None,
+                             pass_fds=(), check=True, stderr=subprocess.PIPE):
+        """Run cmds with each one's stdout piped into the next one's stdin.
+
+        input (bytes or an iterable of bytes) is written to the first
+        command's stdin, which is inherited if input is None. Returns the
+        CompletedProcess of the last command, with its stdout and stderr.
+        stderr is captured unless it is None, then the commands write to
+        ours and the stderr of the result and errors is None. If check is
+        set, the first command that failed raises a ProcessError with its
+        own stderr. After timeout seconds every command is killed and
+        subprocess.TimeoutExpired raised.
+        """
+        async with self._semaphore:
+            procs = await self._spawn(cmds, input, cwd, pass_fds, stderr)
+            tasks = [asyncio.ensure_future(_read(proc.stderr))
+                     for proc in procs]
+            tasks.append(asyncio.ensure_future(procs[-1].stdout.read()))
+            if input is not None:
+                tasks.append(asyncio.ensure_future(_feed(procs[0].stdin,
+                                                         input)))
+            tasks.extend(asyncio.ensure_future(proc.wait()) for proc in procs)
+
+            try:
+                results = await asyncio.wait_for(asyncio.gather(*tasks),
+                                                 timeout)
+            except asyncio.TimeoutError:
+                for proc in procs:
+                    if proc.returncode is None:
+                        proc.kill()
+                for proc in procs:
+                    await proc.wait()
+                raise subprocess.TimeoutExpired(cmds[-1], timeout) from None
+            except BaseException:
+                for proc in procs:
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                raise
+
+        stderrs = results[:len(procs)]
+        stdout = results[len(procs)]
+        if check:
+            for cmd, proc, stderr in zip(cmds, procs, stderrs):
+                if proc.returncode != 0:
+                    raise ProcessError(proc.returncode, cmd,
+                                       output=stdout if proc is procs[-1]
+                                       else None, stderr=stderr)
+        return subprocess.CompletedProcess(cmds[-1], procs[-1].returncode,
+                                           stdout, stderrs[-1])
+
+    @staticmethod
+    async def _spawn(cmds, input, cwd, pass_fds, stderr):
+        procs = []
+        stdin = subprocess.PIPE if input is not None else None
+        try:
+            for i, cmd in enumerate(cmds):
+                last = i == len(cmds) - 1
+                read_fd = write_fd = None
+                if not last:
+                    read_fd, write_fd = os.pipe()
+                try:
+                    procs.append(await asyncio.create_subprocess_exec(
+                        *cmd, cwd=cwd, stdin=stdin,
+                        stdout=subprocess.PIPE if last else write_fd,
+                        stderr=stderr, pass_fds=pass_fds))
+                finally:
+                    # the children hold their own copies of the pipe ends
+                    if write_fd is not None:
+                        os.close(write_fd)
+                    if isinstance(stdin, int) and stdin >= 0:
+                        os.close(stdin)
+                    stdin = read_fd
+        except BaseException:
+            if isinstance(stdin, int) and stdin >= 0:
+                os.close(stdin)
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+            raise
+        return procs
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def runner():
+    """The process runner shared by everything in this run."""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = Runner(proc_workers())
+        return _runner
+
+
+def run(cmd, **kwargs):
+    return runner().run(cmd, **kwargs)
+
+
+def start(cmd, **kwargs):
+    return runner().start(cmd, **kwargs)
+
+
+def pipeline(cmds, **kwargs):
+    return runner().pipeline(cmds, **kwargs)
+
+
+def wait(future):
+    return runner().wait(future)
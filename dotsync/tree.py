@@ -1,12 +1,17 @@
 import fnmatch
+import functools
 import hashlib
 import logging
 import os
+import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
+from dotsync import fastcopy, instrument
 from dotsync.manifest import MATERIALIZED_DIR, read_manifest, write_manifest
+from dotsync.objects import object_store
 
 DIR_SKIP = {'extensions', 'worktrees', 'Cache', 'CachedData', '.git', 'node_modules', 'logs'}
 
@@ -14,6 +19,9 @@ SYSTEM_FILES = {'.DS_Store', 'Thumbs.db', '.DS_Store?'}
 
 SYMLINK_MAX_DEPTH = 40
 
+# default upper bound for walker threads, DOTSYNC_WALK_WORKERS overrides it
+MAX_WALK_WORKERS = 8
+
 
 @dataclass
 class TreeEntry:
@@ -41,15 +49,157 @@ def normalize_home_rel(home: str, abs_path: str) -> str:
     return rel
 
 
+def _is_under(rel: str, root: str) -> bool:
+    return rel == root or rel.startswith(root + '/')
+
+
+def _segment_width(segment: str) -> Optional[int]:
+    """Number of characters a '*'-free glob segment matches, None if unknown."""
+    width = 0
+    i = 0
+    while i < len(segment):
+        if segment[i] == '[':
+            # same bracket rules as fnmatch.translate: optional '!', a ']'
+            # right after the opening bracket is literal
+            j = i + 1
+            if j < len(segment) and segment[j] == '!':
+                j += 1
+            if j < len(segment) and segment[j] == ']':
+                j += 1
+            j = segment.find(']', j)
+            if j < 0:
+                # unterminated bracket, may pair with a ']' past a '/'
+                return None
+            i = j
+        width += 1
+        i += 1
+    return width
+
+
+class TreePattern:
+    """A single @tree pattern compiled once for repeated matching."""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.walk_root = pattern_walk_root(pattern)
+        # walk_root without the trailing slash glob patterns give it, the
+        # directory every file of the tree is under
+        self.root = self.walk_root.rstrip('/')
+        self.has_glob = pattern_has_glob(pattern)
+        self._regex = None
+        self._owner_regex = None
+        self._segments = None
+        if self.has_glob:
+            self._regex = re.compile(fnmatch.translate(pattern))
+            self._owner_regex = re.compile(fnmatch.translate(pattern + '/*'))
+            self._segments = self._compile_segments()
+
+    def _compile_segments(self):
+        # per path segment below walk_root: ('literal', text), ('glob', width,
+        # regex) or None for segments containing '*', which may span any
+        # number of directories
+        segments = []
+        for segment in self.pattern[len(self.walk_root):].split('/'):
+            if '*' in segment:
+                segments.append(None)
+            elif pattern_has_glob(segment):
+                width = _segment_width(segment)
+                if width is None:
+                    return None
+                segments.append(('glob', width, re.compile(fnmatch.translate(segment))))
+            else:
+                segments.append(('literal', segment))
+        return segments
+
+    # does the file at rel belong to the tree (walk_tree semantics)
+    def matches(self, rel: str) -> bool:
+        if self.has_glob:
+            return self._regex.match(rel) is not None
+        return _is_under(rel, self.pattern)
+
+    # is rel, or one of its parent directories, covered by the pattern
+    def owns(self, rel: str) -> bool:
+        if self.root and not _is_under(rel, self.root):
+            return False
+        if self.has_glob:
+            return (self._regex.match(rel) is not None
+                    or self._owner_regex.match(rel + '/') is not None)
+        return _is_under(rel, self.pattern)
+
+    def is_internal(self, rel: str) -> bool:
+        if not self.root:
+            return self._regex.match(rel) is not None
+        if not _is_under(rel, self.root):
+            return False
+        if self.has_glob:
+            return self._regex.match(rel) is not None
+        return True
+
+    # can any file below the directory rel_dir match. only answers False
+    # when that is certain, so the walker can skip the whole directory
+    def may_contain(self, rel_dir: str) -> bool:
+        if self._segments is None or not rel_dir.startswith(self.walk_root):
+            return True
+
+        parts = rel_dir[len(self.walk_root):].split('/')
+        for part, segment in zip(parts, self._segments):
+            if segment is None:
+                return True
+            if segment[0] == 'literal':
+                if part != segment[1]:
+                    return False
+                continue
+            _, width, regex = segment
+            if len(part) < width:
+                # '?' and brackets also match '/', the segment could span
+                # into a subdirectory
+                return True
+            if len(part) > width or regex.match(part) is None:
+                return False
+
+        # every segment matched a directory exactly, nothing deeper can match
+        return len(parts) < len(self._segments)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern: str) -> TreePattern:
+    return TreePattern(pattern)
+
+
+class TreeMatcher:
+    """Answers which @tree entry owns a path, compiling every pattern once.
+
+    Patterns are bucketed by walk root so a lookup only tests the trees
+    rooted at one of the path's ancestors.
+    """
+
+    def __init__(self, trees: List[dict]):
+        self.trees = trees
+        self._buckets: Dict[str, List[Tuple[int, TreePattern]]] = {}
+        for i, tree in enumerate(trees):
+            compiled = compile_pattern(tree['pattern'])
+            self._buckets.setdefault(compiled.root, []).append((i, compiled))
+
+    def _candidates(self, rel: str):
+        keys = {'', rel}
+        slash = rel.find('/')
+        while slash >= 0:
+            keys.add(rel[:slash])
+            slash = rel.find('/', slash + 1)
+        for key in keys:
+            yield from self._buckets.get(key, ())
+
+    def owner(self, rel: str) -> Optional[dict]:
+        """Return the first tree (in filelist order) owning rel, if any."""
+        best = None
+        for i, compiled in self._candidates(rel):
+            if (best is None or i < best) and compiled.owns(rel):
+                best = i
+        return None if best is None else self.trees[best]
+
+
 def is_internal_target(home_rel: str, tree_pattern: str) -> bool:
-    walk_root = pattern_walk_root(tree_pattern)
-    if not walk_root:
-        return fnmatch.fnmatch(home_rel, tree_pattern)
-    if not (home_rel == walk_root or home_rel.startswith(walk_root + '/')):
-        return False
-    if pattern_has_glob(tree_pattern):
-        return fnmatch.fnmatch(home_rel, tree_pattern)
-    return True
+    return compile_pattern(tree_pattern).is_internal(home_rel)
 
 
 def resolve_symlink_chain(home: str, rel_path: str) -> Tuple[Optional[str], Optional[str]]:
@@ -89,14 +239,15 @@ def external_materialized_path(home_rel: str, basename: str) -> str:
     return os.path.join(MATERIALIZED_DIR, material_id, basename)
 
 
-def _copy_content_to_repo(abs_source: str, dest: str) -> None:
+def _copy_content_to_repo(abs_source: str, dest: str, store=None) -> None:
+    copy = fastcopy.copy2 if store is None else store.link
     if os.path.isfile(abs_source):
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        shutil.copy2(abs_source, dest)
+        copy(abs_source, dest)
     elif os.path.isdir(abs_source):
         if os.path.exists(dest):
             shutil.rmtree(dest)
-        shutil.copytree(abs_source, dest)
+        shutil.copytree(abs_source, dest, copy_function=copy)
 
 
 def _canonical_repo_path(
@@ -129,6 +280,7 @@ def materialize_symlinks(
         warnings = []
     if dotsync_repo is None:
         dotsync_repo = repo
+    store = object_store(dotsync_repo)
 
     entries = []
     copied: Set[str] = set()
@@ -158,7 +310,7 @@ def materialize_symlinks(
                 dest = os.path.join(dotsync_repo, canonical)
             else:
                 dest = os.path.join(repo, canonical)
-            _copy_content_to_repo(resolved_abs, dest)
+            _copy_content_to_repo(resolved_abs, dest, store=store)
             copied.add(canonical)
 
         entries.append({
@@ -180,22 +332,19 @@ def expand_trees_from_repo(plugin_dir: str, trees: List[dict], categories) -> Di
             continue
 
         master = min(tree['categories'])
-        pattern = tree['pattern']
-        walk_root = pattern_walk_root(pattern)
-        category_root = os.path.join(plugin_dir, master, walk_root)
+        compiled = compile_pattern(tree['pattern'])
+        category_root = os.path.join(plugin_dir, master, compiled.walk_root)
 
         if not os.path.exists(category_root):
             continue
 
-        has_glob = pattern_has_glob(pattern)
-
         if os.path.isfile(category_root) or os.path.islink(category_root):
             rel = os.path.relpath(category_root, os.path.join(plugin_dir, master))
             if not rel.startswith('.'):
                 rel = '.' + rel
-            if has_glob and not fnmatch.fnmatch(rel, pattern):
+            if compiled.has_glob and not compiled.matches(rel):
                 continue
-            if not has_glob and rel != pattern:
+            if not compiled.has_glob and rel != compiled.pattern:
                 continue
             files[rel] = {
                 'categories': tree['categories'],
@@ -204,29 +353,16 @@ def expand_trees_from_repo(plugin_dir: str, trees: List[dict], categories) -> Di
             }
             continue
 
-        for root, dirs, fnames in os.walk(category_root):
-            dirs[:] = [d for d in dirs if d not in DIR_SKIP]
-            for fname in fnames:
-                if fname in SYSTEM_FILES:
-                    continue
-                abs_f = os.path.join(root, fname)
-                rel = os.path.relpath(abs_f, os.path.join(plugin_dir, master))
-                if not rel.startswith('.'):
-                    rel = '.' + rel
-
-                if has_glob:
-                    if not fnmatch.fnmatch(rel, pattern):
-                        continue
-                elif rel != pattern and not rel.startswith(pattern + '/'):
-                    continue
-
-                if rel in files:
-                    continue
-                files[rel] = {
-                    'categories': tree['categories'],
-                    'plugin': tree['plugin'],
-                    'kind': 'file',
-                }
+        walked = scan_tree(os.path.join(plugin_dir, master), category_root,
+                           descend=compiled.may_contain)
+        for rel, _ in walked:
+            if not compiled.matches(rel) or rel in files:
+                continue
+            files[rel] = {
+                'categories': tree['categories'],
+                'plugin': tree['plugin'],
+                'kind': 'file',
+            }
 
     return files
 
@@ -320,41 +456,169 @@ def restore_symlinks(
             logging.info(f'Restored symlink content to {home_path}')
 
 
-def walk_tree(home: str, pattern: str) -> Dict[str, dict]:
+class TreeWalkCache:
+    """Memoized walk_tree results, shared by every caller in one invocation.
+
+    Keyed by (home, pattern); ``walks`` counts the walks that actually hit
+    the filesystem so repeated expansion shows up in debug output.
+    """
+
+    def __init__(self):
+        self.walks = 0
+        self._results: Dict[Tuple[str, str], Dict[str, dict]] = {}
+
+    def walk(self, home: str, pattern: str) -> Dict[str, dict]:
+        key = (str(home), pattern)
+        if key not in self._results:
+            self.walks += 1
+            self._results[key] = walk_tree(home, pattern)
+            logging.debug(f'tree walk #{self.walks}: {pattern} '
+                          f'({len(self._results[key])} paths)')
+        return self._results[key]
+
+    def clear(self) -> None:
+        self._results.clear()
+
+
+def walk_workers() -> int:
+    """Number of threads used to scan directories during a tree walk."""
+    env = os.environ.get('DOTSYNC_WALK_WORKERS')
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            logging.warning(f'invalid DOTSYNC_WALK_WORKERS={env!r}, using default')
+    return min(MAX_WALK_WORKERS, os.cpu_count() or 1)
+
+
+def _scan_dir(path: str) -> Tuple[List[Tuple[str, bool]], List[str]]:
+    """List one directory as ([(file name, is_symlink)], [subdir names]).
+
+    Follows os.walk(followlinks=False): symlinks to directories are neither
+    descended into nor reported as files, unreadable directories are empty.
+    """
+    files = []
+    dirs = []
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return files, dirs
+
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            try:
+                is_link = entry.is_symlink()
+            except OSError:
+                is_link = False
+
+            if is_dir:
+                if not is_link:
+                    dirs.append(entry.name)
+            else:
+                files.append((entry.name, is_link))
+
+    return files, dirs
+
+
+def scan_tree(
+    base: str,
+    abs_root: str,
+    workers: Optional[int] = None,
+    descend: Optional[Callable[[str], bool]] = None,
+) -> List[Tuple[str, bool]]:
+    """Return (rel, is_symlink) for every file below abs_root, in os.walk order.
+
+    rel is relative to base and follows the normalize_home_rel convention.
+    Directories in DIR_SKIP and files in SYSTEM_FILES are left out, as are
+    directories for which ``descend(rel_dir)`` returns False. Each directory
+    level is scanned on a thread pool of ``workers`` threads, the listing is
+    then stitched back together depth-first so the result does not depend
+    on the worker count.
+    """
+    if workers is None:
+        workers = walk_workers()
+    abs_root = os.path.normpath(abs_root)
+
+    root_rel = os.path.relpath(abs_root, base)
+    root_prefix = '' if root_rel == '.' else root_rel + '/'
+
+    listing: Dict[str, Tuple[List[Tuple[str, bool]], List[str]]] = {}
+    frontier = [(abs_root, root_prefix)]
+    pool = None
+    try:
+        while frontier:
+            paths = [path for path, _ in frontier]
+            if workers > 1 and len(paths) > 1:
+                if pool is None:
+                    pool = ThreadPoolExecutor(max_workers=workers)
+                scanned = list(pool.map(_scan_dir, paths))
+            else:
+                scanned = [_scan_dir(path) for path in paths]
+
+            next_frontier = []
+            for (path, rel_prefix), (files, dirs) in zip(frontier, scanned):
+                kept = []
+                for d in dirs:
+                    if d in DIR_SKIP:
+                        continue
+                    if descend is not None:
+                        rel_dir = rel_prefix + d
+                        if not rel_dir.startswith('.'):
+                            rel_dir = '.' + rel_dir
+                        if not descend(rel_dir):
+                            continue
+                    kept.append(d)
+                    next_frontier.append((path + os.sep + d, rel_prefix + d + '/'))
+                listing[path] = (files, kept)
+            frontier = next_frontier
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = []
+    stack = [(abs_root, root_prefix)]
+    while stack:
+        path, rel_prefix = stack.pop()
+        files, dirs = listing[path]
+        for name, is_link in files:
+            if name in SYSTEM_FILES:
+                continue
+            rel = rel_prefix + name
+            if not rel.startswith('.'):
+                rel = '.' + rel
+            results.append((rel, is_link))
+        for d in reversed(dirs):
+            stack.append((path + os.sep + d, rel_prefix + d + '/'))
+
+    instrument.count('directories scanned', len(listing))
+    instrument.count('files walked', len(results))
+    return results
+
+
+def walk_tree(home: str, pattern: str, workers: Optional[int] = None) -> Dict[str, dict]:
     """Walk home for file paths matching a tree pattern."""
-    walk_root = pattern_walk_root(pattern)
-    abs_root = os.path.join(home, walk_root)
+    compiled = compile_pattern(pattern)
+    abs_root = os.path.join(home, compiled.walk_root)
 
     if not os.path.exists(abs_root):
         return {}
 
-    has_glob = pattern_has_glob(pattern)
-
     if os.path.isfile(abs_root) or os.path.islink(abs_root):
         rel = normalize_home_rel(home, abs_root)
-        if has_glob and not fnmatch.fnmatch(rel, pattern):
+        if compiled.has_glob and not compiled.matches(rel):
             return {}
-        if not has_glob and rel != pattern:
+        if not compiled.has_glob and rel != pattern:
             return {}
         kind = 'symlink' if os.path.islink(abs_root) else 'file'
         return {rel: {'kind': kind}}
 
     results = {}
-    for root, dirs, files in os.walk(abs_root):
-        dirs[:] = [d for d in dirs if d not in DIR_SKIP]
-        for fname in files:
-            if fname in SYSTEM_FILES:
-                continue
-            abs_f = os.path.join(root, fname)
-            rel = normalize_home_rel(home, abs_f)
-
-            if has_glob:
-                if not fnmatch.fnmatch(rel, pattern):
-                    continue
-            elif rel != pattern and not rel.startswith(pattern + '/'):
-                continue
-
-            kind = 'symlink' if os.path.islink(abs_f) else 'file'
-            results[rel] = {'kind': kind}
+    for rel, is_link in scan_tree(home, abs_root, workers, descend=compiled.may_contain):
+        if compiled.matches(rel):
+            results[rel] = {'kind': 'symlink' if is_link else 'file'}
 
     return results
@@ -0,0 +1,389 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from dotsync.tree import DIR_SKIP, compile_pattern
+
+# seconds without new events before a burst of changes is synced
+DEBOUNCE = 0.5
+# a burst that keeps going is synced after this many seconds anyway
+MAX_DELAY = 10.0
+# seconds between two scans of the polling watcher
+POLL_INTERVAL = 1.0
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+EVENT = struct.Struct('iIII')
+
+
+def _active_patterns(filelist_obj, categories):
+    active = filelist_obj.category_mask(categories)
+    return [compile_pattern(tree['pattern']) for tree, mask
+            in zip(filelist_obj.trees, filelist_obj._category_index()[2])
+            if mask & active]
+
+
+def watch_targets(filelist_obj, active_filelist, home, categories):
+    """Return (tree roots, dirs, files) to watch, as absolute paths.
+
+    Tree roots are the directories the active @tree patterns are walked
+    from, watched with everything below them. dirs are only watched for the
+    files directly in them: home, for patterns like *rc, which would
+    otherwise need a watch on all of home. files are the atomic active
+    entries (tree files are covered by their root). Raises ValueError for
+    patterns globbing the first directory below home.
+    """
+    roots = []
+    dirs = []
+    for compiled in _active_patterns(filelist_obj, categories):
+        if compiled.root:
+            roots.append(os.path.normpath(os.path.join(home, compiled.root)))
+        elif '/' not in compiled.pattern:
+            dirs.append(os.path.normpath(home))
+        else:
+            raise ValueError(f'unable to watch @tree:{compiled.pattern}, it '
+                             'would need a watch on every directory in home')
+    files = [os.path.join(home, path) for path, entry in active_filelist.items()
+             if 'kind' not in entry]
+    return sorted(set(roots)), sorted(set(dirs)), sorted(files)
+
+
+def managed(filelist_obj, active_filelist, home, categories):
+    """Return a predicate telling if a changed absolute path is managed.
+
+    That is an active entry or a file an active @tree pattern matches,
+    everything else changing under a watched directory is of no interest.
+    """
+    patterns = _active_patterns(filelist_obj, categories)
+
+    def is_managed(path):
+        rel = os.path.relpath(path, home)
+        if rel == '..' or rel.startswith('..' + os.sep):
+            return False
+        return rel in active_filelist or any(p.matches(rel) for p in patterns)
+
+    return is_managed
+
+
+def _is_under(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def _nearest_existing(path):
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class PollingWatcher:
+    """Finds changes by comparing stat snapshots of everything watched.
+
+    Works on any filesystem and in any container, at the cost of a scan of
+    the tree roots every interval.
+    """
+
+    def __init__(self, roots, files, interval=POLL_INTERVAL, dirs=()):
+        self.roots = roots
+        self.files = files
+        self.dirs = dirs
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode)
+
+    def scan(self):
+        snapshot = {}
+        stack = [root for root in self.roots if os.path.isdir(root)]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in DIR_SKIP:
+                        stack.append(entry.path)
+                else:
+                    snapshot[entry.path] = self._stat(entry.path)
+        for dirname in self.dirs:
+            try:
+                entries = list(os.scandir(dirname))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    snapshot[entry.path] = self._stat(entry.path)
+        for path in self.files:
+            snapshot[path] = self._stat(path)
+        return snapshot
+
+    # waits up to timeout seconds and returns the paths that changed since
+    # the previous call
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        old = self.snapshot
+        self.snapshot = snapshot
+        return {path for path in old.keys() | snapshot.keys()
+                if old.get(path) != snapshot.get(path)}
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Linux inotify based watcher, using libc through ctypes.
+
+    Every directory below the tree roots is watched, as are dirs and the
+    directories holding the atomic files. A root (or file directory) that
+    does not exist yet is covered by watching its nearest existing parent
+    until it shows up.
+    """
+
+    def __init__(self, roots, files, dirs=()):
+        self.roots = roots
+        self.files = set(files)
+        self.flat_dirs = set(dirs)
+        self.file_dirs = sorted({os.path.dirname(path) for path in files}
+                                | self.flat_dirs)
+        self.libc = self._libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1: {os.strerror(err)}')
+        self.dirs = {}
+        self.wds = {}
+        # paths found while adding watches for directories that appeared
+        self.found = set()
+        self.ensure()
+        # whatever exists now is synced before watching starts
+        self.found.clear()
+
+    @staticmethod
+    def _libc():
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        return libc
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            return hasattr(cls._libc(), 'inotify_init1')
+        except OSError:
+            return False
+
+    def add(self, path):
+        if path in self.wds:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logging.warning(f'unable to watch {path}: {os.strerror(err)}')
+            return False
+        self.dirs[wd] = path
+        self.wds[path] = wd
+        return True
+
+    # watches path and every directory below it, remembering the files found
+    # in directories that were not watched before
+    def add_tree(self, path):
+        stack = [path]
+        while stack:
+            dirname = stack.pop()
+            new = self.add(dirname)
+            try:
+                entries = list(os.scandir(dirname))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in DIR_SKIP:
+                        stack.append(entry.path)
+                elif new:
+                    self.found.add(entry.path)
+
+    def ensure(self):
+        for root in self.roots:
+            existing = _nearest_existing(root)
+            if existing == root:
+                self.add_tree(root)
+            else:
+                self.add(existing)
+        for dirname in self.file_dirs:
+            existing = _nearest_existing(dirname)
+            if self.add(existing) and existing == dirname:
+                # files may have been written before the watch was added
+                self.found.update(path for path in self.files
+                                  if os.path.dirname(path) == dirname
+                                  and os.path.lexists(path))
+
+    def _handle(self, path, mask, changed):
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if any(_is_under(path, root) for root in self.roots):
+                    self.add_tree(path)
+                elif any(_is_under(target, path)
+                         for target in self.roots + self.file_dirs):
+                    # a missing root or file directory (or a parent) appeared
+                    self.ensure()
+            elif mask & IN_MOVED_FROM and any(_is_under(path, root)
+                                              for root in self.roots):
+                # the files that went with it are unknown
+                return False
+            return True
+
+        if any(_is_under(path, root) for root in self.roots) \
+                or path in self.files \
+                or os.path.dirname(path) in self.flat_dirs:
+            changed.add(path)
+        return True
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events.
+
+        Returns the changed paths, or None if events were lost and everything
+        has to be looked at again.
+        """
+        changed = set(self.found)
+        self.found.clear()
+        if changed:
+            timeout = 0
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length]
+                offset += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                dirname = self.dirs.get(wd)
+                if mask & IN_IGNORED:
+                    if dirname is not None:
+                        del self.dirs[wd]
+                        self.wds.pop(dirname, None)
+                    continue
+                if dirname is None:
+                    continue
+                path = os.path.join(dirname, os.fsdecode(name.rstrip(b'\0')))
+                if not self._handle(path, mask, changed):
+                    return None
+
+        changed |= self.found
+        self.found.clear()
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def make_watcher(roots, files, poll=False, dirs=()):
+    if not poll and InotifyWatcher.available():
+        try:
+            watcher = InotifyWatcher(roots, files, dirs=dirs)
+            logging.info('watching for changes with inotify')
+            return watcher
+        except OSError as e:
+            logging.warning(f'inotify unavailable ({e}), polling instead')
+    logging.info(f'polling for changes every {POLL_INTERVAL}s')
+    return PollingWatcher(roots, files, dirs=dirs)
+
+
+def run(watcher, sync, rescan, commit=None, debounce=DEBOUNCE,
+        commit_interval=None, max_cycles=None, clock=time.monotonic):
+    """Feed changes reported by watcher to sync until interrupted.
+
+    Changes are collected until none arrive for debounce seconds (or
+    MAX_DELAY passed since the first one) and then handed to sync as a set
+    of absolute paths. rescan is called instead when the watcher lost track.
+    Both return the watcher to use from then on (it changes when the
+    filelist itself was edited). With a commit_interval, commit is called
+    at most that often while there are synced changes. max_cycles stops
+    after that many syncs, for tests.
+    """
+    pending = set()
+    first_change = None
+    cycles = 0
+    dirty = False
+    last_commit = clock()
+
+    try:
+        while max_cycles is None or cycles < max_cycles:
+            changed = watcher.wait(debounce if pending else POLL_INTERVAL)
+            now = clock()
+
+            if changed is None:
+                logging.info('lost track of changes, rescanning')
+                watcher = rescan(watcher)
+                pending.clear()
+                first_change = None
+                cycles += 1
+                dirty = True
+            elif changed:
+                if not pending:
+                    first_change = now
+                pending |= changed
+
+            if pending and (not changed or now - first_change >= MAX_DELAY):
+                logging.info(f'syncing {len(pending)} changed path(s)')
+                watcher = sync(watcher, pending)
+                pending = set()
+                first_change = None
+                cycles += 1
+                dirty = True
+
+            if commit is not None and commit_interval is not None and dirty \
+                    and now - last_commit >= commit_interval:
+                commit()
+                dirty = False
+                last_commit = now
+    except KeyboardInterrupt:
+        logging.info('stopped watching')
+    finally:
+        if commit is not None and commit_interval is not None and dirty:
+            commit()
+        watcher.close()
+
+    return 0
@@ -57,6 +57,15 @@ class TestArguments:
         assert Arguments(['restore', '--yes']).non_interactive
         assert Arguments(['restore', '-y']).non_interactive
 
+    def test_profile(self):
+        assert Arguments(['update']).profile is None
+        # --profile does not take the action as its value
+        args = Arguments(['--profile', 'update'])
+        assert args.profile == 'table'
+        assert args.action == Actions.UPDATE
+        assert Arguments(['update', '--profile']).profile == 'table'
+        assert Arguments(['--profile-format', 'json', 'update']).profile == 'json'
+
     def test_remote_and_categories_filter(self):
         args = Arguments(['restore', '--remote', 'git@github.com:user/dotfiles.git',
                           '--categories', 'shell,vim'])
@@ -97,3 +106,18 @@ class TestArguments:
         assert Arguments([act]).commit_message is None
         assert Arguments(['-m', 'sync', act]).commit_message == 'sync'
         assert Arguments(['--message', 'sync', act]).commit_message == 'sync'
+
+    def test_paths(self):
+        args = Arguments(['update', '/home/u/.zshrc', 'tools', '.vimrc'])
+        assert args.paths == ['/home/u/.zshrc', '.vimrc']
+        assert args.categories == ['tools']
+
+        args = Arguments(['save', '~/.config/nvim'])
+        assert args.paths == ['~/.config/nvim']
+        assert args.categories == ['common', socket.gethostname()]
+
+        args = Arguments(['update', 'tools'])
+        assert args.paths == []
+        assert args.categories == ['tools']
+
+        assert Arguments(['restore', '.vimrc']).paths == []
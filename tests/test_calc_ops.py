@@ -203,6 +203,39 @@ class TestCalcOps:
         assert (home / 'file').is_file()
         assert not (home / 'file').is_symlink()
 
+    def test_restore_prescan(self, tmp_path):
+        from dotsync.calc_ops import RestorePrescan
+        home, repo = self.setup_home_repo(tmp_path)
+        os.makedirs(repo / 'cat1')
+        (repo / 'cat1' / 'same').write_text('same')
+        (repo / 'cat1' / 'changed').write_text('repo')
+        (home / 'same').write_text('same')
+        (home / 'changed').write_text('repo')
+
+        compared = []
+
+        class CountingPlugin(PlainPlugin):
+            def samefile(self, repo_path, home_path):
+                compared.append(os.path.basename(home_path))
+                return super().samefile(repo_path, home_path)
+
+        files = {'same': ['cat1'], 'changed': ['cat1']}
+        plugin = CountingPlugin(tmp_path / '.data')
+        prescan = CalcOps(repo, home, plugin).prescan_restore(
+            files, RestorePrescan())
+        assert sorted(compared) == ['changed', 'same']
+
+        # a file changed after the prescan is compared again
+        (repo / 'cat1' / 'changed').write_text('pulled')
+        compared.clear()
+        from dotsync.policy import RunPolicy
+        policy = RunPolicy(non_interactive=True, conflict='overwrite')
+        calc = CalcOps(repo, home, plugin, policy=policy, prescan=prescan)
+        calc.restore(files).apply()
+
+        assert compared == ['changed']
+        assert (home / 'changed').read_text() == 'pulled'
+
     def test_restore_nomaster_nohome(self, tmp_path, caplog):
         home, repo = self.setup_home_repo(tmp_path)
 
@@ -443,6 +476,65 @@ class TestCalcOps:
 
         assert not (repo / 'cat1').is_dir()
 
+    def test_plan_prune(self, tmp_path):
+        home, repo = self.setup_home_repo(tmp_path)
+        os.makedirs(repo / 'cat1' / 'sub')
+        os.makedirs(repo / 'cat1' / 'gone' / 'deeper')
+        os.makedirs(repo / 'cat1' / 'empty')
+        os.makedirs(repo / 'cat2')
+        (repo / 'cat1' / 'keep').touch()
+        (repo / 'cat1' / 'sub' / 'keep').touch()
+        (repo / 'cat1' / 'sub' / 'old').touch()
+        (repo / 'cat1' / 'gone' / 'old').touch()
+        (repo / 'cat1' / 'gone' / 'deeper' / 'old').touch()
+        (repo / 'cat1' / 'empty' / '.DS_Store').touch()
+
+        calc = CalcOps(repo, home, PlainPlugin(tmp_path / '.data'))
+        plan = calc.plan_prune(['cat1/keep', 'cat1/sub/keep'])
+
+        assert plan.stale == ['cat1/gone/deeper/old', 'cat1/gone/old',
+                              'cat1/sub/old']
+        assert plan.removals == ['cat1/gone/deeper/old', 'cat1/gone/old',
+                                 'cat1/sub/old', 'cat2']
+
+        plan.file_ops().apply()
+        assert (repo / 'cat1' / 'keep').is_file()
+        assert (repo / 'cat1' / 'sub' / 'keep').is_file()
+        assert not (repo / 'cat1' / 'sub' / 'old').exists()
+        assert not (repo / 'cat1' / 'gone' / 'old').exists()
+        assert (repo / 'cat1' / 'gone' / 'deeper').is_dir()
+        assert (repo / 'cat1' / 'empty' / '.DS_Store').is_file()
+        assert not (repo / 'cat2').exists()
+
+    def test_find_stale_repo_files(self, tmp_path):
+        home, repo = self.setup_home_repo(tmp_path)
+        os.makedirs(repo / 'cat1' / 'sub')
+        (repo / 'cat1' / 'keep').touch()
+        (repo / 'cat1' / 'sub' / 'old').touch()
+        (repo / 'cat1' / '.DS_Store').touch()
+
+        calc = CalcOps(repo, home, PlainPlugin(tmp_path / '.data'))
+        assert calc.find_stale_repo_files(['cat1/keep']) == ['cat1/sub/old']
+        assert CalcOps(tmp_path / 'missing', home, PlainPlugin(
+            tmp_path / '.data')).find_stale_repo_files([]) == []
+
+    def test_plan_prune_walks_once(self, tmp_path, monkeypatch):
+        home, repo = self.setup_home_repo(tmp_path)
+        os.makedirs(repo / 'cat1' / 'a' / 'b')
+        (repo / 'cat1' / 'a' / 'b' / 'file').touch()
+
+        scanned = []
+        scandir = os.scandir
+        monkeypatch.setattr(os, 'scandir',
+                            lambda path: scanned.append(path) or scandir(path))
+        monkeypatch.setattr(os, 'listdir', None)
+
+        calc = CalcOps(repo, home, PlainPlugin(tmp_path / '.data'))
+        plan = calc.plan_prune(['cat1/a/b/file'])
+
+        assert not plan
+        assert len(scanned) == len(set(scanned)) == 4
+
     def test_diff(self, tmp_path):
         home, repo = self.setup_home_repo(tmp_path)
 
@@ -0,0 +1,106 @@
+import errno
+import logging
+import os
+import shutil
+
+import pytest
+
+from dotsync import fastcopy
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    fastcopy.clear_cache()
+    yield
+    fastcopy.clear_cache()
+
+
+def test_copyfile(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+    dst = tmp_path / 'dst'
+
+    mode = fastcopy.copyfile(str(src), str(dst))
+    assert mode in fastcopy.MODES
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_copyfile_empty_and_overwrite(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(b'')
+    dst = tmp_path / 'dst'
+    dst.write_text('previous content that is longer')
+
+    fastcopy.copyfile(str(src), str(dst))
+    assert dst.read_bytes() == b''
+
+
+def test_copyfile_same_file(tmp_path):
+    src = tmp_path / 'src'
+    src.write_text('data')
+    with pytest.raises(shutil.SameFileError):
+        fastcopy.copyfile(str(src), str(src))
+
+
+def test_fallback_is_cached_per_device(tmp_path, monkeypatch, caplog):
+    calls = []
+
+    def unsupported(src, dst):
+        calls.append('reflink')
+        raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+    def copy_file_range(src, dst):
+        calls.append('copy_file_range')
+        raise OSError(errno.EXDEV, 'cross device')
+
+    monkeypatch.setitem(fastcopy._COPIERS, 'reflink', unsupported)
+    monkeypatch.setitem(fastcopy._COPIERS, 'copy_file_range', copy_file_range)
+    monkeypatch.setattr(fastcopy, '_available', lambda mode: True)
+
+    src = tmp_path / 'src'
+    src.write_text('data')
+    caplog.set_level(logging.INFO)
+
+    assert fastcopy.copyfile(str(src), str(tmp_path / 'a')) == 'copy'
+    assert fastcopy.copyfile(str(src), str(tmp_path / 'b')) == 'copy'
+    assert calls == ['reflink', 'copy_file_range']
+    assert (tmp_path / 'b').read_text() == 'data'
+    assert caplog.text.count('using copy') == 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'),
+                    reason='needs os.copy_file_range')
+def test_short_copy_file_range_falls_back(tmp_path, monkeypatch):
+    # a filesystem that copies part of the file and then returns 0
+    def copy_file_range(src, dst, count, offset_src=None, offset_dst=None):
+        if offset_src:
+            return 0
+        return os.pwrite(dst, os.pread(src, 2, 0), 0)
+
+    monkeypatch.setattr(fastcopy.os, 'copy_file_range', copy_file_range)
+    monkeypatch.setattr(fastcopy, '_available',
+                        lambda mode: mode != 'reflink')
+
+    src = tmp_path / 'src'
+    src.write_text('data')
+    assert fastcopy.copyfile(str(src), str(tmp_path / 'dst')) == 'copy'
+    assert (tmp_path / 'dst').read_text() == 'data'
+
+
+def test_real_errors_are_raised(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        fastcopy.copyfile(str(tmp_path / 'missing'), str(tmp_path / 'dst'))
+
+
+def test_copy2_keeps_metadata(tmp_path):
+    src = tmp_path / 'src'
+    src.write_text('data')
+    src.chmod(0o600)
+    os.utime(src, (1000000000, 1000000000))
+    os.makedirs(tmp_path / 'dir')
+
+    dst = fastcopy.copy2(str(src), str(tmp_path / 'dir'))
+    assert dst == str(tmp_path / 'dir' / 'src')
+    assert (tmp_path / 'dir' / 'src').read_text() == 'data'
+    assert os.stat(dst).st_mode & 0o777 == 0o600
+    assert os.stat(dst).st_mtime == 1000000000
@@ -1,6 +1,8 @@
 import os
 
-from dotsync.file_ops import FileOps, Op
+import pytest
+
+from dotsync.file_ops import BatchApplyError, FileOps, Op
 
 class TestFileOps:
     def test_init(self, tmp_path):
@@ -108,6 +110,160 @@ class TestFileOps:
         assert plugin.source == str(tmp_path / 'source')
         assert plugin.dest == str(tmp_path / 'dest')
 
+    def test_batchable_plugin(self, tmp_path):
+        fop = FileOps(tmp_path)
+        calls = []
+
+        class Plugin:
+            batchable = True
+
+            def apply(self, source, dest):
+                raise AssertionError('ops must go through run_batch')
+
+            def flush(self):
+                calls.append('flush')
+
+            def run_batch(self, op, pairs):
+                calls.append(pairs)
+                for src, dest in pairs:
+                    with open(dest, 'w') as f:
+                        f.write(os.path.basename(src))
+                return [(src, dest, Exception(f'bad {src}'))
+                        for src, dest in pairs if 'bad' in src]
+
+            def strify(self, op):
+                return 'Plugin.apply'
+
+        plugin = Plugin()
+        fop.plugin(plugin.apply, 'a', 'dest_a')
+        fop.plugin(plugin.apply, 'b', 'dest_b')
+        # touches a file the batch writes, runs after it
+        fop.copy('dest_a', 'copy_a')
+        fop.plugin(plugin.apply, 'bad', 'dest_c')
+        fop.plugin(plugin.apply, 'd', 'dest_d')
+
+        with pytest.raises(BatchApplyError) as e:
+            fop.apply(keep_going=True)
+
+        assert [len(c) if c != 'flush' else c for c in calls] == [4, 'flush']
+        assert (tmp_path / 'copy_a').read_text() == 'a'
+        assert (tmp_path / 'dest_d').read_text() == 'd'
+        assert e.value.errors == [
+            ('Plugin.apply "bad" -> "dest_c"', f'bad {tmp_path / "bad"}')]
+        assert fop.ops == []
+
+    def test_schedule(self, tmp_path):
+        fop = FileOps(tmp_path)
+        fop.mkdir('dir')
+        fop.copy('a', 'dir/a')
+        fop.mkdir('dir')
+        fop.copy('b', 'dir/b')
+        fop.copy('c', 'other')
+        fop.remove('master')
+        fop.move('new', 'master')
+        fop.remove('dir')
+
+        # copies into dir queue mkdirs of their own (1, 3)
+        assert [op for op, _ in fop.ops].count(Op.MKDIR) == 4
+
+        waves = [[i for i, _, _ in wave] for wave in fop.schedule()]
+        # repeated mkdirs of dir are dropped, the copies into dir wait for the
+        # mkdir and the remove of dir waits for everything inside it
+        assert waves == [[0, 6, 7], [2, 5, 8], [9]]
+
+    def test_apply_parallel_matches_serial(self, tmp_path, monkeypatch):
+        def run(wd, workers):
+            monkeypatch.setenv('DOTSYNC_APPLY_WORKERS', str(workers))
+            os.makedirs(wd / 'src')
+            for i in range(50):
+                (wd / 'src' / f'f{i}').write_text(str(i))
+            (wd / 'master').write_text('old')
+            (wd / 'new').write_text('new')
+
+            fop = FileOps(wd)
+            for i in range(50):
+                fop.copy(f'src/f{i}', f'out/d{i % 5}/f{i}')
+                fop.link(f'out/d{i % 5}/f{i}', f'links/f{i}')
+            fop.remove('master')
+            fop.move('new', 'master')
+            fop.apply()
+
+            return sorted((os.path.relpath(os.path.join(root, f), wd),
+                           open(os.path.join(root, f)).read())
+                          for root, _, files in os.walk(wd) for f in files)
+
+        serial = run(tmp_path / 'serial', 1)
+        assert serial == run(tmp_path / 'parallel', 8)
+        assert ('master', 'new') in serial
+        assert ('links/f7', '7') in serial
+
+    def test_apply_errors_in_queue_order(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('DOTSYNC_APPLY_WORKERS', '4')
+        (tmp_path / 'ok').write_text('ok')
+        fop = FileOps(tmp_path)
+        fop.copy('missing1', 'a')
+        fop.copy('ok', 'b')
+        fop.copy('missing2', 'c')
+        fop.copy('b', 'd')
+
+        with pytest.raises(BatchApplyError) as e:
+            fop.apply(keep_going=True)
+        assert [op for op, _ in e.value.errors] == [
+            'COPY "missing1" -> "a"', 'COPY "missing2" -> "c"']
+        assert (tmp_path / 'd').read_text() == 'ok'
+
+    @pytest.mark.parametrize('workers', ['1', '4'])
+    def test_apply_stops_at_first_failure(self, tmp_path, monkeypatch, workers):
+        monkeypatch.setenv('DOTSYNC_APPLY_WORKERS', workers)
+        (tmp_path / 'ok').write_text('ok')
+        fop = FileOps(tmp_path)
+        fop.copy('missing', 'a')
+        fop.copy('ok', 'b')
+        fop.copy('b', 'c')
+
+        with pytest.raises(FileNotFoundError):
+            fop.apply()
+        # nothing after the failed op ran, like in the serial loop
+        assert not (tmp_path / 'c').exists()
+        if workers == '1':
+            assert not (tmp_path / 'b').exists()
+
+    def test_apply_stops_batch_at_first_failure(self, tmp_path):
+        from dotsync.plugin import Plugin
+        ran = []
+
+        class Failing(Plugin):
+            batchable = True
+
+            def apply(self, source, dest):
+                ran.append(os.path.basename(source))
+                if 'bad' in source:
+                    raise ValueError(source)
+
+            def strify(self, op):
+                return 'Failing.apply'
+
+        plugin = Failing(str(tmp_path / '.data'))
+        fop = FileOps(tmp_path)
+        for name in ('a', 'bad', 'c'):
+            fop.plugin(plugin.apply, name, f'dest_{name}')
+
+        with pytest.raises(ValueError):
+            fop.apply()
+        assert ran == ['a', 'bad']
+
+    def test_schedule_shared_source(self, tmp_path):
+        fop = FileOps(tmp_path)
+        fop.copy('src', 'a')
+        fop.copy('src', 'b')
+        fop.remove('src')
+        fop.copy('a', 'c')
+
+        waves = [[i for i, _, _ in wave] for wave in fop.schedule()]
+        # reading the same source does not order the copies, removing it
+        # waits for both
+        assert waves == [[0, 1], [2, 3]]
+
     def test_append(self, tmp_path):
         fop1 = FileOps(tmp_path)
         fop2 = FileOps(tmp_path)
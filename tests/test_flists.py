@@ -1,3 +1,4 @@
+import json
 import os
 import pytest
 import socket
@@ -139,3 +140,150 @@ class TestFilelist:
 
         assert sorted(manifest['encrypt']) == sorted(['cat1/pfile',
                                                       'cat2/pfile'])
+
+
+class TestFilelistCache:
+    CONTENT = ('group=cat1,cat2\ncfile\nnfile:cat1,cat2\n'
+               '@tree:.config/app:cat1\npfile:cat1|encrypt\n')
+
+    def write_flist(self, tmp_path, content):
+        fname = os.path.join(tmp_path, 'filelist')
+        with open(fname, 'w') as f:
+            f.write(content)
+        # out of the racy window so the cache is trusted on stat alone
+        os.utime(fname, ns=(0, os.stat(fname).st_mtime_ns - 10 * 10**9))
+        return fname
+
+    def no_parse(self, monkeypatch):
+        def parse(self, content):
+            raise AssertionError('filelist parsed again')
+        monkeypatch.setattr(Filelist, '_parse', parse)
+
+    def test_cached_matches_parsed(self, tmp_path, monkeypatch):
+        fname = self.write_flist(tmp_path, self.CONTENT)
+        parsed = Filelist(fname)
+        first = Filelist(fname, use_cache=True)
+        assert (tmp_path / '.dotsync' / 'cache' / 'filelist.json').is_file()
+
+        self.no_parse(monkeypatch)
+        cached = Filelist(fname, use_cache=True)
+        for flist in (first, cached):
+            assert flist.groups == parsed.groups
+            assert flist.group_lines == ['group=cat1,cat2']
+            assert flist.files == parsed.files
+            assert flist.trees == parsed.trees
+
+    def test_changed_content_reparsed(self, tmp_path):
+        fname = self.write_flist(tmp_path, self.CONTENT)
+        Filelist(fname, use_cache=True)
+
+        # same size, the mtime differs by a single nanosecond
+        st = os.stat(fname)
+        self.write_flist(tmp_path, self.CONTENT.replace('cfile', 'dfile'))
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+        files = Filelist(fname, use_cache=True).files
+        assert 'dfile' in files
+        assert 'cfile' not in files
+
+    def test_touched_file_uses_cache(self, tmp_path, monkeypatch):
+        fname = self.write_flist(tmp_path, self.CONTENT)
+        Filelist(fname, use_cache=True)
+        os.utime(fname)
+
+        self.no_parse(monkeypatch)
+        assert 'cfile' in Filelist(fname, use_cache=True).files
+
+    def test_hostname_change_reparsed(self, tmp_path, monkeypatch):
+        import dotsync.info
+
+        fname = self.write_flist(tmp_path, self.CONTENT + 'otherhost=cat3\n')
+        Filelist(fname, use_cache=True)
+
+        monkeypatch.setattr(dotsync.info, 'hostname', 'otherhost', raising=False)
+        flist = Filelist(fname, use_cache=True)
+        assert flist.groups['otherhost'] == ['cat3', 'otherhost']
+
+    @pytest.mark.parametrize('garbage', ['{', '[]', '{"version": 2}',
+                                         'cos\nsystem\n(S"true"\ntR.'])
+    def test_bad_cache_reparsed(self, tmp_path, garbage):
+        fname = self.write_flist(tmp_path, self.CONTENT)
+        Filelist(fname, use_cache=True)
+        (tmp_path / '.dotsync' / 'cache' / 'filelist.json').write_text(garbage)
+
+        assert 'cfile' in Filelist(fname, use_cache=True).files
+        # and the cache was written again
+        assert 'cfile' in Filelist(fname, use_cache=True).files
+        assert json.loads(
+            (tmp_path / '.dotsync' / 'cache' / 'filelist.json').read_text())
+
+    def test_invalidate(self, tmp_path):
+        from dotsync.flists import invalidate_filelist_cache
+
+        fname = self.write_flist(tmp_path, self.CONTENT)
+        Filelist(fname, use_cache=True)
+        invalidate_filelist_cache(fname)
+        assert not (tmp_path / '.dotsync' / 'cache' / 'filelist.json').exists()
+        invalidate_filelist_cache(fname)
+
+
+class TestCategoryIndex:
+    def write_flist(self, tmp_path, content):
+        fname = os.path.join(tmp_path, 'filelist')
+        with open(fname, 'w') as f:
+            f.write(content)
+        return fname
+
+    def test_activate_matches_set_intersection(self, tmp_path):
+        content = ('group=cat1,cat2\nhosts=group,cat4\n'
+                   'a:cat1\nb:cat2,cat3\nc\nd:cat4|encrypt\ne:group\nf:cat5\n')
+        flist = Filelist(self.write_flist(tmp_path, content))
+
+        for active in (['cat1'], ['group'], ['hosts'], ['common', 'cat3'],
+                       ['unknown'], ['cat5', 'cat4'], []):
+            cats = flist._flatten_categories(active)
+            expected = {path: group for path, groups in flist.files.items()
+                        for group in groups if set(cats) & set(group['categories'])}
+            assert flist.activate(active) == expected
+
+    def test_expand_trees_nested_groups(self, tmp_path):
+        home = tmp_path / 'home'
+        (home / '.cfg').mkdir(parents=True)
+        (home / '.cfg' / 'a').write_text('a')
+        (home / '.other').mkdir()
+        (home / '.other' / 'o').write_text('o')
+        content = ('g1=b,c\nb=d\nx:b\n@tree:.cfg:b\n@tree:.other:d\n')
+        flist = Filelist(self.write_flist(tmp_path, content))
+
+        # groups are expanded once, like the set intersection did
+        for active in (['g1'], ['b'], ['d'], ['c']):
+            cats = flist._flatten_categories(active)
+            expected = {path for tree in flist.trees
+                        if set(cats) & set(tree['categories'])
+                        for path in flist.walk_tree(str(home), tree['pattern'])}
+            assert set(flist.expand_trees(str(home), active)) == expected
+        assert set(flist.expand_trees(str(home), ['g1'])) == {'.cfg/a'}
+        assert list(flist.activate(['g1'])) == ['x']
+
+    def test_active_files_by_plugin(self, tmp_path):
+        flist = Filelist(self.write_flist(
+            tmp_path, 'a:cat1\nb:cat1|encrypt\nc:cat1\nd:cat2\n'))
+
+        active = flist.activate(['cat1'])
+        assert list(active.by_plugin('plain')) == ['a', 'c']
+        assert list(active.by_plugin('encrypt')) == ['b']
+
+        active['e'] = {'categories': ['cat1'], 'plugin': 'encrypt'}
+        assert list(active.by_plugin('encrypt')) == ['b', 'e']
+        active['a'] = {'categories': ['cat1'], 'plugin': 'encrypt'}
+        assert list(active.by_plugin('plain')) == ['c']
+        del active['c']
+        assert active.by_plugin('plain') == {}
+
+    def test_manifest_is_a_copy(self, tmp_path):
+        flist = Filelist(self.write_flist(tmp_path, 'g=cat1,cat2\na:g\n'))
+
+        manifest = flist.manifest()
+        assert manifest == {'plain': ['cat1/a', 'cat2/a']}
+        manifest['plain'].append('other')
+        assert flist.manifest() == {'plain': ['cat1/a', 'cat2/a']}
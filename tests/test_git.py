@@ -151,6 +151,71 @@ class TestGit:
         self.touch(repo, 'foo')
         assert git.diff() == ['added foo']
 
+    def test_diff_leaves_index_alone(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        self.touch(repo, 'staged')
+        git.add('staged')
+        self.touch(repo, 'untracked')
+
+        assert git.diff() == ['added staged', 'added untracked']
+        assert git.status() == [(FileState.ADDED, 'staged'),
+                                (FileState.UNTRACKED, 'untracked')]
+
+    def test_diff_unstaged_changes(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        for fname in ('moved', 'changed', 'removed'):
+            with open(os.path.join(repo, fname), 'w') as f:
+                f.write(f'{fname} content\n')
+        git.add()
+        git.commit()
+
+        os.makedirs(os.path.join(repo, 'dir'))
+        os.rename(os.path.join(repo, 'moved'), os.path.join(repo, 'dir', 'moved'))
+        with open(os.path.join(repo, 'changed'), 'a') as f:
+            f.write('more\n')
+        os.remove(os.path.join(repo, 'removed'))
+        self.touch(repo, 'new')
+
+        assert git.diff() == ['modified changed', 'renamed moved -> dir/moved',
+                              'added new', 'deleted removed']
+        git.add()
+        assert git.status() == [(FileState.MODIFIED, 'changed'),
+                                (FileState.RENAMED, 'moved -> dir/moved'),
+                                (FileState.ADDED, 'new'),
+                                (FileState.DELETED, 'removed')]
+
+    def test_diff_staged_rename(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        with open(os.path.join(repo, 'a file'), 'w') as f:
+            f.write('content\n')
+        git.add()
+        git.commit()
+        git.run(['git', 'mv', 'a file', 'b file'])
+        assert git.diff() == ['renamed a file -> b file']
+
+    def test_snapshot_shares_status(self, tmp_path, monkeypatch):
+        git, repo = self.setup_git(tmp_path)
+        self.touch(repo, 'foo')
+
+        calls = []
+        run = git.run
+
+        def counting_run(cmd):
+            calls.append(cmd)
+            return run(cmd)
+
+        monkeypatch.setattr(git, 'run', counting_run)
+        with git.snapshot():
+            assert git.has_changes()
+            assert git.gen_commit_message(pending=True) == 'Added foo'
+            assert git.diff() == ['added foo']
+            assert len(calls) == 1
+            git.add()
+            assert git.gen_commit_message() == 'Added foo'
+            assert len(calls) == 3
+        assert git.has_changes()
+        assert len(calls) == 4
+
     def test_diff_no_changes(self, tmp_path):
         git, repo = self.setup_git(tmp_path)
         assert git.diff() == ['no changes']
@@ -166,6 +231,44 @@ class TestGit:
         ).stdout.decode().strip()
         assert git.head_sha() == expected
 
+    def test_head_sha_no_commits(self, tmp_path, caplog):
+        git, repo = self.setup_git(tmp_path)
+        with pytest.raises(subprocess.CalledProcessError):
+            git.head_sha()
+        caplog.clear()
+        assert git.head_sha(check=False) is None
+        assert not [r for r in caplog.records if r.levelname == 'ERROR']
+
+        self.touch(repo, 'file')
+        git.add('file')
+        git.commit('init')
+        assert git.head_sha(check=False) == git.head_sha()
+
+    def test_push_shows_git_output(self, tmp_path, capfd):
+        git, repo = self.setup_git(tmp_path)
+        remote = os.path.join(tmp_path, 'remote')
+        subprocess.run(['git', 'init', '-q', '--bare', remote], check=True)
+        git.add_remote('origin', remote)
+        self.touch(repo, 'file')
+        git.add('file')
+        git.commit('init')
+        capfd.readouterr()
+
+        git.push()
+        # git reports where it pushed on stderr
+        assert f'To {remote}' in capfd.readouterr().err
+
+    def test_wait_fetch(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        git.add_remote('origin', os.path.join(tmp_path, 'missing'))
+        git.start_fetch()
+        pending = git.pending_fetch
+        # a failed fetch nobody asked about is not an error
+        git.wait_fetch()
+        assert pending.done()
+        assert git.pending_fetch is None
+        git.wait_fetch()
+
     def test_has_remote_false(self, tmp_path):
         git, _ = self.setup_git(tmp_path)
         assert not git.has_remote()
@@ -175,12 +278,47 @@ class TestGit:
         subprocess.run(['git', 'remote', 'add', 'origin', repo], cwd=repo, check=True)
         assert git.has_remote()
 
+    def test_ref_queries_cached(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        self.touch(repo, 'file')
+        git.add('file')
+        git.commit('init')
+
+        spawned = Git.spawned
+        sha = git.head_sha()
+        branch = git.branch()
+        assert not git.has_remote()
+        assert git.upstream() is None
+        assert Git.spawned == spawned + 4
+
+        assert git.head_sha() == sha
+        assert git.branch() == branch
+        assert not git.has_remote()
+        assert git.upstream() is None
+        assert Git.spawned == spawned + 4
+
+    def test_ref_cache_invalidated(self, tmp_path):
+        git, repo = self.setup_git(tmp_path)
+        self.touch(repo, 'file')
+        git.add('file')
+        git.commit('init')
+        sha = git.head_sha()
+        assert not git.has_remote()
+
+        git.add_remote('origin', repo)
+        assert git.remotes() == ['origin']
+
+        self.touch(repo, 'file2')
+        git.add('file2')
+        git.commit('second')
+        assert git.head_sha() != sha
+
     def test_pull_ff_only_success(self, tmp_path, monkeypatch):
         git, _ = self.setup_git(tmp_path)
         expected_sha = 'deadbeef' * 5
         calls = []
 
-        def mock_run(cmd):
+        def mock_run(cmd, **kwargs):
             cmd_list = cmd if isinstance(cmd, list) else shlex.split(cmd)
             calls.append(cmd_list)
             if cmd_list[:2] == ['git', 'fetch']:
@@ -198,7 +336,7 @@ class TestGit:
     def test_pull_ff_only_failure_raises(self, tmp_path, monkeypatch):
         git, _ = self.setup_git(tmp_path)
 
-        def mock_run(cmd):
+        def mock_run(cmd, **kwargs):
             cmd_list = cmd if isinstance(cmd, list) else shlex.split(cmd)
             if cmd_list[:2] == ['git', 'fetch']:
                 return ''
@@ -0,0 +1,55 @@
+import hashlib
+import os
+
+from dotsync import hashing
+
+
+def test_hash_file_matches_hashlib(tmp_path):
+    data = os.urandom(3 * hashing.BUFSIZE + 11)
+    f = tmp_path / 'file'
+    f.write_bytes(data)
+
+    assert hashing.hash_file(str(f)) == hashlib.sha256(data).hexdigest()
+    assert (hashing.hash_file(str(f), hashing.FAST)
+            == hashlib.blake2b(data, digest_size=16).hexdigest())
+    assert hashing.hash_file(str(f), 'sha1') == hashlib.sha1(data).hexdigest()
+
+
+def test_hash_file_empty(tmp_path):
+    f = tmp_path / 'file'
+    f.write_bytes(b'')
+    assert hashing.hash_file(str(f)) == hashlib.sha256(b'').hexdigest()
+
+
+def test_hash_file_mmap(tmp_path, monkeypatch):
+    monkeypatch.setattr(hashing, 'MMAP_THRESHOLD', 1024)
+    data = os.urandom(4096)
+    f = tmp_path / 'file'
+    f.write_bytes(data)
+    assert hashing.hash_file(str(f)) == hashlib.sha256(data).hexdigest()
+
+
+def test_samecontent(tmp_path):
+    data = os.urandom(2 * hashing.BUFSIZE + 5)
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_bytes(data)
+    b.write_bytes(data)
+    assert hashing.samecontent(str(a), str(b))
+    assert hashing.samecontent(str(a), str(a))
+
+    b.write_bytes(data[:-1] + bytes([data[-1] ^ 1]))
+    assert not hashing.samecontent(str(a), str(b))
+
+
+def test_samecontent_size_mismatch_reads_nothing(tmp_path, monkeypatch):
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_text('data')
+    b.write_text('more data')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('file was opened')
+
+    monkeypatch.setattr('builtins.open', fail)
+    assert not hashing.samecontent(str(a), str(b))
@@ -0,0 +1,140 @@
+import os
+
+from dotsync.calc_ops import CalcOps
+from dotsync.index import StatIndex
+from dotsync.manifest import CACHE_DIR
+from dotsync.plugins.plain import PlainPlugin
+
+
+def age(path, seconds=60):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 10**9))
+
+
+def setup_pair(tmp_path, content='data'):
+    home = tmp_path / 'home'
+    repo = tmp_path / 'repo'
+    os.makedirs(home)
+    os.makedirs(repo / 'dotfiles' / 'common')
+    ext = home / 'file'
+    master = repo / 'dotfiles' / 'common' / 'file'
+    ext.write_text(content)
+    master.write_text(content)
+    age(ext)
+    age(master)
+    return home, repo, ext, master
+
+
+class CountingPlugin(PlainPlugin):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compared = 0
+
+    def samefile(self, repo_file, ext_file):
+        self.compared += 1
+        return super().samefile(repo_file, ext_file)
+
+
+class TestStatIndex:
+    def test_unknown_pair_misses(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        assert not index.lookup(master, ext)
+
+    def test_record_then_hit(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        assert index.lookup(master, ext)
+
+    def test_persisted_in_cache_dir(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        index.save()
+
+        assert (repo / CACHE_DIR / 'index.json').is_file()
+        assert (repo / CACHE_DIR / '.gitignore').read_text() == '*\n'
+        assert StatIndex(repo).lookup(master, ext)
+
+    def test_changed_content_misses(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        ext.write_text('changed')
+        assert not index.lookup(master, ext)
+
+    def test_touched_same_content_hits(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        os.utime(ext)
+        assert index.lookup(master, ext)
+
+    def test_changed_repo_file_misses(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        master.write_text('data')
+        assert not index.lookup(master, ext)
+
+    def test_recent_files_not_recorded(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        ext.write_text('data')
+        index = StatIndex(repo)
+        index.record(master, ext)
+        assert not index.lookup(master, ext)
+
+    def test_rehash_ignores_entries(self, tmp_path):
+        _, repo, ext, master = setup_pair(tmp_path)
+        index = StatIndex(repo)
+        index.record(master, ext)
+        index.save()
+        assert not StatIndex(repo, rehash=True).lookup(master, ext)
+
+    def test_corrupt_index_ignored(self, tmp_path, caplog):
+        _, repo, ext, master = setup_pair(tmp_path)
+        os.makedirs(repo / CACHE_DIR)
+        (repo / CACHE_DIR / 'index.json').write_text('{not json')
+        assert not StatIndex(repo).lookup(master, ext)
+        assert 'ignoring unreadable stat index' in caplog.text
+
+
+class TestCalcOpsIndex:
+    def test_update_skips_compare_when_indexed(self, tmp_path):
+        home, repo, ext, master = setup_pair(tmp_path)
+        plugin = CountingPlugin(tmp_path / '.data')
+        index = StatIndex(repo)
+        calc = CalcOps(repo / 'dotfiles', home, plugin, index=index)
+
+        calc.update({'file': ['common']}).apply()
+        assert plugin.compared == 1
+
+        calc.update({'file': ['common']}).apply()
+        assert plugin.compared == 1
+        assert index.hits == 1
+
+    def test_update_records_synced_files(self, tmp_path):
+        home, repo, ext, master = setup_pair(tmp_path)
+        ext.write_text('new content')
+        age(ext)
+        plugin = CountingPlugin(tmp_path / '.data')
+        index = StatIndex(repo)
+        calc = CalcOps(repo / 'dotfiles', home, plugin, index=index)
+
+        calc.update({'file': ['common']}).apply()
+        calc.record_synced()
+        assert master.read_text() == 'new content'
+
+        calc.update({'file': ['common']})
+        assert plugin.compared == 1
+
+    def test_diff_uses_index(self, tmp_path):
+        home, repo, ext, master = setup_pair(tmp_path)
+        plugin = CountingPlugin(tmp_path / '.data')
+        index = StatIndex(repo)
+        index.record(master, ext)
+        calc = CalcOps(repo / 'dotfiles', home, plugin, index=index)
+
+        assert calc.diff(['common']) == []
+        assert plugin.compared == 0
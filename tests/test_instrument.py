@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+from dotsync import instrument
+from dotsync.__main__ import main
+
+
+@pytest.fixture(autouse=True)
+def disabled():
+    yield
+    instrument.disable()
+    instrument.reset()
+
+
+def test_disabled_records_nothing():
+    @instrument.timed('work')
+    def work():
+        return 42
+
+    assert work() == 42
+    with instrument.span('block'):
+        pass
+    instrument.count('things', 3)
+
+    data = instrument.report()
+    assert data['spans'] == {}
+    assert data['counters'] == {}
+
+
+def test_spans_and_counters():
+    instrument.enable()
+
+    @instrument.timed('work')
+    def work(fail=False):
+        if fail:
+            raise ValueError()
+        return 1
+
+    work()
+    with pytest.raises(ValueError):
+        work(fail=True)
+    with instrument.span('block'):
+        pass
+    instrument.count('things')
+    instrument.count('things', 2)
+
+    data = instrument.report()
+    assert data['spans']['work']['calls'] == 2
+    assert data['spans']['block']['calls'] == 1
+    assert data['counters'] == {'things': 3}
+    assert 'work' in instrument.format_table(data)
+
+
+def test_enable_resets():
+    instrument.enable()
+    instrument.count('things')
+    instrument.enable()
+    assert instrument.report()['counters'] == {}
+
+
+def test_main_profile_json(tmp_path, capsys):
+    home = tmp_path / 'home'
+    repo = tmp_path / 'repo'
+    os.makedirs(home)
+    os.makedirs(repo)
+    main(args=['init'], cwd=str(repo))
+    (repo / 'filelist').write_text('foo\n')
+    (home / 'foo').write_text('data')
+    capsys.readouterr()
+
+    assert main(args=['update', '--profile-format', 'json'], cwd=str(repo),
+                home=str(home)) == 0
+
+    data = json.loads(capsys.readouterr().err)
+    assert {'prepare_active_filelist', 'CalcOps.update', 'FileOps.apply',
+            'CalcOps.plan_prune'} <= set(data['spans'])
+    assert data['counters']['bytes copied'] == 4
+    assert not instrument.enabled
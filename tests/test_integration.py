@@ -150,6 +150,58 @@ class TestIntegration:
         assert not restored.is_symlink()
         assert restored.read_text() == '{"key": "value"}'
 
+    def test_update_paths(self, tmp_path, monkeypatch):
+        """update PATH... only syncs the entries for the given paths."""
+        home, repo = self.setup_repo(tmp_path, '.foo\n.bar\n@tree:.config/app\n')
+        app = home / '.config' / 'app'
+        app.mkdir(parents=True)
+        (home / '.foo').write_text('foo')
+        (home / '.bar').write_text('bar')
+        (app / 'old.txt').write_text('old')
+        assert main(args=['update'], cwd=str(repo), home=str(home)) == 0
+
+        (home / '.foo').write_text('foo changed')
+        (home / '.bar').write_text('bar changed')
+        (app / 'new.txt').write_text('new')
+        os.remove(app / 'old.txt')
+
+        walked = []
+        for target in ('dotsync.tree.walk_tree', 'dotsync.flists.walk_tree'):
+            monkeypatch.setattr(target, lambda *args, **kwargs: walked.append(args))
+        assert main(
+            args=['update', str(home / '.foo'), str(app / 'new.txt'),
+                  str(app / 'old.txt')],
+            cwd=str(repo),
+            home=str(home),
+        ) == 0
+        assert walked == []
+
+        mirror = repo / 'dotfiles' / 'plain' / 'common'
+        assert (mirror / '.foo').read_text() == 'foo changed'
+        assert (mirror / '.bar').read_text() == 'bar'
+        assert (mirror / '.config' / 'app' / 'new.txt').read_text() == 'new'
+        assert not (mirror / '.config' / 'app' / 'old.txt').exists()
+
+        assert main(args=['update', str(home / '.unmanaged')],
+                    cwd=str(repo), home=str(home)) == 1
+
+    def test_update_paths_glob_tree(self, tmp_path):
+        """update PATH works for files of a glob @tree."""
+        home, repo = self.setup_repo(tmp_path, '@tree:.config/foo/*.json\n')
+        foo = home / '.config' / 'foo'
+        foo.mkdir(parents=True)
+        (foo / 'x.json').write_text('x')
+        (foo / 'y.txt').write_text('y')
+
+        assert main(args=['update', str(foo / 'x.json')],
+                    cwd=str(repo), home=str(home)) == 0
+        mirror = repo / 'dotfiles' / 'plain' / 'common' / '.config' / 'foo'
+        assert (mirror / 'x.json').read_text() == 'x'
+
+        assert main(args=['update', str(foo / 'y.txt')],
+                    cwd=str(repo), home=str(home)) == 1
+        assert not (mirror / 'y.txt').exists()
+
     def test_save_prunes_stale_repo_files_with_confirmation(self, tmp_path, monkeypatch):
         """Removing a file from a watched tree prunes stale repo mirror after confirm."""
         home, repo = self.setup_repo(tmp_path, '@tree:.config/myapp:editor\n')
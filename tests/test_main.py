@@ -226,6 +226,28 @@ class TestMain:
         assert main(args=['passwd'], cwd=str(repo), home=str(home)) == 0
         assert repo_file.read_text() != txt
 
+    def test_reencrypt(self, tmp_path, monkeypatch):
+        home, repo = self.setup_repo(tmp_path, 'file|encrypt')
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+
+        (home / 'file').write_text('secret')
+        assert main(args=['update'], cwd=str(repo), home=str(home)) == 0
+        repo_file = repo / 'dotfiles' / 'encrypt' / 'common' / 'file'
+        assert repo_file.read_bytes().startswith(b'-----BEGIN PGP MESSAGE')
+
+        os.makedirs(repo / '.dotsync', exist_ok=True)
+        (repo / '.dotsync' / 'config.json').write_text('{"armor": false}')
+        assert main(args=['reencrypt', '--dry-run'], cwd=str(repo),
+                    home=str(home)) == 0
+        assert repo_file.read_bytes().startswith(b'-----BEGIN PGP MESSAGE')
+        assert main(args=['reencrypt'], cwd=str(repo), home=str(home)) == 0
+        assert not repo_file.read_bytes().startswith(b'-----BEGIN')
+
+        os.remove(home / 'file')
+        assert main(args=['restore', '--skip-pull', '--non-interactive'],
+                    cwd=str(repo), home=str(home)) == 0
+        assert (home / 'file').read_text() == 'secret'
+
     def test_add_file(self, tmp_path, caplog):
         """Test adding a file and verify auto-update mirrors to repo"""
         home, repo = self.setup_repo(tmp_path, '')
@@ -0,0 +1,178 @@
+import errno
+import json
+import os
+
+import pytest
+
+from dotsync import objects
+from dotsync.__main__ import main
+from dotsync.manifest import CONFIG_FILE
+from dotsync.objects import ObjectStore, object_store
+
+
+def test_link_dedupes(tmp_path):
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_text('same')
+    b.write_text('same')
+    dest = tmp_path / 'repo' / 'files'
+    dest.mkdir(parents=True)
+
+    store.link(str(a), str(dest / 'a'))
+    store.link(str(b), str(dest / 'b'))
+
+    st_a = os.stat(dest / 'a')
+    assert os.path.samestat(st_a, os.stat(dest / 'b'))
+    assert st_a.st_nlink == 3
+    assert (dest / 'a').read_text() == 'same'
+
+
+def test_link_replaces(tmp_path):
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_text('same')
+    b.write_text('same')
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    store.link(str(b), str(tmp_path / 'b.mirror'))
+
+    # a changed source gets a new object, the other mirror keeps the old one
+    a.write_text('changed')
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    assert (tmp_path / 'a.mirror').read_text() == 'changed'
+    assert (tmp_path / 'b.mirror').read_text() == 'same'
+    assert os.stat(tmp_path / 'b.mirror').st_nlink == 2
+
+
+def test_link_mode(tmp_path):
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_text('#!/bin/sh')
+    b.write_text('#!/bin/sh')
+    os.chmod(a, 0o644)
+    os.chmod(b, 0o755)
+
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    store.link(str(b), str(tmp_path / 'b.mirror'))
+
+    assert not os.path.samestat(os.stat(tmp_path / 'a.mirror'),
+                                os.stat(tmp_path / 'b.mirror'))
+    assert os.stat(tmp_path / 'b.mirror').st_mode & 0o777 == 0o755
+
+
+def test_store_names_object_by_stored_bytes(tmp_path, monkeypatch):
+    from dotsync import hashing
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    a.write_text('old')
+    hash_file = hashing.hash_file
+
+    # source changes right after it was hashed
+    def racing_hash_file(path):
+        digest = hash_file(path)
+        a.write_text('new')
+        return digest
+
+    monkeypatch.setattr(objects.hashing, 'hash_file', racing_hash_file)
+    path = store.store(str(a))
+    with open(path) as f:
+        assert f.read() == 'old'
+    assert os.path.basename(path).startswith(hash_file(path))
+
+
+def test_prune(tmp_path):
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    a.write_text('a')
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    assert store.prune() == 0
+
+    os.remove(tmp_path / 'a.mirror')
+    assert store.prune() == 1
+    assert not [name for _, _, files in os.walk(store.root) for name in files
+                if not name.startswith('.')]
+
+
+def test_link_fallback(tmp_path, monkeypatch):
+    def link(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(objects.os, 'link', link)
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    a.write_text('a')
+
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    assert (tmp_path / 'a.mirror').read_text() == 'a'
+    assert os.stat(tmp_path / 'a.mirror').st_nlink == 1
+    assert store.fallback
+
+
+def test_link_fallback_keeps_shared_object(tmp_path, monkeypatch):
+    store = ObjectStore(str(tmp_path / 'repo'))
+    a = tmp_path / 'a'
+    a.write_text('shared')
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+    store.link(str(a), str(tmp_path / 'b.mirror'))
+
+    # a.mirror is linked to the object b.mirror shares, when linking stops
+    # working its new content must not go into that object
+    real_link = os.link
+
+    def link(src, dst):
+        if src.startswith(store.root):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        return real_link(src, dst)
+
+    monkeypatch.setattr(objects.os, 'link', link)
+    a.write_text('changed')
+    store.link(str(a), str(tmp_path / 'a.mirror'))
+
+    assert (tmp_path / 'a.mirror').read_text() == 'changed'
+    assert (tmp_path / 'b.mirror').read_text() == 'shared'
+    assert os.stat(tmp_path / 'a.mirror').st_nlink == 1
+
+
+def test_object_store_config(tmp_path):
+    repo = tmp_path / 'repo'
+    (repo / '.dotsync').mkdir(parents=True)
+    assert object_store(str(repo)) is None
+
+    (repo / CONFIG_FILE).write_text(json.dumps({'object_store': True}))
+    assert isinstance(object_store(str(repo)), ObjectStore)
+
+    (repo / CONFIG_FILE).write_text('{')
+    assert object_store(str(repo)) is None
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_update(tmp_path, enabled):
+    home = tmp_path / 'home'
+    repo = tmp_path / 'repo'
+    home.mkdir()
+    repo.mkdir()
+    main(args=['init'], cwd=str(repo))
+    (repo / 'filelist').write_text('.foo\n.bar\n')
+    (repo / '.dotsync').mkdir(exist_ok=True)
+    (repo / CONFIG_FILE).write_text(json.dumps({'object_store': enabled}))
+    (home / '.foo').write_text('same')
+    (home / '.bar').write_text('same')
+
+    assert main(args=['update'], cwd=str(repo), home=str(home)) == 0
+    mirror = repo / 'dotfiles' / 'plain' / 'common'
+    assert (mirror / '.foo').read_text() == 'same'
+    assert os.path.samestat(os.stat(mirror / '.foo'),
+                            os.stat(mirror / '.bar')) == enabled
+
+    (repo / 'filelist').write_text('.foo\n')
+    (home / '.foo').write_text('changed')
+    assert main(args=['update', '--non-interactive'], cwd=str(repo),
+                home=str(home)) == 0
+    assert (mirror / '.foo').read_text() == 'changed'
+    assert not (mirror / '.bar').exists()
+    if enabled:
+        store = ObjectStore(str(repo))
+        assert store.prune() == 0
+        assert os.stat(mirror / '.foo').st_nlink == 2
@@ -1,3 +1,12 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+from dotsync import instrument
+from dotsync.plugins import encrypt
 from dotsync.plugins.encrypt import GPG, hash_file, EncryptPlugin
 
 
@@ -25,6 +34,32 @@ class TestGPG:
         gpg.decrypt(str(output_file), str(input_file))
         assert input_file.read_text() == txt
 
+    def test_encrypt_hashed(self, tmp_path):
+        txt, input_file, output_file = self.setup_io(tmp_path)
+        gpg = GPG('password123')
+
+        assert gpg.encrypt_hashed(str(input_file), str(output_file)) == \
+            hash_file(str(input_file))
+        gpg.decrypt(str(output_file), str(tmp_path / 'plain'))
+        assert (tmp_path / 'plain').read_text() == txt
+
+    def test_rekey(self, tmp_path):
+        txt, input_file, output_file = self.setup_io(tmp_path)
+        encrypted = tmp_path / 'encrypted'
+        GPG('old').encrypt(str(input_file), str(encrypted))
+
+        GPG('old').rekey(str(encrypted), str(output_file), 'new')
+        GPG('new').decrypt(str(output_file), str(tmp_path / 'plain'))
+        assert (tmp_path / 'plain').read_text() == txt
+
+    def test_rekey_wrong_password(self, tmp_path):
+        txt, input_file, output_file = self.setup_io(tmp_path)
+        encrypted = tmp_path / 'encrypted'
+        GPG('old').encrypt(str(input_file), str(encrypted))
+
+        with pytest.raises(subprocess.CalledProcessError):
+            GPG('wrong').rekey(str(encrypted), str(output_file), 'new')
+
 class TestHash:
     def test_hash(self, tmp_path):
         f = tmp_path / 'file'
@@ -38,7 +73,11 @@ class TestEncryptPlugin:
         (tmp_path / 'hashes').write_text('{"foo": "abcde"}')
         plugin = EncryptPlugin(data_dir=str(tmp_path))
 
-        assert plugin.hashes == {'foo': 'abcde'}
+        assert plugin.hashes == {'foo': {'hash': 'abcde'}}
+        # the old format is written back converted on the next flush
+        plugin.flush()
+        assert json.loads((tmp_path / 'hashes').read_text()) == \
+            {'foo': {'hash': 'abcde'}}
 
     def test_apply(self, tmp_path, monkeypatch):
         sfile = tmp_path / 'source'
@@ -64,9 +103,31 @@ class TestEncryptPlugin:
 
         assert tfile.read_text() == txt
         assert rel_path in plugin.hashes
-        assert plugin.hashes[rel_path] == hash_file(str(sfile))
+        assert plugin.hashes[rel_path]['hash'] == hash_file(str(sfile))
         assert plugin.modes[rel_path] == 0o600
+        assert not (tmp_path / "hashes").exists()
+        assert rel_path in (tmp_path / "journal").read_text()
+
+        plugin.flush()
         assert (tmp_path / "hashes").read_text()
+        assert not (tmp_path / "journal").exists()
+
+    def test_journal_replayed(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        sfile.write_text('hello world')
+
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path), repo_dir=str(tmp_path))
+        plugin.apply(str(sfile), str(tmp_path / 'dest'))
+        # run interrupted before flush, last entry torn mid-write
+        with open(tmp_path / 'journal', 'a') as f:
+            f.write('{"path": "oth')
+
+        plugin = EncryptPlugin(data_dir=str(tmp_path), repo_dir=str(tmp_path))
+        assert plugin.hashes['dest']['hash'] == hash_file(str(sfile))
+        assert plugin.modes == {'dest': sfile.stat().st_mode & 0o777}
+        assert 'dest' in (tmp_path / 'hashes').read_text()
+        assert not (tmp_path / 'journal').exists()
 
     def test_remove(self, tmp_path, monkeypatch):
         txt = 'hello world'
@@ -88,6 +149,47 @@ class TestEncryptPlugin:
         assert dfile.read_text() == tfile.read_text()
         assert dfile.stat().st_mode & 0o777 == 0o600
 
+    def test_run_batch(self, tmp_path, monkeypatch):
+        password = 'password123'
+        prompts = []
+
+        def getpass(prompt):
+            prompts.append(prompt)
+            return password
+
+        monkeypatch.setattr('getpass.getpass', getpass)
+        monkeypatch.setenv('DOTSYNC_GPG_WORKERS', '3')
+        plugin = EncryptPlugin(data_dir=str(tmp_path), repo_dir=str(tmp_path))
+
+        saves = []
+        save_data = plugin.save_data
+        monkeypatch.setattr(plugin, 'save_data', lambda: saves.append(save_data()))
+
+        pairs = []
+        for i in range(5):
+            source = tmp_path / f'source{i}'
+            source.write_text(f'secret {i}')
+            pairs.append((str(source), str(tmp_path / f'enc{i}')))
+        pairs.append((str(tmp_path / 'missing'), str(tmp_path / 'enc_missing')))
+
+        errors = plugin.run_batch(plugin.apply, pairs)
+
+        assert [(s, d) for s, d, _ in errors] == [pairs[-1]]
+        assert not (tmp_path / 'enc_missing').exists()
+        assert saves == []
+        # password is set up once, not per file
+        assert len(prompts) == 2
+        assert sorted(plugin.hashes) == [f'enc{i}' for i in range(5)]
+
+        out = [(d, str(tmp_path / f'dec{i}')) for i, (_, d) in enumerate(pairs[:5])]
+        assert plugin.run_batch(plugin.remove, out) == []
+        for i in range(5):
+            assert (tmp_path / f'dec{i}').read_text() == f'secret {i}'
+
+        plugin.flush()
+        plugin.flush()
+        assert len(saves) == 1
+
     def test_samefile(self, tmp_path, monkeypatch):
         txt = 'hello world'
         password = 'password123'
@@ -105,6 +207,62 @@ class TestEncryptPlugin:
         assert hash_file(str(sfile)) != hash_file(str(dfile))
         assert plugin.samefile(repo_file=str(dfile), ext_file=str(sfile))
 
+    def test_samefile_stat(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        dfile = tmp_path / 'dest'
+        sfile.write_text('hello world')
+        # old enough for its mtime to be trusted
+        mtime_ns = time.time_ns() - 10 * 10**9
+        os.utime(sfile, ns=(mtime_ns, mtime_ns))
+
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path), repo_dir=str(tmp_path))
+        plugin.apply(str(sfile), str(dfile))
+        assert plugin.hashes['dest'] == {'hash': hash_file(str(sfile)),
+                                         'size': 11, 'mtime_ns': mtime_ns}
+
+        hashed = []
+        monkeypatch.setattr('dotsync.plugins.encrypt.hash_file',
+                            lambda path: hashed.append(path) or hash_file(path))
+        instrument.enable()
+        try:
+            assert plugin.samefile(str(dfile), str(sfile))
+            assert hashed == []
+            assert instrument.report()['counters']['hashes avoided'] == 1
+
+            plugin.rehash = True
+            assert plugin.samefile(str(dfile), str(sfile))
+            assert hashed == [str(sfile)]
+            plugin.rehash = False
+
+            # same size and content, new mtime: hashed, still the same
+            os.utime(sfile, ns=(mtime_ns + 1, mtime_ns + 1))
+            assert plugin.samefile(str(dfile), str(sfile))
+            assert len(hashed) == 2
+
+            # same mtime, different size
+            sfile.write_text('hello world!')
+            os.utime(sfile, ns=(mtime_ns, mtime_ns))
+            assert not plugin.samefile(str(dfile), str(sfile))
+        finally:
+            instrument.disable()
+
+    def test_samefile_converted(self, tmp_path):
+        sfile = tmp_path / 'source'
+        sfile.write_text('hello world')
+        mtime_ns = time.time_ns() - 10 * 10**9
+        os.utime(sfile, ns=(mtime_ns, mtime_ns))
+        (tmp_path / 'hashes').write_text(
+            json.dumps({'dest': hash_file(str(sfile))}))
+
+        plugin = EncryptPlugin(data_dir=str(tmp_path), repo_dir=str(tmp_path))
+        assert plugin.samefile(str(tmp_path / 'dest'), str(sfile))
+        # the first match fills in the snapshot the old format lacked
+        assert plugin.hashes['dest'] == {'hash': hash_file(str(sfile)),
+                                         'size': 11, 'mtime_ns': mtime_ns}
+        plugin.flush()
+        assert 'mtime_ns' in (tmp_path / 'hashes').read_text()
+
     def test_verify(self, tmp_path, monkeypatch):
         txt = 'hello world'
         password = 'password123'
@@ -148,6 +306,181 @@ class TestEncryptPlugin:
 
         assert tfile.read_text() == txt
 
+    def test_apply_reuses_ciphertext(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        repo = tmp_path / 'repo'
+        repo.mkdir()
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path / 'data'),
+                               repo_dir=str(repo),
+                               cache_dir=str(tmp_path / 'cache'))
+
+        encrypted = []
+        encrypt_hashed = GPG.encrypt_hashed
+
+        def counting(gpg, input_file, *args, **kwargs):
+            encrypted.append(input_file)
+            return encrypt_hashed(gpg, input_file, *args, **kwargs)
+
+        monkeypatch.setattr(GPG, 'encrypt_hashed', counting)
+
+        sfile.write_text('first')
+        plugin.apply(str(sfile), str(repo / 'dest'))
+        first = (repo / 'dest').read_bytes()
+        sfile.write_text('second')
+        plugin.apply(str(sfile), str(repo / 'dest'))
+        assert (repo / 'dest').read_bytes() != first
+        assert len(encrypted) == 2
+
+        # back to an earlier content, and the same content at another path
+        sfile.write_text('first')
+        plugin.apply(str(sfile), str(repo / 'dest'))
+        plugin.apply(str(sfile), str(repo / 'other'))
+        assert len(encrypted) == 2
+        assert (repo / 'dest').read_bytes() == first
+        assert (repo / 'other').read_bytes() == first
+        assert plugin.hashes['other']['hash'] == hash_file(str(sfile))
+
+        # ciphertexts of the old password are not reused, and dropped
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'new')
+        plugin.change_password(repo=str(repo))
+        plugin.apply(str(sfile), str(repo / 'dest'))
+        assert len(encrypted) == 3
+        plugin.clean_data(['dest'])
+        assert os.listdir(tmp_path / 'cache' / 'encrypt') == \
+            [os.path.basename(plugin.ciphertext_dir())]
+        GPG('new').decrypt(str(repo / 'dest'), str(tmp_path / 'plain'))
+        assert (tmp_path / 'plain').read_text() == 'first'
+
+    def test_apply_hashes_once(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        sfile.write_text('plaintext')
+        repo = tmp_path / 'repo'
+        repo.mkdir()
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path / 'data'),
+                               repo_dir=str(repo),
+                               cache_dir=str(tmp_path / 'cache'))
+
+        instrument.enable()
+        try:
+            plugin.apply(str(sfile), str(repo / 'dest'))
+            assert instrument.report()['counters']['bytes hashed'] == 9
+        finally:
+            instrument.disable()
+        assert plugin.hashes['dest']['hash'] == hash_file(str(sfile))
+
+    def test_prune_ciphertexts(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path / 'data'),
+                               repo_dir=str(tmp_path),
+                               cache_dir=str(tmp_path / 'cache'))
+        sfile.write_text('old')
+        plugin.apply(str(sfile), str(tmp_path / 'dest'))
+        old = plugin.cached_ciphertext(hash_file(str(sfile)))
+        sfile.write_text('new')
+        plugin.apply(str(sfile), str(tmp_path / 'dest'))
+        new = plugin.cached_ciphertext(hash_file(str(sfile)))
+
+        plugin.clean_data(['dest'])
+        assert os.path.exists(old)
+
+        long_ago = time.time() - 2 * encrypt.CIPHERTEXT_MAX_AGE
+        os.utime(old, (long_ago, long_ago))
+        os.utime(new, (long_ago, long_ago))
+        plugin.clean_data(['dest'])
+        assert not os.path.exists(old)
+        # in use, kept and touched
+        assert os.path.exists(new)
+        assert os.stat(new).st_mtime > long_ago
+
+    def test_apply_binary(self, tmp_path, monkeypatch):
+        sfile = tmp_path / 'source'
+        sfile.write_text('hello world')
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password123')
+        plugin = EncryptPlugin(data_dir=str(tmp_path / 'data'),
+                               repo_dir=str(tmp_path), armor=False)
+
+        plugin.apply(str(sfile), str(tmp_path / 'dest'))
+        assert not (tmp_path / 'dest').read_bytes().startswith(b'-----BEGIN')
+        assert plugin.hashes['dest']['armor'] is False
+        assert not plugin.armored('dest')
+
+        plugin.remove(str(tmp_path / 'dest'), str(tmp_path / 'plain'))
+        assert (tmp_path / 'plain').read_text() == 'hello world'
+
+    def test_convert(self, tmp_path, monkeypatch):
+        repo, plugin = self.setup_rekey(tmp_path, monkeypatch, 'password123')
+        armored = (repo / 'a').read_bytes()
+        assert armored.startswith(b'-----BEGIN PGP MESSAGE-----')
+
+        assert plugin.convert(False) == 3
+        assert plugin.convert(False) == 0
+        for name in ['a', 'b', 'c']:
+            assert not (repo / name).read_bytes().startswith(b'-----BEGIN')
+            assert not plugin.armored(name)
+        assert '"armor": false' in (tmp_path / 'data' / 'hashes').read_text()
+
+        # a password change keeps every file in its format
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'new')
+        plugin.change_password(repo=str(repo))
+        assert not (repo / 'a').read_bytes().startswith(b'-----BEGIN')
+        GPG('new').decrypt(str(repo / 'a'), str(tmp_path / 'plain'))
+        assert (tmp_path / 'plain').read_text() == 'a' * 10
+
+        assert plugin.convert(True) == 3
+        assert (repo / 'a').read_bytes().startswith(b'-----BEGIN')
+        assert 'armor' not in plugin.hashes['a']
+
+    def setup_rekey(self, tmp_path, monkeypatch, password):
+        repo = tmp_path / 'repo'
+        repo.mkdir()
+        monkeypatch.setattr('getpass.getpass', lambda prompt: password)
+        plugin = EncryptPlugin(data_dir=str(tmp_path / 'data'),
+                               repo_dir=str(repo))
+        for name in ['a', 'b', 'c']:
+            source = tmp_path / name
+            source.write_text(name * 10)
+            plugin.apply(str(source), str(repo / name))
+        plugin.flush()
+        return repo, plugin
+
+    def test_change_password_only_hashed(self, tmp_path, monkeypatch):
+        repo, plugin = self.setup_rekey(tmp_path, monkeypatch, 'password123')
+        stray = repo / 'stray'
+        stray.write_text('not encrypted')
+
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'new')
+        plugin.change_password(repo=str(repo))
+
+        assert stray.read_text() == 'not encrypted'
+        assert sorted(os.listdir(repo)) == ['a', 'b', 'c', 'stray']
+        assert plugin.verify_password('new')
+        for name in ['a', 'b', 'c']:
+            GPG('new').decrypt(str(repo / name), str(tmp_path / 'out'))
+            assert (tmp_path / 'out').read_text() == name * 10
+
+    def test_change_password_rollback(self, tmp_path, monkeypatch):
+        repo, plugin = self.setup_rekey(tmp_path, monkeypatch, 'password123')
+        before = {name: (repo / name).read_bytes() for name in ['a', 'b', 'c']}
+
+        rekey = GPG.rekey
+
+        def failing_rekey(gpg, input_file, *args):
+            if input_file.endswith('b'):
+                raise subprocess.CalledProcessError(2, ['gpg'])
+            rekey(gpg, input_file, *args)
+
+        monkeypatch.setattr(GPG, 'rekey', failing_rekey)
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'new')
+        with pytest.raises(subprocess.CalledProcessError):
+            plugin.change_password(repo=str(repo))
+
+        assert {name: (repo / name).read_bytes() for name in before} == before
+        assert sorted(os.listdir(repo)) == ['a', 'b', 'c']
+        assert plugin.verify_password('password123')
+
     def test_clean_data(self, tmp_path, monkeypatch):
         txt = 'hello world'
         password = 'password123'
@@ -0,0 +1,121 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from dotsync import proc
+from dotsync.proc import ProcessError, Runner
+
+
+def test_run():
+    result = proc.run(['echo', 'hello'])
+    assert result.returncode == 0
+    assert result.stdout == b'hello\n'
+    assert result.stderr == b''
+
+
+def test_run_input():
+    assert proc.run(['cat'], input=b'data').stdout == b'data'
+    assert proc.run(['cat'], input=iter([b'a', b'b', b'c'])).stdout == b'abc'
+
+
+def test_pipeline():
+    result = proc.pipeline([['printf', 'b\\na\\n'], ['sort']])
+    assert result.stdout == b'a\nb\n'
+
+
+def test_error_has_stderr():
+    with pytest.raises(ProcessError) as e:
+        proc.run(['sh', '-c', 'echo broken >&2; exit 3'])
+    assert isinstance(e.value, subprocess.CalledProcessError)
+    assert e.value.returncode == 3
+    assert e.value.stderr == b'broken\n'
+    assert str(e.value).endswith(': broken')
+
+
+def test_pipeline_error_names_failed_stage():
+    with pytest.raises(ProcessError) as e:
+        proc.pipeline([['sh', '-c', 'echo nope >&2; exit 2'], ['cat']])
+    assert e.value.cmd[0] == 'sh'
+    assert e.value.stderr == b'nope\n'
+
+
+def test_stderr_not_captured(capfd):
+    result = proc.run(['sh', '-c', 'echo progress >&2'], stderr=None)
+    assert result.stderr is None
+    assert capfd.readouterr().err == 'progress\n'
+
+
+def test_no_check():
+    result = proc.run(['false'], check=False)
+    assert result.returncode == 1
+
+
+def test_timeout():
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        proc.run(['sleep', '10'], timeout=0.2)
+    assert time.monotonic() - start < 5
+
+
+def test_interrupt_kills_process(tmp_path):
+    pidfile = tmp_path / 'pid'
+    cmd = ['sh', '-c', f'echo $$ > {pidfile}; exec sleep 30']
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            proc.run(cmd)
+    finally:
+        timer.cancel()
+
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pidfile.read_text()), 0)
+
+
+def test_iterable_input_off_loop():
+    loop_thread = []
+
+    def chunks():
+        loop_thread.append(threading.current_thread().name)
+        yield b'x'
+
+    assert proc.run(['cat'], input=chunks()).stdout == b'x'
+    assert loop_thread and loop_thread[0] != 'dotsync-proc'
+
+
+def test_limit():
+    runner = Runner(2)
+    cmd = [sys.executable, '-c', 'import time; time.sleep(0.3)']
+    start = time.monotonic()
+    futures = [runner.start(cmd) for _ in range(4)]
+    for future in futures:
+        future.result()
+    # four processes two at a time take two rounds
+    assert time.monotonic() - start >= 0.6
+
+
+def test_threads_share_runner():
+    results = []
+
+    def worker(i):
+        results.append(proc.run(['echo', str(i)]).stdout)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == sorted(f'{i}\n'.encode() for i in range(8))
+
+
+def test_proc_workers(monkeypatch, caplog):
+    monkeypatch.setenv('DOTSYNC_PROC_WORKERS', '3')
+    assert proc.proc_workers() == 3
+    monkeypatch.setenv('DOTSYNC_PROC_WORKERS', 'many')
+    assert 1 <= proc.proc_workers() <= proc.MAX_PROC_WORKERS
+    assert 'invalid DOTSYNC_PROC_WORKERS' in caplog.text
@@ -111,3 +111,84 @@ def test_restore_no_remote_uses_local_head(tmp_path, capsys):
     captured = capsys.readouterr()
     assert f'Restoring from commit {expected_sha}' in captured.out
     assert (home / '.file').is_file()
+
+
+
+def setup_clone(tmp_path):
+    home, upstream = setup_repo(tmp_path)
+    open(home / '.file', 'w').write('content')
+    assert main(args=['update'], cwd=str(upstream), home=str(home)) == 0
+    subprocess.run(['git', 'add', '-A'], cwd=str(upstream), check=True)
+    subprocess.run(['git', 'commit', '-qm', 'update'], cwd=str(upstream), check=True)
+
+    repo = tmp_path / 'clone'
+    subprocess.run(['git', 'clone', '-q', str(upstream), str(repo)], check=True)
+    target = tmp_path / 'target'
+    os.makedirs(target)
+    return home, upstream, repo, target
+
+
+def test_restore_fetches_in_background(monkeypatch, tmp_path):
+    home, upstream, repo, target = setup_clone(tmp_path)
+
+    order = []
+    original_start_fetch = Git.start_fetch
+    original_fetch = Git.fetch
+
+    def track_start_fetch(self):
+        order.append('start_fetch')
+        original_start_fetch(self)
+
+    def track_fetch(self):
+        order.append(('fetch', self.pending_fetch is not None))
+        original_fetch(self)
+
+    from dotsync.flists import Filelist
+    original_merge = Filelist.merge_active
+
+    def track_merge(self, *args, **kwargs):
+        order.append('expand')
+        return original_merge(self, *args, **kwargs)
+
+    monkeypatch.setattr(Git, 'start_fetch', track_start_fetch)
+    monkeypatch.setattr(Git, 'fetch', track_fetch)
+    monkeypatch.setattr(Filelist, 'merge_active', track_merge)
+
+    assert main(args=['restore'], cwd=str(repo), home=str(target)) == 0
+    # the fetch was started before the filelist was expanded and the pull
+    # waited for it instead of fetching again
+    assert order == ['start_fetch', 'expand', ('fetch', True)]
+    assert (target / '.file').read_text() == 'content'
+
+
+def test_restore_waits_for_fetch_on_early_return(monkeypatch, tmp_path):
+    home, upstream, repo, target = setup_clone(tmp_path)
+
+    fetches = []
+    original_start_fetch = Git.start_fetch
+
+    def track_start_fetch(self):
+        original_start_fetch(self)
+        fetches.append(self.pending_fetch)
+
+    monkeypatch.setattr(Git, 'start_fetch', track_start_fetch)
+    monkeypatch.setattr('dotsync.__main__.load_filelist', lambda fname: None)
+
+    assert main(args=['restore'], cwd=str(repo), home=str(target)) == 1
+    assert len(fetches) == 1
+    assert fetches[0].done()
+
+
+def test_restore_reexpands_pulled_filelist(tmp_path):
+    home, upstream, repo, target = setup_clone(tmp_path)
+
+    # the pull brings a filelist with a new entry
+    (upstream / 'filelist').write_text('.file:common\n.other:common\n')
+    open(home / '.other', 'w').write('other')
+    assert main(args=['update'], cwd=str(upstream), home=str(home)) == 0
+    subprocess.run(['git', 'add', '-A'], cwd=str(upstream), check=True)
+    subprocess.run(['git', 'commit', '-qm', 'add .other'], cwd=str(upstream), check=True)
+
+    assert main(args=['restore'], cwd=str(repo), home=str(target)) == 0
+    assert (target / '.file').read_text() == 'content'
+    assert (target / '.other').read_text() == 'other'
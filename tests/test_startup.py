@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+
+import dotsync
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(dotsync.__file__))
+
+# modules that quick commands (list, categories, --version) must not load
+HEAVY_MODULES = [
+    'dotsync.git', 'dotsync.calc_ops', 'dotsync.file_ops', 'dotsync.index',
+    'dotsync.plugins.encrypt', 'dotsync.plugins.plain', 'subprocess', 'socket',
+    'dotsync.proc', 'asyncio',
+]
+
+# generous, only meant to catch something heavy sneaking back into the
+# import path of dotsync.__main__
+IMPORT_BUDGET_US = 300000
+
+
+def run_python(code, *args):
+    env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+    return subprocess.run([sys.executable, *args, '-c', code], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True, universal_newlines=True)
+
+
+def loaded_modules(code):
+    out = run_python(code + '\nimport sys\nprint(" ".join(sys.modules))').stdout
+    return set(out.split('\n')[-2].split())
+
+
+def test_import_main_is_light():
+    modules = loaded_modules('import dotsync.__main__')
+    assert not modules & set(HEAVY_MODULES)
+
+
+def test_list_does_not_load_heavy_modules(tmp_path):
+    home = tmp_path / 'home'
+    repo = tmp_path / 'repo'
+    os.makedirs(home)
+    os.makedirs(repo / '.git')
+    (repo / 'filelist').write_text('.bashrc:common\n')
+
+    modules = loaded_modules(
+        'from dotsync.__main__ import main\n'
+        f'assert main(["list"], cwd={str(repo)!r}, home={str(home)!r}) == 0\n'
+        f'assert main(["categories"], cwd={str(repo)!r}, home={str(home)!r}) == 0'
+    )
+    assert 'dotsync.flists' in modules
+    assert not modules & set(HEAVY_MODULES)
+
+
+def test_import_time_budget():
+    stderr = run_python('import dotsync.__main__', '-X', 'importtime').stderr
+    for line in stderr.splitlines():
+        if line.rstrip().endswith('| dotsync.__main__'):
+            cumulative = int(line.split('|')[1])
+            break
+    else:
+        raise AssertionError('dotsync.__main__ missing from -X importtime output')
+    assert cumulative < IMPORT_BUDGET_US
@@ -4,7 +4,7 @@ import pytest
 
 from dotsync.flists import Filelist
 from dotsync.manifest import read_manifest
-from dotsync.tree import materialize_symlinks
+from dotsync.tree import is_internal_target, materialize_symlinks
 
 
 def make_home(tmp_path):
@@ -90,6 +90,33 @@ def test_dedup_when_link_target_also_watched(tmp_path):
     assert entries[0]['canonical_repo_path'] == 'editor/.config/app/real.txt'
 
 
+def test_glob_tree_target_stays_in_tree(tmp_path):
+    home = make_home(tmp_path)
+    repo = make_repo(tmp_path)
+    app = os.path.join(home, '.config', 'app')
+    os.makedirs(app)
+    with open(os.path.join(app, 'real.json'), 'w') as f:
+        f.write('{}')
+    os.symlink('real.json', os.path.join(app, 'link.json'))
+
+    assert is_internal_target('.config/app/real.json', '.config/app/*.json')
+    assert not is_internal_target('.config/app/real.txt', '.config/app/*.json')
+    assert not is_internal_target('.config/other/real.json',
+                                  '.config/app/*.json')
+
+    fname = write_flist(tmp_path, '@tree:.config/app/*.json:editor\n')
+    fl = Filelist(fname)
+    watched = fl.expand_trees(home, ['editor'])
+
+    entries = materialize_symlinks(
+        home, repo, watched, 'editor', '.config/app/*.json'
+    )
+
+    assert len(entries) == 1
+    assert entries[0]['canonical_repo_path'] == 'editor/.config/app/real.json'
+    assert not os.path.exists(os.path.join(repo, '.dotsync', 'materialized'))
+
+
 def test_broken_symlink_warn_skip(tmp_path, caplog):
     home = make_home(tmp_path)
     repo = make_repo(tmp_path)
@@ -153,3 +180,29 @@ def test_external_target_to_dotsync_materialized(tmp_path):
         'target': os.path.join(external, 'secret.cfg'),
         'canonical_repo_path': canonical,
     }
+
+
+def test_materialize_tree_symlinks_walks_each_tree_once(tmp_path):
+    from dotsync.__main__ import materialize_tree_symlinks
+
+    home = make_home(tmp_path)
+    repo = make_repo(tmp_path)
+    for name in ('a', 'b', 'c'):
+        app = os.path.join(home, '.config', name)
+        os.makedirs(app)
+        with open(os.path.join(app, 'real.txt'), 'w') as f:
+            f.write(name)
+        os.symlink('real.txt', os.path.join(app, 'link.txt'))
+
+    fname = write_flist(tmp_path,
+                        '@tree:.config/a:editor\n'
+                        '@tree:.config/b:editor\n'
+                        '@tree:.config/c:editor\n')
+    fl = Filelist(fname)
+    fl.cache_trees()
+    plugin_dirs = {'plain': os.path.join(repo, 'dotfiles', 'plain')}
+
+    canonicals = materialize_tree_symlinks(fl, home, repo, plugin_dirs, ['editor'])
+
+    assert 'editor/.config/c/real.txt' in canonicals['plain']
+    assert fl.tree_cache.walks == 3
@@ -151,3 +151,208 @@ def test_expand_trees_respects_active_categories(tmp_path):
 
     assert fl.expand_trees(home, ['shell']) == {}
     assert fl.expand_trees(home, ['editor']) != {}
+
+
+def test_cached_trees_walk_each_root_once(tmp_path):
+    home = make_home(tmp_path)
+    for root in ('.config/nvim', '.config/alacritty'):
+        os.makedirs(os.path.join(home, root))
+        with open(os.path.join(home, root, 'init'), 'w') as f:
+            f.write('v1')
+
+    fname = write_flist(tmp_path,
+                        '@tree:.config/nvim:editor\n'
+                        '@tree:.config/alacritty:editor\n')
+    fl = Filelist(fname)
+    fl.cache_trees()
+
+    fl.merge_active(home, ['editor'])
+    fl.expand_trees(home, ['editor'])
+    fl.build_save_manifest(home, ['editor'])
+
+    assert fl.tree_cache.walks == 2
+
+
+def test_cached_trees_invalidate(tmp_path):
+    home = make_home(tmp_path)
+    nvim = os.path.join(home, '.config', 'nvim')
+    os.makedirs(nvim)
+    with open(os.path.join(nvim, 'init.lua'), 'w') as f:
+        f.write('v1')
+
+    fname = write_flist(tmp_path, '@tree:.config/nvim:editor\n')
+    fl = Filelist(fname)
+    fl.cache_trees()
+    assert set(fl.expand_trees(home, ['editor'])) == {'.config/nvim/init.lua'}
+
+    with open(os.path.join(nvim, 'plugins.lua'), 'w') as f:
+        f.write('new')
+    assert set(fl.expand_trees(home, ['editor'])) == {'.config/nvim/init.lua'}
+
+    fl.invalidate_trees()
+    assert set(fl.expand_trees(home, ['editor'])) == {
+        '.config/nvim/init.lua',
+        '.config/nvim/plugins.lua',
+    }
+
+
+def _legacy_walk_tree(home, pattern):
+    """os.walk based reference implementation the scandir walker replaced."""
+    import fnmatch
+
+    from dotsync.tree import DIR_SKIP, SYSTEM_FILES, normalize_home_rel, pattern_has_glob, pattern_walk_root
+
+    abs_root = os.path.join(home, pattern_walk_root(pattern))
+    has_glob = pattern_has_glob(pattern)
+    results = {}
+    for root, dirs, files in os.walk(abs_root):
+        dirs[:] = [d for d in dirs if d not in DIR_SKIP]
+        for fname in files:
+            if fname in SYSTEM_FILES:
+                continue
+            abs_f = os.path.join(root, fname)
+            rel = normalize_home_rel(home, abs_f)
+            if has_glob:
+                if not fnmatch.fnmatch(rel, pattern):
+                    continue
+            elif rel != pattern and not rel.startswith(pattern + '/'):
+                continue
+            results[rel] = {'kind': 'symlink' if os.path.islink(abs_f) else 'file'}
+    return results
+
+
+def _make_walk_fixture(home):
+    app = os.path.join(home, '.config', 'app')
+    for sub in ('a/b/c', 'a/d', 'e', 'node_modules/pkg', 'plain-dir'):
+        os.makedirs(os.path.join(app, sub))
+    for rel in ('top.txt', 'a/one', 'a/b/two', 'a/b/c/three', 'a/d/four',
+                'e/five', 'node_modules/pkg/index.js', 'a/.DS_Store',
+                'plain-dir/six'):
+        with open(os.path.join(app, rel), 'w') as f:
+            f.write(rel)
+    os.symlink('top.txt', os.path.join(app, 'link.txt'))
+    os.symlink('missing', os.path.join(app, 'broken'))
+    os.symlink('a', os.path.join(app, 'dirlink'))
+
+
+def test_walk_tree_matches_os_walk(tmp_path):
+    from dotsync.tree import walk_tree
+
+    home = make_home(tmp_path)
+    _make_walk_fixture(home)
+
+    for pattern in ('.config/app', '.config/app/a', '.config/app/*',
+                    '.config/*/a/b*', '.config/app/plain-*', '*top*'):
+        expected = _legacy_walk_tree(home, pattern)
+        for workers in (1, 4):
+            result = walk_tree(home, pattern, workers=workers)
+            assert result == expected
+            assert list(result) == list(expected)
+
+
+def test_walk_tree_reports_symlink_kinds(tmp_path):
+    from dotsync.tree import walk_tree
+
+    home = make_home(tmp_path)
+    _make_walk_fixture(home)
+
+    result = walk_tree(home, '.config/app', workers=2)
+    assert result['.config/app/link.txt'] == {'kind': 'symlink'}
+    assert result['.config/app/broken'] == {'kind': 'symlink'}
+    assert '.config/app/dirlink' not in result
+    assert not any(p.startswith('.config/app/dirlink/') for p in result)
+    assert not any('node_modules' in p for p in result)
+
+
+def test_expand_trees_from_repo_parallel_matches_serial(tmp_path, monkeypatch):
+    from dotsync.tree import expand_trees_from_repo
+
+    plugin_dir = os.path.join(tmp_path, 'plain')
+    _make_walk_fixture(os.path.join(plugin_dir, 'editor'))
+    trees = [{'pattern': '.config/app', 'categories': ['editor'], 'plugin': 'plain'}]
+
+    monkeypatch.setenv('DOTSYNC_WALK_WORKERS', '1')
+    serial = expand_trees_from_repo(plugin_dir, trees, ['editor'])
+    monkeypatch.setenv('DOTSYNC_WALK_WORKERS', '4')
+    parallel = expand_trees_from_repo(plugin_dir, trees, ['editor'])
+
+    assert serial == parallel
+    assert '.config/app/a/b/c/three' in serial
+
+
+def _legacy_find_tree(trees, path):
+    import fnmatch
+
+    from dotsync.tree import pattern_has_glob, pattern_walk_root
+
+    for tree in trees:
+        pattern = tree['pattern']
+        walk_root = pattern_walk_root(pattern)
+        if walk_root and not (path == walk_root or path.startswith(walk_root + '/')):
+            continue
+        if pattern_has_glob(pattern):
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path + '/', pattern + '/*'):
+                return tree
+        elif path == pattern or path.startswith(pattern + '/'):
+            return tree
+    return None
+
+
+def test_tree_matcher_matches_linear_scan():
+    from dotsync.tree import TreeMatcher
+
+    trees = [{'pattern': p} for p in (
+        '.config/nvim', '.config/nvim/lua', '.config', '*rc', '.local/share/app',
+        '.config/*/init.lua', '.ssh', '.sshd', '.config/foo/*.json',
+    )]
+    matcher = TreeMatcher(trees)
+    for path in ('.config/nvim', '.config/nvim/lua/x.lua', '.config/nvimrc',
+                 '.config', '.configx', '.bashrc', '.local/share/app/db',
+                 '.local/share', '.ssh/config', '.sshd/key', '.ssh', '.nothing',
+                 '.config/foo/x.json', '.config/foo/x.txt'):
+        assert matcher.owner(path) is _legacy_find_tree(trees, path)
+
+
+def test_walk_tree_prunes_unmatched_dirs(tmp_path, monkeypatch):
+    import dotsync.tree as tree
+
+    home = make_home(tmp_path)
+    _make_walk_fixture(home)
+
+    scanned = []
+    scan_dir = tree._scan_dir
+
+    def counting_scan_dir(path):
+        scanned.append(os.path.relpath(path, home))
+        return scan_dir(path)
+
+    monkeypatch.setattr(tree, '_scan_dir', counting_scan_dir)
+    result = tree.walk_tree(home, '.config/app/?/*', workers=1)
+
+    assert '.config/app/a/b/c/three' in result
+    assert '.config/app/plain-dir' not in scanned
+    assert sorted(scanned) == ['.config/app', '.config/app/a', '.config/app/a/b',
+                               '.config/app/a/b/c', '.config/app/a/d', '.config/app/e']
+
+    del scanned[:]
+    assert tree.walk_tree(home, '.config/app/a/?', workers=1) == {}
+    assert scanned == ['.config/app/a']
+
+
+def test_walk_tree_pruning_matches_os_walk(tmp_path):
+    from dotsync.tree import walk_tree
+
+    home = make_home(tmp_path)
+    _make_walk_fixture(home)
+    for rel in ('.config/app/x/one', '.config/app/a/c', '.config/app/ab/cd/two'):
+        os.makedirs(os.path.dirname(os.path.join(home, rel)), exist_ok=True)
+        with open(os.path.join(home, rel), 'w') as f:
+            f.write(rel)
+
+    for pattern in ('.config/app/?/*', '.config/app/a/?', '.config/app/a?c*',
+                    '.config/app/[ax]/*', '.config/app/[!a]/one', '.config/a?p/e/*',
+                    '.config/app/a[/]b/*', '.config/app/??/cd/*'):
+        expected = _legacy_walk_tree(home, pattern)
+        result = walk_tree(home, pattern, workers=1)
+        assert result == expected, pattern
+        assert list(result) == list(expected)
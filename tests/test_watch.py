@@ -0,0 +1,266 @@
+import os
+import time
+
+import pytest
+
+from dotsync import watch
+from dotsync.__main__ import main, setup_plugins_and_dirs, sync_paths
+from dotsync.flists import Filelist
+from dotsync.index import StatIndex
+from dotsync.policy import RunPolicy
+
+
+def setup_repo(tmp_path):
+    home = tmp_path / 'home'
+    repo = tmp_path / 'repo'
+    os.makedirs(home / '.config' / 'app')
+    os.makedirs(repo)
+    main(args=['init'], cwd=str(repo))
+    (repo / 'filelist').write_text('.foo\n@tree:.config/app\n')
+    (home / '.foo').write_text('foo')
+    (home / '.config' / 'app' / 'a').write_text('a')
+    (home / '.config' / 'app' / 'b').write_text('b')
+    assert main(args=['update', 'common'], cwd=str(repo), home=str(home)) == 0
+    return home, repo
+
+
+def load_active(repo, home):
+    filelist = Filelist(str(repo / 'filelist'))
+    return filelist, filelist.merge_active(str(home), ['common'])
+
+
+class TestScopeActive:
+    def test_scope(self, tmp_path):
+        home, repo = setup_repo(tmp_path)
+        filelist, active = load_active(repo, home)
+        app = home / '.config' / 'app'
+        (app / 'new').write_text('new')
+        os.remove(app / 'b')
+        (home / '.other').write_text('other')
+
+        paths = [str(home / '.foo'), str(app / 'new'), str(app / 'b'),
+                 str(home / '.other')]
+        scoped, gone, unknown = filelist.scope_active(
+            active, str(home), paths, ['common'])
+
+        assert sorted(scoped) == ['.config/app/new', '.foo']
+        assert list(gone) == ['.config/app/b']
+        assert unknown == [str(home / '.other')]
+        assert '.config/app/new' in active
+        assert '.config/app/b' not in active
+
+    def test_directory(self, tmp_path):
+        home, repo = setup_repo(tmp_path)
+        filelist, active = load_active(repo, home)
+        (home / '.config' / 'app' / 'sub').mkdir()
+        (home / '.config' / 'app' / 'sub' / 'c').write_text('c')
+
+        scoped, gone, unknown = filelist.scope_active(
+            active, str(home), [str(home / '.config' / 'app')], ['common'])
+        assert sorted(scoped) == ['.config/app/a', '.config/app/b',
+                                  '.config/app/sub/c']
+        assert not gone and not unknown
+
+
+    def test_glob_tree(self, tmp_path):
+        home, repo = setup_repo(tmp_path)
+        (repo / 'filelist').write_text('.foo\n@tree:.config/app/*.json\n')
+        filelist, active = load_active(repo, home)
+        app = home / '.config' / 'app'
+        (app / 'new.json').write_text('{}')
+
+        scoped, gone, unknown = filelist.scope_active(
+            active, str(home), [str(app / 'new.json'), str(app / 'a')],
+            ['common'])
+        assert list(scoped) == ['.config/app/new.json']
+        assert not gone
+        assert unknown == [str(app / 'a')]
+
+
+def test_sync_paths(tmp_path):
+    home, repo = setup_repo(tmp_path)
+    filelist, active = load_active(repo, home)
+    plugins, plugin_dirs, _ = setup_plugins_and_dirs(str(repo))
+    mirror = repo / 'dotfiles' / 'plain' / 'common'
+    app = home / '.config' / 'app'
+
+    (home / '.foo').write_text('changed')
+    (app / 'a').write_text('changed')
+    (app / 'new').write_text('new')
+    os.remove(app / 'b')
+
+    result = sync_paths(
+        str(repo), filelist, active, plugins, plugin_dirs, str(home),
+        [str(home / '.foo'), str(app / 'new'), str(app / 'b')], ['common'],
+        RunPolicy(non_interactive=True), StatIndex(str(repo)),
+    )
+    assert result == 0
+    assert (mirror / '.foo').read_text() == 'changed'
+    assert (mirror / '.config' / 'app' / 'new').read_text() == 'new'
+    assert not (mirror / '.config' / 'app' / 'b').exists()
+    # not among the given paths
+    assert (mirror / '.config' / 'app' / 'a').read_text() == 'a'
+
+
+def test_polling_watcher(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'sub' / 'a').write_text('a')
+    single = tmp_path / 'single'
+    single.write_text('x')
+
+    watcher = watch.PollingWatcher([str(root)], [str(single)], interval=0)
+    assert watcher.wait(0) == set()
+
+    (root / 'sub' / 'a').write_text('longer')
+    (root / 'sub' / 'b').write_text('b')
+    os.remove(single)
+    assert watcher.wait(0) == {str(root / 'sub' / 'a'),
+                               str(root / 'sub' / 'b'), str(single)}
+    assert watcher.wait(0) == set()
+
+
+@pytest.mark.skipif(not watch.InotifyWatcher.available(),
+                    reason='inotify not available')
+def test_inotify_watcher(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'old').write_text('old')
+    single = tmp_path / 'dir' / 'single'
+
+    watcher = watch.InotifyWatcher([str(root)], [str(single)])
+    try:
+        assert watcher.wait(0) == set()
+
+        (root / 'old').write_text('changed')
+        (root / 'sub').mkdir()
+        (root / 'sub' / 'new').write_text('new')
+        (tmp_path / 'unrelated').write_text('x')
+        # the parent of single does not exist yet
+        single.parent.mkdir()
+        single.write_text('single')
+
+        changed = set()
+        deadline = time.monotonic() + 5
+        expected = {str(root / 'old'), str(root / 'sub' / 'new'), str(single)}
+        while not expected <= changed and time.monotonic() < deadline:
+            changed |= watcher.wait(0.1)
+        assert changed == expected
+    finally:
+        watcher.close()
+
+
+class FakeWatcher:
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = False
+
+    def wait(self, timeout):
+        return self.events.pop(0) if self.events else set()
+
+    def close(self):
+        self.closed = True
+
+
+def test_run_debounces_and_rescans():
+    watcher = FakeWatcher([{'a'}, {'b'}, set(), None, {'c'}, set()])
+    synced = []
+    rescans = []
+
+    def sync(w, paths):
+        synced.append(set(paths))
+        return w
+
+    def rescan(w):
+        rescans.append(True)
+        return w
+
+    assert watch.run(watcher, sync, rescan, max_cycles=3) == 0
+    assert synced == [{'a', 'b'}, {'c'}]
+    assert rescans == [True]
+    assert watcher.closed
+
+
+def test_run_commits_on_interval():
+    now = [0.0]
+    watcher = FakeWatcher([{'a'}, set(), {'b'}, set(), {'c'}, set()])
+    commits = []
+
+    def clock():
+        now[0] += 10
+        return now[0]
+
+    watch.run(watcher, lambda w, paths: w, lambda w: w,
+              commit=lambda: commits.append(now[0]), commit_interval=25,
+              max_cycles=3, clock=clock)
+    # once when the interval passed and once for what is left at the end
+    assert len(commits) == 2
+
+
+def test_watch_targets(tmp_path):
+    home = tmp_path / 'home'
+    home.mkdir()
+    (tmp_path / 'filelist').write_text(
+        '.foo\n@tree:.config/app\n@tree:.config/foo/*.json\n@tree:*rc\n')
+    filelist = Filelist(str(tmp_path / 'filelist'))
+    active = filelist.merge_active(str(home), ['common'])
+
+    roots, dirs, files = watch.watch_targets(filelist, active, str(home),
+                                             ['common'])
+    assert roots == [str(home / '.config' / 'app'),
+                     str(home / '.config' / 'foo')]
+    # files directly in home are watched without watching all of home
+    assert dirs == [str(home)]
+    assert files == [str(home / '.foo')]
+
+    (tmp_path / 'filelist').write_text('@tree:*/init.lua\n')
+    filelist = Filelist(str(tmp_path / 'filelist'))
+    with pytest.raises(ValueError):
+        watch.watch_targets(filelist, {}, str(home), ['common'])
+
+
+def test_managed(tmp_path):
+    home = tmp_path / 'home'
+    home.mkdir()
+    (tmp_path / 'filelist').write_text('.foo\n@tree:.config/foo/*.json\n')
+    filelist = Filelist(str(tmp_path / 'filelist'))
+    active = filelist.merge_active(str(home), ['common'])
+
+    is_managed = watch.managed(filelist, active, str(home), ['common'])
+    assert is_managed(str(home / '.foo'))
+    assert is_managed(str(home / '.config' / 'foo' / 'x.json'))
+    assert not is_managed(str(home / '.config' / 'foo' / 'x.json.swp'))
+    assert not is_managed(str(tmp_path / 'elsewhere'))
+
+
+def test_polling_watcher_dirs(tmp_path):
+    home = tmp_path / 'home'
+    (home / 'sub').mkdir(parents=True)
+    watcher = watch.PollingWatcher([], [], interval=0, dirs=[str(home)])
+
+    (home / '.bashrc').write_text('x')
+    (home / 'sub' / 'deep').write_text('x')
+    assert watcher.wait(0) == {str(home / '.bashrc')}
+
+
+def test_watch_ignores_unmanaged_changes(tmp_path, monkeypatch, caplog):
+    home, repo = setup_repo(tmp_path)
+    (repo / 'filelist').write_text('.foo\n@tree:.config/app/*.json\n')
+    app = home / '.config' / 'app'
+    (app / 'x.json').write_text('{}')
+    assert main(args=['update', 'common', '--non-interactive'], cwd=str(repo),
+                home=str(home)) == 0
+
+    (app / 'x.json').write_text('{"a": 1}')
+    events = [{str(app / 'a')}, set(), {str(app / 'x.json')}, set()]
+    monkeypatch.setattr(watch, 'make_watcher',
+                        lambda *args, **kwargs: FakeWatcher(events))
+    run = watch.run
+    monkeypatch.setattr(watch, 'run',
+                        lambda *args, **kwargs: run(*args, max_cycles=2, **kwargs))
+
+    assert main(args=['watch', 'common'], cwd=str(repo), home=str(home)) == 0
+    assert 'not managed' not in caplog.text
+    assert 'ERROR' not in caplog.text
+    mirror = repo / 'dotfiles' / 'plain' / 'common' / '.config' / 'app'
+    assert (mirror / 'x.json').read_text() == '{"a": 1}'